@@ -0,0 +1,85 @@
+"""Общие части бенчмарков: хранилище на отдельной БД, заполнение таблиц, замер задержек."""
+import logging
+import statistics
+import subprocess
+import time
+from contextlib import closing
+
+import repertuar_env as env
+
+SONGS_PER_CHUNK = 50000
+TAGS_COUNT = 50
+
+
+def create_storage(backend, database):
+    logger = logging.getLogger("benchmark")
+    if backend == "postgresql":
+        from storage_manager.postgresql_storage_manager import PostgresqlStorageManager
+        return PostgresqlStorageManager(logger, dict(env.POSTGRESQL_CONNECTOR_PARAMS, database=database))
+    if backend == "sqlite":
+        from storage_manager.sqlite_storage_manager import SqliteStorageManager
+        return SqliteStorageManager(logger, dict(database=database + ".sqlite3"))
+    from storage_manager.mysql_storage_manager import MysqlStorageManager
+    return MysqlStorageManager(logger, dict(env.MYSQL_CONNECTOR_PARAMS, database=database))
+
+
+def execute(storage, *statements):
+    """Выполнение SQL-запросов в одной транзакции; результат последнего запроса"""
+    def query(db):
+        result = None
+        with closing(db.cursor()) as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+                result = cursor.fetchall() if cursor.description else None
+        db.commit()
+        return result
+    return storage.pool.run(query)
+
+
+def clear(storage, backend):
+    """Очистка композиций, тегов и сводных таблиц статистики
+    (на song_tags ссылаются внешние ключи, поэтому очищаются все три таблицы)"""
+    if backend == "postgresql":
+        execute(storage, "TRUNCATE TABLE song_tags, tags, repertuar, tag_stats, mark_stats RESTART IDENTITY")
+    elif backend == "sqlite":
+        # TRUNCATE в SQLite нет; полнотекстовый индекс очищают триггеры repertuar
+        execute(storage, "DELETE FROM song_tags", "DELETE FROM tags", "DELETE FROM repertuar",
+                "DELETE FROM tag_stats", "DELETE FROM mark_stats")
+    else:
+        execute(storage, "SET FOREIGN_KEY_CHECKS = 0", "TRUNCATE TABLE song_tags", "TRUNCATE TABLE tags",
+                "TRUNCATE TABLE repertuar", "TRUNCATE TABLE tag_stats", "TRUNCATE TABLE mark_stats",
+                "SET FOREIGN_KEY_CHECKS = 1")
+
+
+def fill(storage, backend, size):
+    """Очистка таблиц и загрузка size композиций; время загрузки в секундах"""
+    clear(storage, backend)
+    started = time.perf_counter()
+    for start in range(0, size, SONGS_PER_CHUNK):
+        rows = [[f"Песня {i}", f"Исполнитель {i % 1000}", f"тег {i % TAGS_COUNT},ретро", str(i % 6)]
+                for i in range(start, min(start + SONGS_PER_CHUNK, size))]
+        storage.add_songs_bulk(rows)
+    seconds = time.perf_counter() - started
+    storage.deck.refresh()
+    return seconds
+
+
+def measure(action, repeats):
+    """Задержки action в миллисекундах: медиана, 95-й перцентиль"""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        action()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return dict(median_ms=round(statistics.median(timings), 3),
+                p95_ms=round(timings[max(int(len(timings) * 0.95) - 1, 0)], 3))
+
+
+def git_commit():
+    """Текущий коммит - чтобы сравнивать результаты между коммитами"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,109 @@
+"""Бенчмарк обработчиков бота целиком: команды слушателей проходят через обработчики, хранилище и
+Telegram API, роль которого играет локальный имитатор (tools/fake_telegram.py). Результат - количество
+обработанных сообщений в секунду (на каждую команду бот отвечает одним сообщением).
+
+Бот работает с отдельной БД (по умолчанию repertuar_bench, таблицы в ней очищаются);
+лимиты отправки сообщений на время замера снимаются.
+
+    python -m benchmarks.handlers --bot sync --backend postgresql --rows 100000 --updates 2000
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import threading
+import time
+
+from aiohttp import web
+
+import repertuar_env as env
+from benchmarks.common import fill, git_commit
+from telegram_sender import RateLimiter
+from tools.fake_telegram import COMMANDS, FakeTelegram, make_update
+
+UNLIMITED = 10 ** 6
+
+
+def start_fake_telegram(port):
+    """Имитатор Telegram API в отдельном потоке со своим циклом событий"""
+    started = threading.Event()
+    holder = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        holder['telegram'] = FakeTelegram()
+        runner = web.AppRunner(holder['telegram'].app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name='fake-telegram', daemon=True).start()
+    started.wait()
+    return holder['telegram']
+
+
+def wait_replies(telegram, count, timeout):
+    deadline = time.monotonic() + timeout
+    while telegram.replies < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", choices=["sync", "async"], default="sync")
+    parser.add_argument("--backend", choices=["postgresql", "mysql", "sqlite"], default="postgresql")
+    parser.add_argument("--database", default="repertuar_bench")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    telegram = start_fake_telegram(args.api_port)
+    # Параметры подменяются до импорта бота: он создаёт хранилище и клиент Telegram при импорте
+    env.TELEGRAM_API_URL = f"http://127.0.0.1:{args.api_port}/bot{{0}}/{{1}}"
+    env.STORAGE_BACKEND = args.backend
+    env.POSTGRESQL_CONNECTOR_PARAMS = dict(env.POSTGRESQL_CONNECTOR_PARAMS, database=args.database)
+    env.MYSQL_CONNECTOR_PARAMS = dict(env.MYSQL_CONNECTOR_PARAMS, database=args.database)
+    env.SQLITE_CONNECTOR_PARAMS = dict(database=args.database + ".sqlite3")
+    module = importlib.import_module("repertuar_tgbot" if args.bot == "sync" else "repertuar_async_tgbot")
+    module.bot.limiter = RateLimiter(UNLIMITED, UNLIMITED, UNLIMITED, UNLIMITED, UNLIMITED)
+
+    # Хранилище бота создаётся в фоне (LazyStorageManager -> TenantStorageManager -> хранилище БД);
+    # замер идёт на репертуаре владельца по умолчанию
+    storage = module.storage if args.bot == "sync" else module.storage.storage
+    storage.wait(args.timeout)
+    fill(storage, args.backend, args.rows)
+
+    updates = [make_update(update_id, 1000 + update_id % args.chats, COMMANDS[update_id % len(COMMANDS)])
+               for update_id in range(1, args.updates + 1)]
+    replies_before = telegram.replies
+    started = time.perf_counter()
+    if args.bot == "sync":
+        module.bot.process_new_updates([module.telebot.types.Update.de_json(update) for update in updates])
+    else:
+        async def process():
+            await asyncio.gather(*(module.process_update(update) for update in updates))
+        asyncio.run(process())
+    wait_replies(telegram, replies_before + args.updates, args.timeout)
+    seconds = time.perf_counter() - started
+    replies = telegram.replies - replies_before
+
+    print(json.dumps(dict(
+        benchmark="handlers",
+        commit=git_commit(),
+        bot=args.bot,
+        backend=args.backend,
+        rows=args.rows,
+        updates=args.updates,
+        replies=replies,
+        seconds=round(seconds, 3),
+        messages_per_second=round(replies / seconds, 1),
+    ), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Бенчмарк выбора случайной композиции: ORDER BY RANDOM() против взвешенного выбора в памяти (SongDeck).
+
+Нужна отдельная БД - таблица repertuar в ней очищается! В докер-образах из папки docker
+для этого создаётся БД repertuar_bench. Параметры соединения берутся из repertuar_env.py,
+имя БД заменяется на --database.
+
+    python -m benchmarks.random_song --backend postgresql --sizes 1000 100000 1000000
+"""
+import argparse
+import json
+import time
+
+from benchmarks.common import create_storage, execute, fill, git_commit, measure
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["postgresql", "mysql", "sqlite"], default="postgresql")
+    parser.add_argument("--database", default="repertuar_bench")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    storage = create_storage(args.backend, args.database)
+    order_by_random = "SELECT id, title, artist, tags, mark FROM repertuar ORDER BY {} LIMIT 1".format(
+        "RAND()" if args.backend == "mysql" else "RANDOM()")
+    for size in args.sizes:
+        fill(storage, args.backend, size)
+        started = time.perf_counter()
+        storage.deck.refresh()
+        deck_load_ms = round((time.perf_counter() - started) * 1000, 3)
+        print(json.dumps(dict(
+            benchmark="random_song",
+            commit=git_commit(),
+            backend=args.backend,
+            rows=size,
+            order_by_random=measure(lambda: execute(storage, order_by_random), args.repeats),
+            deck=measure(storage.get_random_song, args.repeats),
+            deck_load_ms=deck_load_ms,
+        ), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Бенчмарк методов хранилища: массовая загрузка, add_song, get_random_song, get_tags, get_tag_counts,
+get_stats, update_rating и backup на таблицах разного размера.
+
+Как и остальные бенчмарки, работает с отдельной БД (по умолчанию repertuar_bench) - таблицы в ней очищаются.
+Замеряется само хранилище, без кэша CachedStorageManager.
+
+    python -m benchmarks.storage --backend postgresql --sizes 1000 100000 1000000
+"""
+import argparse
+import itertools
+import json
+import random
+
+from benchmarks.common import create_storage, fill, git_commit, measure
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["postgresql", "mysql", "sqlite"], default="postgresql")
+    parser.add_argument("--database", default="repertuar_bench")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--repeats", type=int, default=100)
+    parser.add_argument("--backup-repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    storage = create_storage(args.backend, args.database)
+    for size in args.sizes:
+        bulk_seconds = fill(storage, args.backend, size)
+        song_ids = [song_id for song_id, _, _ in storage.get_song_marks()]
+        new_songs = itertools.count()
+        backup_sizes = []
+
+        def backup():
+            with storage.backup() as backup_file:
+                backup_file.seek(0, 2)
+                backup_sizes.append(backup_file.tell())
+
+        print(json.dumps(dict(
+            benchmark="storage",
+            commit=git_commit(),
+            backend=args.backend,
+            rows=size,
+            bulk_import=dict(seconds=round(bulk_seconds, 3), rows_per_second=round(size / bulk_seconds)),
+            add_song=measure(lambda: storage.add_song(f"Новая песня {next(new_songs)}", "Бенчмарк", "новые", 3),
+                             args.repeats),
+            get_random_song=measure(storage.get_random_song, args.repeats),
+            get_tags=measure(storage.get_tags, args.repeats),
+            get_tag_counts=measure(storage.get_tag_counts, args.repeats),
+            get_stats=measure(storage.get_stats, args.repeats),
+            update_rating=measure(lambda: storage.update_rating(random.choice(song_ids), random.randrange(6)),
+                                  args.repeats),
+            backup=dict(measure(backup, args.backup_repeats), bytes=backup_sizes[-1]),
+        ), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,8 @@
 CREATE DATABASE `viktorkrasikov$repertuar` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
 GRANT ALL PRIVILEGES ON `viktorkrasikov$repertuar`.* TO 'viktorkrasikov'@'%';
 FLUSH PRIVILEGES;
+
+-- Отдельная БД для бенчмарков (таблицы в ней очищаются)
+CREATE DATABASE `repertuar_bench` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+GRANT ALL PRIVILEGES ON `repertuar_bench`.* TO 'viktorkrasikov'@'%';
+FLUSH PRIVILEGES;
@@ -1,2 +1,6 @@
 CREATE DATABASE repertuar;
 GRANT ALL PRIVILEGES ON DATABASE repertuar TO viktorkrasikov;
+
+-- Отдельная БД для бенчмарков (таблицы в ней очищаются)
+CREATE DATABASE repertuar_bench;
+GRANT ALL PRIVILEGES ON DATABASE repertuar_bench TO viktorkrasikov;
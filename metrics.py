@@ -0,0 +1,256 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Гистограммы задержек обработчиков и методов хранилища, счётчики ошибок, а также значения,
+которые считают сами компоненты (обращения к БД пула соединений, попадания кэша, ошибки Telegram API) -
+они читаются в момент выгрузки. Выгрузка - командой /metrics (для администратора)
+или по HTTP (METRICS_PARAMS в repertuar_env.py); там же - проверка готовности бота (/ready).
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, list(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # метки -> [количества по корзинам (последняя - +Inf), сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + [('le', bound)], cumulative))
+            samples.append((self.name + '_sum', labels, round(total, 6)))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class CallbackMetric:
+    """Метрика, значения которой в момент выгрузки возвращает callback() -
+    словарь {кортеж значений меток: значение}"""
+
+    def __init__(self, name, documentation, type, callback, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        return [(self.name, list(zip(self.labelnames, key)), value) for key, value in self.callback().items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, type, callback, labelnames=()):
+        return self.register(CallbackMetric(name, documentation, type, callback, labelnames))
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                lines.append(f"# {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{_format_labels(labels)} {value}" for name, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram('repertuar_handler_seconds', 'Время работы обработчика обновления',
+                                     ['handler'])
+HANDLER_ERRORS = REGISTRY.counter('repertuar_handler_errors_total', 'Исключения в обработчиках', ['handler'])
+STORAGE_SECONDS = REGISTRY.histogram('repertuar_storage_seconds', 'Время вызова метода хранилища', ['method'])
+STORAGE_ERRORS = REGISTRY.counter('repertuar_storage_errors_total', 'Исключения в методах хранилища', ['method'])
+
+
+def _timed(function, histogram, errors, **labels):
+    """Обёртка функции (или корутины), замеряющая время вызова"""
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                try:
+                    return await function(*args, **kwargs)
+                except Exception:
+                    errors.inc(**labels)
+                    raise
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                try:
+                    return function(*args, **kwargs)
+                except Exception:
+                    errors.inc(**labels)
+                    raise
+    return wrapper
+
+
+def instrument_handlers(bot):
+    """Замер времени всех зарегистрированных обработчиков бота (вызывается после их регистрации)"""
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            function = handler['function']
+            handler['function'] = _timed(function, HANDLER_SECONDS, HANDLER_ERRORS, handler=function.__name__)
+
+
+class InstrumentedStorageManager:
+    """Обёртка над хранилищем, замеряющая время вызова каждого метода"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not inspect.ismethod(attr):
+            return attr
+        return _timed(attr, STORAGE_SECONDS, STORAGE_ERRORS, method=name)
+
+
+def register_storage_metrics(storage):
+    """Счётчики пула соединений и кэшей хранилищ владельцев (см. TenantStorageManager)"""
+    REGISTRY.callback('repertuar_db_pool_events_total',
+                      'События пула соединений: checkouts - обращения к БД, connects, disconnects, probes, retries',
+                      'counter', lambda: {(name,): value for name, value in storage.pool.stats().items()
+                                          if name not in ('size', 'idle')}, ['event'])
+    REGISTRY.callback('repertuar_db_pool_connections', 'Открытые соединения с БД (всего и свободные)', 'gauge',
+                      lambda: {(state,): storage.pool.stats()[state] for state in ('size', 'idle')}, ['state'])
+    REGISTRY.callback('repertuar_cache_requests_total', 'Обращения к кэшу хранилища', 'counter',
+                      lambda: {('hit',): storage.cache_stats()['hits'], ('miss',): storage.cache_stats()['misses']},
+                      ['result'])
+    REGISTRY.callback('repertuar_cache_hit_ratio', 'Доля попаданий в кэш хранилища', 'gauge',
+                      lambda: {(): storage.cache_stats()['hit_rate']})
+    REGISTRY.callback('repertuar_cache_entries', 'Записей в кэше хранилища', 'gauge',
+                      lambda: {(): storage.cache_stats()['size']})
+    REGISTRY.callback('repertuar_owner_storages', 'Хранилища владельцев репертуаров в памяти процесса', 'gauge',
+                      lambda: {(): len(storage)})
+    REGISTRY.callback('repertuar_owner_storage_evictions_total', 'Вытеснения хранилищ владельцев из памяти (LRU)',
+                      'counter', lambda: {(): storage.evictions})
+
+
+def register_readiness_metrics(storage):
+    """Готовность хранилища, создаваемого в фоне (см. LazyStorageManager)"""
+    REGISTRY.callback('repertuar_storage_ready', 'Хранилище готово (1) или ещё запускается (0)', 'gauge',
+                      lambda: {(): int(storage.ready)})
+
+
+def register_sender_metrics(bot):
+    """Ошибки Telegram API по методам и кодам (из RateLimitedBot.error_counts())"""
+    REGISTRY.callback('repertuar_telegram_errors_total', 'Ошибки вызовов Telegram API', 'counter',
+                      bot.error_counts, ['method', 'code'])
+
+
+def start_http_server(host='127.0.0.1', port=9100, path='/metrics', ready_path='/ready', status=None):
+    """HTTP-сервер с метриками в отдельном потоке.
+    status - функция, возвращающая 'ready' или причину неготовности бота: по ready_path сервер отвечает
+    200, когда бот готов, и 503, пока нет (проверка готовности контейнера)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == path:
+                self._reply(200, REGISTRY.render(), 'text/plain; version=0.0.4; charset=utf-8')
+            elif self.path == ready_path and status is not None:
+                text = status()
+                self._reply(200 if text == 'ready' else 503, text + "\n", 'text/plain; charset=utf-8')
+            else:
+                self.send_error(404)
+
+        def _reply(self, code, text, content_type):
+            body = text.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
@@ -0,0 +1,534 @@
+"""Асинхронный вариант бота (AsyncTeleBot на asyncio).
+Обработчики не блокируют друг друга ни на запросах к Telegram, ни на запросах к БД:
+вызовы хранилища выполняются в пуле потоков через AsyncStorageManager.
+Запуск: python repertuar_async_tgbot.py (синхронный вариант - python repertuar_tgbot.py)
+С WEBHOOK_PARAMS в repertuar_env.py обновления принимаются через webhook (см. webhook_server.py).
+"""
+import asyncio
+import functools
+import io
+import tempfile
+
+import aiohttp
+from telebot import asyncio_helper, types
+from telebot.asyncio_filters import SimpleCustomFilter
+from telebot.async_telebot import AsyncTeleBot
+
+import repertuar_env as env
+from metrics import REGISTRY, instrument_handlers, register_sender_metrics, start_http_server
+from repertuar_common import ADD_CSV_TEXT, DEFAULT_TENANT_ID, DOWNLOAD_CHUNK_SIZE, MULTI_TENANT, ORDER_TEXT, \
+    RANDOM_SONGS_COUNT, REQUESTS_PAGE_SIZE, RESTORE_TEXT, SEARCH_PAGE_SIZE, STORAGE_UNAVAILABLE_TEXT, \
+    TELEGRAM_FILE_URL, TENANTS, admin_menu_markup, admin_owner, backup_file_name, client_menu_markup, \
+    command_argument, create_logger, create_state_store, create_storage, format_add_result, format_csv_result, \
+    format_order, format_random_songs, format_request_digest, format_restore_progress, format_stats, \
+    format_tag_counts, format_tag_songs, is_admin, marked_rating, needs_storage, order_markup, owner_by_name, \
+    parse_backup_command, parse_callback, parse_csv_rows, random_song_reply, rating_markup, requests_page, \
+    search_page, search_query_from_message, throttled, update_chat_id
+from storage_manager import BACKUP_SPOOL_SIZE
+from storage_manager.async_storage_manager import AsyncStorageManager
+from storage_manager.rating_writer import RatingWriter
+from telegram_sender import PRIORITY_LOW, AsyncRateLimitedBot, RateLimiter
+from webhook_server import run_webhook
+
+logger = create_logger()
+logger.info('Repertuar async bot started')
+
+# Хранилище создаётся в фоне: бот начинает принимать сообщения, не дожидаясь БД
+storage = AsyncStorageManager(create_storage(logger),
+                              max_workers=getattr(env, 'STORAGE_POOL_PARAMS', {}).get('max_size', 10))
+# Оценки записываются в БД отложенно и пачками; RatingWriter.set() не ждёт БД, поэтому вызывается напрямую
+ratings = RatingWriter(storage.storage, **getattr(env, 'RATING_WRITER_PARAMS', {}))
+
+# Инициализация бота
+if getattr(env, 'TELEGRAM_API_URL', None):
+    asyncio_helper.API_URL = env.TELEGRAM_API_URL
+# Отправка сообщений - с учётом лимитов Telegram (см. telegram_sender.py)
+bot = AsyncRateLimitedBot(AsyncTeleBot(env.TELEGRAM_BOT_TOKEN),
+                          RateLimiter(**getattr(env, 'TELEGRAM_RATE_LIMITS', {})), logger=logger)
+request_digest_task = None
+stats_refresh_task = None
+
+# Многошаговые диалоги (/add, /addcsv, заказ композиции): в хранилище состояний сохраняется имя
+# следующего шага и его аргументы, поэтому диалог переживает перезапуск и продолжается любым процессом бота
+states = AsyncStorageManager(create_state_store(storage.storage),
+                             max_workers=getattr(env, 'STORAGE_POOL_PARAMS', {}).get('max_size', 10))
+dialog_steps = {}
+
+
+def dialog_step(function):
+    """Регистрация функции как шага диалога (по имени)"""
+    dialog_steps[function.__name__] = function
+    return function
+
+
+async def register_next_step(message, step, *args):
+    await states.set(message.chat.id, step.__name__, args)
+
+
+class PendingStepFilter(SimpleCustomFilter):
+    """Сообщение, которого ждёт диалог чата; найденное состояние сохраняется в message.pending_step"""
+    key = 'pending_step'
+
+    async def check(self, message):
+        message.pending_step = await states.get(message.chat.id)
+        return message.pending_step is not None
+
+
+bot.add_custom_filter(PendingStepFilter())
+
+
+# Пока хранилище запускается (см. create_storage), вместо обработчиков, которым нужна БД, отвечаем,
+# что бот временно недоступен. Регистрируется раньше всех, поэтому до готовности хранилища остальные не вызываются
+@bot.message_handler(content_types=['text', 'document'],
+                     func=lambda message: not storage.ready and needs_storage(message))
+async def storage_unavailable(message):
+    await bot.send_message(message.chat.id, STORAGE_UNAVAILABLE_TEXT)
+
+
+@bot.callback_query_handler(func=lambda call: not storage.ready)
+async def storage_unavailable_callback(call):
+    await bot.answer_callback_query(call.id, STORAGE_UNAVAILABLE_TEXT)
+
+
+# Следующий после проверки готовности, чтобы ответ в многошаговом диалоге не перехватили другие обработчики
+@bot.message_handler(content_types=['text', 'document'], pending_step=True)
+async def next_step(message):
+    step, args = message.pending_step
+    await states.delete(message.chat.id)
+    if step not in dialog_steps:
+        logger.warning(f"Неизвестный шаг диалога {step}")
+        return
+    await dialog_steps[step](message, *args)
+
+
+async def owner_of(update):
+    """Владелец репертуара, с которым работает отправитель: свой - у администратора,
+    выбранный по ссылке на музыканта - у слушателя"""
+    owner_id = admin_owner(update)
+    if owner_id is None and MULTI_TENANT:
+        owner_id = await storage.get_chat_owner(update_chat_id(update))
+    return DEFAULT_TENANT_ID if owner_id is None else owner_id
+
+
+async def storage_of(update):
+    """Хранилище репертуара владельца, с которым работает отправитель"""
+    return storage.for_owner(await owner_of(update))
+
+
+async def send_admin_menu(chat_id):
+    await bot.send_message(chat_id, "Выберите пункт меню", reply_markup=admin_menu_markup())
+
+
+async def send_client_menu(chat_id):
+    await bot.send_message(chat_id, "Выберите пункт меню", reply_markup=client_menu_markup())
+
+
+@bot.message_handler(commands=['start'])
+async def start(message):
+    owner_id = admin_owner(message)
+    if owner_id is not None:
+        await send_admin_menu(message.chat.id)
+        # Чат администратора - для сводок заказов (см. send_request_digest). /start отвечает и без БД,
+        # тогда чат запомнится при следующем /start
+        if storage.ready:
+            await storage.for_owner(owner_id).set_admin_chat(message.chat.id)
+    else:
+        # "/start <музыкант>" - слушатель пришёл по ссылке на музыканта (t.me/<бот>?start=<музыкант>)
+        name = command_argument(message.text)
+        owner_id = owner_by_name(name) if name else None
+        if owner_id is not None:
+            await storage.set_chat_owner(message.chat.id, owner_id)
+        await bot.send_message(message.chat.id, "Добро пожаловать!")
+        await send_client_menu(message.chat.id)
+
+
+@bot.message_handler(commands=['stats'])
+async def stats(message):
+    if is_admin(message):
+        # Одно чтение сводных таблиц вместо подсчёта по всему репертуару
+        owner_storage = await storage_of(message)
+        await bot.send_message(message.chat.id, format_stats(await owner_storage.get_stats()))
+    else:
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде")
+
+
+@bot.message_handler(commands=['tags'])
+async def tags(message):
+    owner_storage = await storage_of(message)
+    await bot.send_message(message.chat.id, format_tag_counts(await owner_storage.get_tag_counts()))
+
+
+# Команда "/tag ретро" - список композиций с тегом
+@bot.message_handler(commands=['tag'])
+async def songs_by_tag(message):
+    tag = command_argument(message.text)
+    if tag is None:
+        await bot.send_message(message.chat.id, "Укажите тег: /tag ретро")
+        return
+    owner_storage = await storage_of(message)
+    await bot.send_message(message.chat.id, format_tag_songs(tag, await owner_storage.get_songs_by_tag(tag)))
+
+
+# Команда /add для добавления музыкального произведения
+@bot.message_handler(commands=['add'])
+async def add_music(message):
+    if is_admin(message):
+        await bot.send_message(message.chat.id, "Введите название музыкального произведения:")
+        await register_next_step(message, add_artist)
+    else:
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
+
+
+@dialog_step
+async def add_artist(message):
+    title = message.text
+    await bot.send_message(message.chat.id, "Введите исполнителя:")
+    await register_next_step(message, add_tags, title)
+
+
+@dialog_step
+async def add_tags(message, title):
+    artist = message.text
+    await bot.send_message(message.chat.id, "Введите теги через запятую:")
+    await register_next_step(message, add_mark, title, artist)
+
+
+@dialog_step
+async def add_mark(message, title, artist):
+    tags = message.text
+    await bot.send_message(message.chat.id, "Введите оценку от 0 до 5:")
+    await register_next_step(message, add_to_database, title, artist, tags)
+
+
+@dialog_step
+async def add_to_database(message, title, artist, tags):
+    mark = int(message.text)
+    owner_storage = await storage_of(message)
+    result = await owner_storage.add_song(title, artist, tags, mark)
+    await bot.send_message(message.chat.id, format_add_result(title, result))
+
+
+# Команда /addcsv для добавления нескольких музыкальных произведений из CSV
+@bot.message_handler(commands=['addcsv'])
+async def add_csv(message):
+    if is_admin(message):
+        await bot.send_message(message.chat.id, ADD_CSV_TEXT)
+        await register_next_step(message, process_csv_input)
+    else:
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
+
+
+@dialog_step
+async def process_csv_input(message):
+    """Процесс обработки входного текста или файла"""
+    if is_admin(message):
+        if message.content_type in ['text', 'document']:
+            if message.content_type == 'text':
+                rows = parse_csv_rows(message.text)
+            elif message.content_type == 'document':
+                # Получаем файл
+                file_info = await bot.get_file(message.document.file_id)
+                rows = parse_csv_rows((await bot.download_file(file_info.file_path)).decode('utf-8'))
+            logger.info("Получено CSV-сообщение с " + str(len(rows)) + " композиций")
+            owner_storage = await storage_of(message)
+            await bot.send_message(message.chat.id, format_csv_result(await owner_storage.add_songs_bulk(rows)))
+        else:
+            await bot.send_message(chat_id=message.chat.id,
+                                   text="Неподдерживаемый тип сообщения. Пожалуйста, отправьте текст или CSV-файл.")
+    else:
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
+
+
+# Команда /random для получения случайного музыкального произведения
+# ("/random ретро" - случайное произведение с тегом "ретро")
+@bot.message_handler(commands=['random'])
+async def random_music(message):
+    await send_random_song(message, command_argument(message.text))
+
+
+# Сообщение "#ретро" - случайное музыкальное произведение с этим тегом
+@bot.message_handler(func=lambda message: message.text is not None and message.text.startswith('#'))
+async def random_music_by_tag(message):
+    await send_random_song(message, message.text.split()[0])
+
+
+async def send_random_song(message, tag=None):
+    owner_storage = await storage_of(message)
+    text, markup = random_song_reply(await owner_storage.get_random_song(tag), tag, is_admin(message))
+    await bot.send_message(message.chat.id, text, reply_markup=markup)
+
+
+# Команда /random20 - 20 случайных композиций одним сообщением
+@bot.message_handler(commands=['random20'])
+async def random20_music(message):
+    if is_admin(message):
+        owner_storage = await storage_of(message)
+        songs = await owner_storage.get_random_songs(RANDOM_SONGS_COUNT)
+        await bot.send_message(message.chat.id, format_random_songs(songs))
+    else:
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде")
+
+
+async def update_rating(message, song_id, mark, owner_id):
+    # Повторное нажатие на уже отмеченную оценку ничего не меняет
+    if marked_rating(message.reply_markup) == mark:
+        return
+    # Оценка записывается в БД позже (RatingWriter), поэтому композиция проверяется заранее (обычно - по кэшу)
+    if await storage.for_owner(owner_id).get_song(song_id) is None:
+        await bot.send_message(message.chat.id, "Композиция не найдена в базе данных")
+        return
+    ratings.set(song_id, mark, owner_id)
+    await bot.edit_message_reply_markup(message.chat.id, message.id,
+                                        reply_markup=rating_markup(song_id, mark, with_edit=False))
+
+
+# Команда "/search кино" - поиск по названию и исполнителю
+@bot.message_handler(commands=['search'])
+async def search(message):
+    query = command_argument(message.text)
+    if query is None:
+        await bot.send_message(message.chat.id, "Укажите, что искать: /search кино")
+        return
+    query = query.strip()
+    owner_storage = await storage_of(message)
+    text, markup = search_page(query, 0, await owner_storage.search_songs(query, SEARCH_PAGE_SIZE + 1, 0))
+    await bot.send_message(message.chat.id, text, reply_markup=markup)
+
+
+async def show_search_page(message, offset, owner_storage):
+    query = search_query_from_message(message)
+    text, markup = search_page(query, offset, await owner_storage.search_songs(query, SEARCH_PAGE_SIZE + 1, offset))
+    await bot.edit_message_text(text, message.chat.id, message.id, reply_markup=markup)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_handler(call):
+    # Нажатие подтверждается сразу, чтобы у кнопки пропали "часики", не дожидаясь БД
+    await bot.answer_callback_query(call.id)
+    # Владелец - по нажавшему кнопку (call), а не по автору сообщения с кнопкой (бота)
+    owner_id = await owner_of(call)
+    owner_storage = storage.for_owner(owner_id)
+    action, *args = parse_callback(call.data, is_admin(call)) or [None]
+    if action == 'update_rating':
+        song_id, mark = args
+        await update_rating(call.message, song_id, mark, owner_id)
+    elif action == 'search':
+        await show_search_page(call.message, args[0], owner_storage)
+    elif action == 'requests':
+        await show_requests_page(call.message, args[0], owner_storage)
+    elif action == 'request_done':
+        request_id, offset = args
+        await owner_storage.set_song_requests_status([request_id], 'done')
+        await show_requests_page(call.message, offset, owner_storage)
+
+
+@bot.message_handler(func=lambda message: message.text == 'Заказать композицию')
+async def zakaz_song(message):
+    msg = await bot.send_message(message.chat.id, ORDER_TEXT, reply_markup=order_markup())
+    await register_next_step(msg, send_composition_to_admin)
+
+
+@dialog_step
+async def send_composition_to_admin(message):
+    if message.text.lower() != 'назад':
+        composition = message.text
+        # Заказ сохраняется в очередь, администратор получает их сводками (см. send_request_digest)
+        try:
+            owner_storage = await storage_of(message)
+            await owner_storage.add_song_request(message.chat.id, message.from_user.username, composition)
+            # Похожие композиции из репертуара - подсказка заказчику
+            await bot.send_message(message.chat.id, format_order(await owner_storage.search_songs(composition, 3)))
+        except Exception as e:
+            logger.error(e)
+            await bot.send_message(message.chat.id, "Не удалось отправить заявку музыканту")
+    await send_client_menu(message.chat.id)
+
+
+# Владельцы, о неотправленных заказах которых журнал уже предупредил
+digest_warned_owners = set()
+
+
+async def send_request_digest():
+    """Сводки новых заказов администраторам: по сообщению на владельца репертуара вместо сообщения на каждый заказ.
+    Заказы владельца дождутся, пока его администратор не выполнит /start"""
+    for owner_id in TENANTS:
+        owner_storage = storage.for_owner(owner_id)
+        chat_id = await owner_storage.get_admin_chat()
+        if chat_id is None:
+            if owner_id not in digest_warned_owners and await owner_storage.get_pending_song_requests(limit=1):
+                digest_warned_owners.add(owner_id)
+                logger.warning(f"Есть заказы композиций владельца {owner_id}, но чат его администратора неизвестен: "
+                               "сводки будут отправляться после /start администратора")
+            continue
+        requests = await owner_storage.claim_song_requests(getattr(env, 'REQUEST_DIGEST_PARAMS', {}).get('limit', 50))
+        if not requests:
+            continue
+        request_ids = [request.id for request in requests]
+        # Сводка несрочная: уходит через очередь отправки с низким приоритетом.
+        # Если отправить не удастся, заказы вернутся в очередь до следующей сводки
+        bot.enqueue('send_message', chat_id, format_request_digest(requests), priority=PRIORITY_LOW,
+                    on_error=lambda e, owner_storage=owner_storage, request_ids=request_ids:
+                    owner_storage.set_song_requests_status(request_ids, 'new'))
+
+
+async def request_digest_loop():
+    interval = getattr(env, 'REQUEST_DIGEST_PARAMS', {}).get('interval', 300)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await send_request_digest()
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки заказов: {e}")
+
+
+async def stats_refresh_loop(interval):
+    """Периодический пересчёт сводных таблиц статистики (исправляет изменения в обход бота)"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await storage.refresh_stats()
+        except Exception as e:
+            logger.error(f"Ошибка пересчёта статистики: {e}")
+
+
+def start_background_tasks():
+    global request_digest_task, stats_refresh_task
+    request_digest_task = asyncio.create_task(request_digest_loop())
+    if getattr(env, 'STATS_REFRESH_PARAMS', None):
+        stats_refresh_task = asyncio.create_task(stats_refresh_loop(env.STATS_REFRESH_PARAMS['interval']))
+
+
+# Команда /requests - невыполненные заказы композиций
+@bot.message_handler(commands=['requests'])
+async def requests_command(message):
+    if is_admin(message):
+        owner_storage = await storage_of(message)
+        text, markup = requests_page(0, await owner_storage.get_pending_song_requests(REQUESTS_PAGE_SIZE + 1, 0))
+        await bot.send_message(message.chat.id, text, reply_markup=markup)
+    else:
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде")
+
+
+async def show_requests_page(message, offset, owner_storage):
+    requests = await owner_storage.get_pending_song_requests(REQUESTS_PAGE_SIZE + 1, offset)
+    if not requests and offset > 0:
+        # Последний заказ страницы выполнен - показываем предыдущую
+        offset = max(offset - REQUESTS_PAGE_SIZE, 0)
+        requests = await owner_storage.get_pending_song_requests(REQUESTS_PAGE_SIZE + 1, offset)
+    text, markup = requests_page(offset, requests)
+    await bot.edit_message_text(text, message.chat.id, message.id, reply_markup=markup)
+
+
+@bot.message_handler(commands=['backup'])
+async def backup_command(message):
+    """Обработчик команды /backup: "/backup [inc|diff] [gz]" - полный, инкрементный (изменения после
+    предыдущего бэкапа) или дифференциальный (после предыдущего полного) бэкап, gz - сжатый"""
+    try:
+        kind, compress = parse_backup_command(message.text)
+        owner_storage = await storage_of(message)
+        with await owner_storage.backup(compress, kind) as backup_file:
+            await bot.send_document(chat_id=message.chat.id, document=backup_file,
+                                    visible_file_name=backup_file_name(kind, compress))
+    except Exception as e:
+        await bot.send_message(chat_id=message.chat.id, text=f"Произошла ошибка: {str(e)}")
+
+
+async def download_document(document):
+    """Скачивание документа во временный файл по частям, без загрузки файла в память целиком"""
+    file_info = await bot.get_file(document.file_id)
+    url = (asyncio_helper.FILE_URL or TELEGRAM_FILE_URL).format(env.TELEGRAM_BOT_TOKEN, file_info.file_path)
+    buffer = tempfile.SpooledTemporaryFile(BACKUP_SPOOL_SIZE)
+    try:
+        async with aiohttp.ClientSession() as session, session.get(url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                buffer.write(chunk)
+    except BaseException:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+
+@bot.message_handler(commands=['restore'])
+async def restore_command(message):
+    """Обработчик команды /restore: восстановление композиций из файла бэкапа"""
+    if is_admin(message):
+        await bot.send_message(message.chat.id, RESTORE_TEXT)
+        await register_next_step(message, process_restore_file)
+    else:
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
+
+
+@dialog_step
+async def process_restore_file(message):
+    """Восстановление из присланного файла бэкапа в одной транзакции с сообщением о ходе восстановления"""
+    if not is_admin(message):
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
+        return
+    if message.content_type != 'document':
+        await bot.send_message(message.chat.id, "Пожалуйста, отправьте файл бэкапа.")
+        return
+    owner_storage = await storage_of(message)
+    status = await bot.send_message(message.chat.id, format_restore_progress())
+    loop = asyncio.get_running_loop()
+
+    def report(result):
+        # Вызывается из потока хранилища: правка сообщения ставится в очередь в цикле событий бота
+        loop.call_soon_threadsafe(functools.partial(bot.enqueue, 'edit_message_text', format_restore_progress(result),
+                                                    message.chat.id, status.message_id))
+
+    try:
+        with await download_document(message.document) as backup_file:
+            result = await owner_storage.restore(backup_file, throttled(report))
+    except Exception as e:
+        logger.error(f"Ошибка восстановления из бэкапа: {e}")
+        await bot.send_message(message.chat.id, f"Восстановление не выполнено, данные не изменены: {str(e)}")
+        return
+    logger.info(f"Восстановление из бэкапа: {result}")
+    bot.enqueue('edit_message_text', format_restore_progress(result, done=True), message.chat.id, status.message_id)
+    await bot.send_message(message.chat.id, format_csv_result(result))
+
+
+@bot.message_handler(commands=['metrics'])
+async def metrics_command(message):
+    """Метрики бота в формате Prometheus (файлом - текст бывает длиннее сообщения)"""
+    if is_admin(message):
+        await bot.send_document(message.chat.id, io.BytesIO(REGISTRY.render().encode('utf-8')),
+                                visible_file_name='metrics.txt')
+    else:
+        await bot.send_message(message.chat.id, "У вас нет доступа к этой команде")
+
+
+# Замер времени всех обработчиков и счётчики ошибок Telegram API
+instrument_handlers(bot)
+register_sender_metrics(bot)
+
+
+async def process_update(update):
+    """Обработка обновления, полученного через webhook (см. webhook_server.py)"""
+    await bot.process_new_updates([types.Update.de_json(update)])
+
+
+async def setup_webhook():
+    # Выполняется при старте webhook-сервера в одном процессе - там же работает и рассылка сводок
+    start_background_tasks()
+    params = env.WEBHOOK_PARAMS
+    await bot.set_webhook(url=params['url'], secret_token=params.get('secret_token'),
+                          max_connections=params.get('max_connections', 40))
+
+
+async def run_polling():
+    start_background_tasks()
+    await bot.remove_webhook()
+    await bot.polling()
+
+
+# Запуск бота: webhook, если он настроен в repertuar_env.py, иначе long polling
+if __name__ == '__main__':
+    if getattr(env, 'METRICS_PARAMS', None):
+        start_http_server(**env.METRICS_PARAMS, status=storage.storage.status)
+    if getattr(env, 'WEBHOOK_PARAMS', None):
+        run_webhook(env.WEBHOOK_PARAMS, process_update, setup_webhook, 'repertuar_async_tgbot', logger)
+    else:
+        asyncio.run(run_polling())
@@ -0,0 +1,423 @@
+"""Общие для синхронного (repertuar_tgbot.py) и асинхронного (repertuar_async_tgbot.py) ботов части:
+логирование, создание хранилища, разбор команд, тексты сообщений и клавиатуры.
+Функции здесь не обращаются ни к Telegram, ни к БД: обработчики ботов передают им уже полученные данные,
+а вызовы API и хранилища (синхронные или с await) остаются в самих ботах."""
+import functools
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from telebot import types
+
+import repertuar_env as env
+from metrics import InstrumentedStorageManager, register_readiness_metrics, register_storage_metrics
+from storage_manager import BACKUP_DIFFERENTIAL, BACKUP_FULL, BACKUP_INCREMENTAL, DEFAULT_OWNER_ID
+from storage_manager.cached_storage_manager import CachedStorageManager
+from storage_manager.lazy_storage_manager import LazyStorageManager
+from storage_manager.state_store import DatabaseStateStore, MemoryStateStore
+from storage_manager.tenant_storage_manager import TenantStorageManager
+
+SEARCH_PAGE_SIZE = 10
+SEARCH_HEADER = "Поиск: "
+REQUESTS_PAGE_SIZE = 10
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+# Аргументы команды /backup для частичных бэкапов
+BACKUP_KINDS = {'inc': BACKUP_INCREMENTAL, 'diff': BACKUP_DIFFERENTIAL}
+# Подсказки многошаговых диалогов /addcsv, заказа композиции и /restore
+ADD_CSV_TEXT = "Вставьте список мулькальных композиций в формате CSV:\n" \
+               "Название;Исполнитель;Тэги через запятую (не обязательно);Оценка от 0 до 5 (не обязательно)\n\n" \
+               "Или отправьте CSV-файл с вышеописанным содержимым."
+ORDER_TEXT = "Введите название песни, которую вы хотели бы заказать или нажмите 'Назад' для возврата."
+RESTORE_TEXT = "Отправьте файл бэкапа (CSV или CSV.GZ, полученный командой /backup).\n" \
+               "Новые композиции будут добавлены, у сохранённых обновятся теги и оценки. " \
+               "Частичные бэкапы отправляйте после полного, в порядке создания."
+# Сколько случайных композиций присылает /random20
+RANDOM_SONGS_COUNT = 20
+# Ответ на сообщения, пока хранилище не готово (БД недоступна или идёт миграция схемы)
+STORAGE_UNAVAILABLE_TEXT = "Бот временно недоступен: нет связи с базой данных. Попробуйте через минуту."
+# Команды, которым хранилище не нужно
+STORAGE_FREE_COMMANDS = ('/start', '/metrics')
+# Адрес для скачивания файлов, если в telebot не задан свой (FILE_URL)
+TELEGRAM_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+# Файлы скачиваются частями такого размера
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Как часто обновлять сообщение о ходе восстановления из бэкапа (в секундах)
+RESTORE_PROGRESS_SECONDS = 3
+# Сколько самых частых тегов показывать в /stats (все теги - в /tags)
+STATS_TAGS_LIMIT = 15
+# Владельцы репертуаров (музыканты): идентификатор -> name (ссылка на музыканта t.me/<бот>?start=<name>)
+# и admin_username. Без TENANTS в repertuar_env.py - один репертуар администратора TELEGRAM_ADMIN_USERNAME
+TENANTS = getattr(env, 'TENANTS', None) or {DEFAULT_OWNER_ID: dict(name='', admin_username=env.TELEGRAM_ADMIN_USERNAME)}
+MULTI_TENANT = len(TENANTS) > 1
+# Репертуар слушателей, не выбравших музыканта по ссылке
+DEFAULT_TENANT_ID = DEFAULT_OWNER_ID if DEFAULT_OWNER_ID in TENANTS else next(iter(TENANTS))
+ADMIN_OWNERS = {tenant['admin_username']: owner_id for owner_id, tenant in TENANTS.items()}
+OWNERS_BY_NAME = {tenant['name']: owner_id for owner_id, tenant in TENANTS.items() if tenant.get('name')}
+
+
+def create_logger():
+    # Создание директории для логов, если она еще не создана
+    log_dir = 'logs'
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    # Имя файла и путь к логам
+    log_file = os.path.join(log_dir, 'repertuar_bot.log')
+
+    # Создаем logger
+    logger = logging.getLogger('repertuar_bot')
+    logger.setLevel(getattr(env, 'LOG_LEVEL', logging.INFO))
+
+    # Создаем обработчик для ротации логов
+    handler = RotatingFileHandler(log_file, maxBytes=100000, backupCount=5)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+
+    # Добавляем обработчик к logger
+    logger.addHandler(handler)
+    return logger
+
+
+def create_storage(logger, lazy=True):
+    """Хранилище бота. При lazy=True оно создаётся в фоновом потоке (соединение с БД, миграции схемы),
+    и бот запускается, не дожидаясь БД; пока хранилище не готово, обработчики отвечают STORAGE_UNAVAILABLE_TEXT.
+    """
+    def create():
+        # Модуль хранилища импортируется только для выбранного сервера БД: драйверы остальных могут быть
+        # не установлены (см. requirements.txt)
+        backend = getattr(env, 'STORAGE_BACKEND', 'postgresql')
+        pool_params = getattr(env, 'STORAGE_POOL_PARAMS', None)
+        if backend == 'mysql':
+            from storage_manager.mysql_storage_manager import MysqlStorageManager
+            storage = MysqlStorageManager(logger, env.MYSQL_CONNECTOR_PARAMS, pool_params)
+        elif backend == 'sqlite':
+            from storage_manager.sqlite_storage_manager import SqliteStorageManager
+            storage = SqliteStorageManager(logger, env.SQLITE_CONNECTOR_PARAMS, pool_params)
+        else:
+            from storage_manager.postgresql_storage_manager import PostgresqlStorageManager
+            storage = PostgresqlStorageManager(logger, env.POSTGRESQL_CONNECTOR_PARAMS, pool_params)
+        # Хранилища владельцев репертуаров на общем пуле соединений, каждое - со своим кэшем
+        # для повторяющихся запросов (/stats, /tags, композиции по идентификатору) и замером времени вызовов
+        storage = TenantStorageManager(
+            storage, lambda owner_storage: InstrumentedStorageManager(
+                CachedStorageManager(owner_storage, **getattr(env, 'STORAGE_CACHE_PARAMS', {}))),
+            **getattr(env, 'TENANT_PARAMS', {}))
+        # Счётчики пула соединений и кэшей (см. metrics.py)
+        register_storage_metrics(storage)
+        return storage
+
+    if not lazy:
+        return create()
+    storage = LazyStorageManager(create, logger, **getattr(env, 'STORAGE_START_PARAMS', {}))
+    register_readiness_metrics(storage)
+    return storage
+
+
+def create_state_store(storage):
+    """Хранилище состояний многошаговых диалогов: в БД (по умолчанию) или в памяти процесса"""
+    params = dict(getattr(env, 'STATE_STORE_PARAMS', {}))
+    if params.pop('backend', 'database') == 'memory':
+        return MemoryStateStore(**params)
+    if (getattr(env, 'WEBHOOK_PARAMS', None) or {}).get('processes', 1) > 1:
+        # Диалог может начаться в одном процессе, а продолжиться в другом: отсутствие диалога не запоминается,
+        # иначе следующий шаг, попавший в другой процесс, был бы принят за обычное сообщение
+        params.setdefault('absent_ttl', 0)
+    return DatabaseStateStore(storage, **params)
+
+
+def needs_storage(message):
+    """Нужно ли хранилище для ответа на сообщение"""
+    words = (message.text or '').split(maxsplit=1)
+    if not words:
+        return True
+    command = words[0].split('@')[0]
+    # "/start <музыкант>" (ссылка на музыканта) сохраняет выбор слушателя в БД
+    return command not in STORAGE_FREE_COMMANDS or (command == '/start' and len(words) > 1)
+
+
+def admin_owner(update):
+    """Владелец репертуара, администратор которого прислал сообщение или нажал кнопку (None - не администратор)"""
+    return ADMIN_OWNERS.get(update.from_user.username)
+
+
+def is_admin(update):
+    return admin_owner(update) is not None
+
+
+def update_chat_id(update):
+    """Чат сообщения или сообщения с нажатой кнопкой"""
+    return (update.message if isinstance(update, types.CallbackQuery) else update).chat.id
+
+
+def command_argument(text):
+    """Аргумент команды: "/tag ретро" => "ретро" (None, если аргумента нет)"""
+    args = (text or '').split(maxsplit=1)
+    return args[1] if len(args) > 1 else None
+
+
+def owner_by_name(name):
+    """Владелец репертуара по имени из ссылки на музыканта (None, если такого нет)"""
+    return OWNERS_BY_NAME.get(name.strip())
+
+
+def admin_menu_markup():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    btn1 = types.KeyboardButton('/random')
+    btn2 = types.KeyboardButton('/random20')
+    btn3 = types.KeyboardButton('/stats')
+    btn4 = types.KeyboardButton('/add')
+    btn5 = types.KeyboardButton('/addcsv')
+    btn6 = types.KeyboardButton('/backup')
+    btn7 = types.KeyboardButton('/tags')
+    btn8 = types.KeyboardButton('/requests')
+    btn9 = types.KeyboardButton('/metrics')
+    btn10 = types.KeyboardButton('/restore')
+    markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn10, btn7, btn8, btn9)
+    return markup
+
+
+def client_menu_markup():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    btn1 = types.KeyboardButton('Случайная композиция')
+    btn2 = types.KeyboardButton('Заказать композицию')
+    btn3 = types.KeyboardButton('Написать отзыв')
+    btn4 = types.KeyboardButton('Поддержать музыканта')
+    markup.add(btn1, btn2, btn3, btn4)
+    return markup
+
+
+def order_markup():
+    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
+    itembtn = types.KeyboardButton('Назад')
+    markup.add(itembtn)
+    return markup
+
+
+def format_tags(tags):
+    # "80е,советские,ретро" => "#80е #советские #ретро"
+    return " ".join(["#" + tag.strip().replace(" ", "_") for tag in (tags or "").split(',') if tag.strip()])
+
+
+def format_song(song):
+    return f"{song.artist} - {song.title}\n{format_tags(song.tags)}"
+
+
+def format_song_list(songs, with_tags=False, start=1):
+    return "\n".join(f"{number}. {song.artist} - {song.title} {format_tags(song.tags) if with_tags else ''}".rstrip()
+                     for number, song in enumerate(songs, start=start))
+
+
+# Клавиатуры оценок повторяются (одна и та же композиция, одна и та же оценка) - строим их один раз
+@functools.lru_cache(maxsize=1024)
+def rating_markup(song_id, mark, with_edit=True):
+    markup = types.InlineKeyboardMarkup(row_width=7)
+    buttons = [types.InlineKeyboardButton(i_mark + ("✔️" if i_mark == str(mark) else ""),
+                                          callback_data=f"update_rating_{song_id}_{i_mark}")
+               for i_mark in "012345"]
+    if with_edit:
+        buttons.append(types.InlineKeyboardButton("✍️", callback_data=f"edit_{song_id}"))
+    markup.add(*buttons)
+    return markup
+
+
+def marked_rating(markup):
+    """Оценка, отмеченная ✔️ в клавиатуре оценок сообщения (None, если не отмечена)"""
+    for row in (markup.keyboard if markup is not None else []):
+        for button in row:
+            if button.text.endswith("✔️") and button.text[0].isdigit():
+                return int(button.text[0])
+
+
+def format_stats(stats):
+    """Текст ответа на /stats по RepertuarStats"""
+    lines = [f"У вас {stats.total} музыкальных композиций в репертуаре"]
+    if stats.marks:
+        lines.append("Оценки: " + ", ".join(f"{mark or 'без оценки'} - {songs}" for mark, songs in stats.marks))
+    if stats.tags:
+        more = f" и ещё {len(stats.tags) - STATS_TAGS_LIMIT}" if len(stats.tags) > STATS_TAGS_LIMIT else ""
+        lines.append("Теги: " + ", ".join(f"{name} ({songs})" for name, songs in stats.tags[:STATS_TAGS_LIMIT])
+                     + more)
+    if stats.recent:
+        lines.append("Недавно добавленные и оценённые:\n" + format_song_list(stats.recent))
+    return "\n".join(lines)[:MESSAGE_LIMIT]
+
+
+def format_tag_counts(tag_counts):
+    return "Список всех тегов: " + ", ".join(f"{name} ({count})" for name, count in tag_counts)
+
+
+def format_tag_songs(tag, songs):
+    """Ответ на "/tag ретро" по найденным композициям"""
+    return format_song_list(songs) if songs else f"Нет композиций с тегом {tag}"
+
+
+def random_song_reply(song, tag, admin):
+    """Текст и клавиатура ответа со случайной композицией (tag - тег из запроса или None);
+    администратору - с кнопками оценки"""
+    if song is None:
+        return ("Нет композиций в базе данных" if tag is None else f"Нет композиций с тегом {tag}"), None
+    return format_song(song), (rating_markup(song.id, song.mark) if admin else None)
+
+
+def format_random_songs(songs):
+    return format_song_list(songs, with_tags=True) if songs else "Нет композиций в базе данных"
+
+
+def format_add_result(title, result):
+    """Ответ на добавление композиции по коду результата StorageManager.add_song"""
+    if result == 0:
+        return f"Музыкальное произведение '{title}' успешно добавлено!"
+    if result == 1:
+        return f"Музыкальное произведение '{title}' уже есть в БД"
+    return "Ошибка при добавлении"
+
+
+def parse_csv_rows(text):
+    """Строки CSV из сообщения или файла /addcsv - списки полей для add_songs_bulk"""
+    return [re.split(";", line) for line in text.split("\n")]
+
+
+def parse_callback(data, admin):
+    """Действие по данным нажатой кнопки: ('update_rating', song_id, mark), ('search', offset),
+    ('requests', offset), ('request_done', request_id, offset) или None. Оценки и заказы - только
+    для администратора"""
+    if data.startswith("update_rating_") and admin:
+        song_id, mark = data[len("update_rating_"):].split("_")
+        return 'update_rating', int(song_id), int(mark)
+    if data.startswith("search_"):
+        return 'search', int(data[len("search_"):])
+    if data.startswith("requests_") and admin:
+        return 'requests', int(data[len("requests_"):])
+    if data.startswith("request_done_") and admin:
+        request_id, offset = data[len("request_done_"):].split("_")
+        return 'request_done', int(request_id), int(offset)
+    return None
+
+
+def format_csv_result(result):
+    """Текст отчёта о загрузке CSV по BulkInsertResult"""
+    count_success, count_duplicates, count_dberror, count_error, count_skipped = \
+        result.success, result.duplicates, result.db_errors, result.errors, result.skipped
+
+    if count_duplicates == 0 and count_dberror == 0 and count_error == 0 and count_skipped == 0:
+        result_text = f"Музыкальные композиции успешно добавлены ({count_success} шт)"
+    elif count_success > 0:
+        result_text = f"Музыкальные композиции успешно добавлены ({count_success} шт)\n" \
+                      f"Дубликатов - {count_duplicates} шт\n" \
+                      f"Ошибок с БД - {count_dberror} шт\n" \
+                      f"Прочих ошибок - {count_error} шт\n" \
+                      f"Пропущено - {count_skipped} шт"
+    else:
+        result_text = f"Музыкальные композиции не были добавлены:\n" \
+                      f"Дубликатов - {count_duplicates} шт\n" \
+                      f"Ошибок с БД - {count_dberror} шт\n" \
+                      f"Прочих ошибок - {count_error} шт\n" \
+                      f"Пропущено - {count_skipped} шт"
+    return result_text
+
+
+def parse_backup_command(text):
+    """Вид бэкапа и сжатие по тексту команды: "/backup [inc|diff] [gz]" """
+    args = text.split()[1:]
+    kind = next((BACKUP_KINDS[arg] for arg in args if arg in BACKUP_KINDS), BACKUP_FULL)
+    return kind, 'gz' in args
+
+
+def backup_file_name(kind, compress):
+    """Имя файла бэкапа: при сортировке по имени бэкапы идут в порядке восстановления"""
+    return f"backup_repertuar_{datetime.now():%Y%m%d_%H%M%S}_{kind}.csv" + ('.gz' if compress else '')
+
+
+def format_restore_progress(result=None, done=False):
+    """Текст сообщения о ходе восстановления из бэкапа"""
+    if result is None:
+        return "Восстановление из бэкапа: загрузка файла..."
+    return f"Восстановление из бэкапа {'завершено' if done else 'идёт'}: обработано строк - {result.total}"
+
+
+def throttled(function, interval=RESTORE_PROGRESS_SECONDS):
+    """Обёртка, вызывающая function не чаще раза в interval секунд (остальные вызовы пропускаются)"""
+    called_at = time.monotonic()
+
+    def wrapper(*args):
+        nonlocal called_at
+        if time.monotonic() - called_at >= interval:
+            called_at = time.monotonic()
+            function(*args)
+    return wrapper
+
+
+def search_page(query, offset, songs):
+    """Текст и клавиатура одной страницы результатов поиска по SEARCH_PAGE_SIZE + 1 найденным композициям.
+    Запрос хранится в первой строке сообщения, поэтому листание не требует состояния на стороне бота.
+    """
+    has_next = len(songs) > SEARCH_PAGE_SIZE
+    songs = songs[:SEARCH_PAGE_SIZE]
+    if not songs:
+        return f"{SEARCH_HEADER}{query}\nНичего не найдено", None
+    buttons = []
+    if offset > 0:
+        buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"search_{max(offset - SEARCH_PAGE_SIZE, 0)}"))
+    if has_next:
+        buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"search_{offset + SEARCH_PAGE_SIZE}"))
+    markup = None
+    if buttons:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(*buttons)
+    return f"{SEARCH_HEADER}{query}\n" + format_song_list(songs, start=offset + 1), markup
+
+
+def search_query_from_message(message):
+    return message.text.split("\n", 1)[0][len(SEARCH_HEADER):]
+
+
+def format_order(similar_songs):
+    """Ответ заказчику: заявка принята, плюс похожие композиции из репертуара"""
+    similar = "\n".join(f"{song.artist} - {song.title}" for song in similar_songs)
+    return "Заявка отправлена" + (f"\nПохожие композиции в репертуаре:\n{similar}" if similar else "")
+
+
+def format_username(username):
+    return f"@{username}" if username else "без имени"
+
+
+def format_request_digest(requests):
+    """Сводка заказов для администратора: одинаковые композиции объединяются, частые заказы - выше"""
+    groups = {}
+    for request in requests:
+        key = " ".join(request.composition.lower().split())
+        groups.setdefault(key, (request.composition, []))[1].append(format_username(request.username))
+    lines = [f"Новые заказы композиций ({len(requests)}):"]
+    for composition, usernames in sorted(groups.values(), key=lambda group: -len(group[1])):
+        count = f" ×{len(usernames)}" if len(usernames) > 1 else ""
+        lines.append(f"{composition}{count} - {', '.join(dict.fromkeys(usernames))}")
+    return "\n".join(lines)[:MESSAGE_LIMIT]
+
+
+def requests_page(offset, requests):
+    """Текст и клавиатура страницы невыполненных заказов по REQUESTS_PAGE_SIZE + 1 заказам.
+    Кнопки с номерами отмечают заказ выполненным и перерисовывают ту же страницу.
+    """
+    has_next = len(requests) > REQUESTS_PAGE_SIZE
+    requests = requests[:REQUESTS_PAGE_SIZE]
+    if not requests:
+        return "Невыполненных заказов нет", None
+    lines = [f"{number}. {request.composition} - {format_username(request.username)}, "
+             f"{request.created_at:%d.%m %H:%M}"
+             for number, request in enumerate(requests, start=offset + 1)]
+    markup = types.InlineKeyboardMarkup(row_width=5)
+    markup.add(*[types.InlineKeyboardButton(f"✅{number}", callback_data=f"request_done_{request.id}_{offset}")
+                 for number, request in enumerate(requests, start=offset + 1)])
+    buttons = []
+    if offset > 0:
+        buttons.append(types.InlineKeyboardButton("◀️",
+                                                  callback_data=f"requests_{max(offset - REQUESTS_PAGE_SIZE, 0)}"))
+    if has_next:
+        buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"requests_{offset + REQUESTS_PAGE_SIZE}"))
+    if buttons:
+        markup.row(*buttons)
+    return "Невыполненные заказы (✅ - отметить выполненным):\n" + "\n".join(lines), markup
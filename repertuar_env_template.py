@@ -2,6 +2,9 @@ TELEGRAM_BOT_TOKEN = "my_telegram_bot_token"
 
 TELEGRAM_ADMIN_USERNAME = "viktor_krasikov"
 
+# Сервер БД: "postgresql" (по умолчанию), "mysql" или "sqlite" - параметры соединения ниже
+STORAGE_BACKEND = "postgresql"
+
 MYSQL_CONNECTOR_PARAMS = dict(
     host="viktorkrasikov.mysql.pythonanywhere-services.com",
     # host="localhost",
@@ -17,3 +20,119 @@ POSTGRESQL_CONNECTOR_PARAMS = dict(
     database="repertuar",
     password="123456"
 )
+
+# Файл БД SQLite (без отдельного сервера БД, для запуска на одном сервере)
+SQLITE_CONNECTOR_PARAMS = dict(
+    database="repertuar.sqlite3"
+)
+
+
+# Пул соединений с БД: минимальное и максимальное количество соединений,
+# время ожидания свободного соединения (в секундах),
+# простой соединения (в секундах), после которого оно проверяется запросом SELECT 1
+STORAGE_POOL_PARAMS = dict(
+    min_size=1,
+    max_size=10,
+    timeout=30,
+    probe_idle_seconds=60
+)
+
+# Кэш хранилища: максимальное количество записей и время жизни записи (в секундах)
+STORAGE_CACHE_PARAMS = dict(
+    maxsize=1000,
+    ttl=300
+)
+
+# Несколько музыкантов в одном боте (раскомментируйте, чтобы включить): id владельца репертуара ->
+# name - имя в ссылке для слушателей t.me/<бот>?start=<name>, admin_username - администратор репертуара.
+# Слушатели без ссылки попадают в репертуар владельца 0 (если его нет в TENANTS - первого из перечисленных)
+# TENANTS = {
+#     0: dict(name="viktor", admin_username="viktor_krasikov"),
+#     1: dict(name="anna", admin_username="anna_guitar")
+# }
+
+# Хранилища владельцев в памяти процесса: не более max_owners (давно не использовавшиеся вытесняются вместе
+# с кэшем), выбор музыканта чатом слушателя кэшируется (chat_owner_cache_size записей на chat_owner_ttl секунд)
+# TENANT_PARAMS = dict(
+#     max_owners=100,
+#     chat_owner_cache_size=10000,
+#     chat_owner_ttl=300
+# )
+
+# Хранилище создаётся в фоне, бот запускается не дожидаясь БД. Если БД недоступна, попытки повторяются:
+# первая пауза retry_seconds, затем вдвое больше, но не больше max_retry_seconds
+# STORAGE_START_PARAMS = dict(
+#     retry_seconds=1,
+#     max_retry_seconds=30
+# )
+
+# Режим webhook вместо long polling (раскомментируйте, чтобы включить):
+# url - публичный адрес, на который Telegram присылает обновления (должен вести на host:port/path)
+# secret_token - строка из символов A-Z, a-z, 0-9, _ и -, которую Telegram передаёт в каждом запросе
+# queue_size - размер очереди обновлений (при переполнении Telegram повторит доставку позже)
+# workers - количество одновременно обрабатываемых обновлений в процессе
+# processes - количество процессов на одном порту
+# WEBHOOK_PARAMS = dict(
+#     url="https://example.com/repertuar",
+#     host="0.0.0.0",
+#     port=8443,
+#     path="/repertuar",
+#     secret_token="my_webhook_secret",
+#     queue_size=1000,
+#     workers=16,
+#     processes=1
+# )
+
+# Адрес Bot API, например локального имитатора Telegram из tools/fake_telegram.py
+# TELEGRAM_API_URL = "http://127.0.0.1:8081/bot{0}/{1}"
+
+# Состояния многошаговых диалогов (/add, /addcsv, заказ композиции):
+# backend - "database" (таблица chat_states: переживают перезапуск, общие для всех процессов) или "memory",
+# ttl - через сколько секунд брошенный диалог забывается,
+# absent_ttl - сколько секунд процесс помнит, что у чата нет диалога, не спрашивая БД
+# (по умолчанию 60; с WEBHOOK_PARAMS processes > 1 - 0, то есть БД спрашивается всегда: иначе диалог,
+# начатый другим процессом, был бы виден с такой задержкой)
+STATE_STORE_PARAMS = dict(
+    backend="database",
+    ttl=3600
+)
+
+# Сводки заказов композиций администратору: раз в interval секунд, не более limit заказов в одной сводке.
+# Сводка уходит в чат, из которого администратор владельца последний раз выполнил /start; пока такого чата нет,
+# заказы копятся в БД, а в журнал один раз пишется предупреждение
+REQUEST_DIGEST_PARAMS = dict(
+    interval=300,
+    limit=50
+)
+
+# Пересчёт сводных таблиц статистики (/stats) раз в interval секунд - если композиции меняются
+# и в обход бота (раскомментируйте, чтобы включить)
+# STATS_REFRESH_PARAMS = dict(
+#     interval=24 * 60 * 60
+# )
+
+# Лимиты отправки сообщений (в секунду): всего, в один чат, в одну группу; burst - сколько сообщений подряд
+# можно отправить без ожидания
+TELEGRAM_RATE_LIMITS = dict(
+    global_rate=30,
+    chat_rate=1,
+    chat_burst=3,
+    group_rate=20 / 60,
+    group_burst=5
+)
+
+# Отложенная запись оценок: оценка записывается, когда её не меняли delay секунд,
+# не более max_batch оценок в одной транзакции
+RATING_WRITER_PARAMS = dict(
+    delay=2,
+    max_batch=100
+)
+
+# Уровень журнала (logging.DEBUG - в том числе выборочные строки массовой загрузки CSV)
+# LOG_LEVEL = "DEBUG"
+
+# HTTP-сервер с метриками в формате Prometheus (раскомментируйте, чтобы включить)
+# METRICS_PARAMS = dict(
+#     host="127.0.0.1",
+#     port=9100
+# )
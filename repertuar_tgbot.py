@@ -1,162 +1,224 @@
-import logging
-import os
-import re
-from logging.handlers import RotatingFileHandler
+import asyncio
+import io
+import tempfile
+import threading
+import time
 
+import requests
 import telebot
-from telebot import types
+from telebot import apihelper
+from telebot.custom_filters import SimpleCustomFilter
 
 import repertuar_env as env
-## Закомментируйте ненужный импорт, оставьте нужный
-# from storage_manager.mysql_storage_manager import MysqlStorageManager
-from storage_manager.postgresql_storage_manager import PostgresqlStorageManager
+from metrics import REGISTRY, instrument_handlers, register_sender_metrics, start_http_server
+from repertuar_common import ADD_CSV_TEXT, DEFAULT_TENANT_ID, DOWNLOAD_CHUNK_SIZE, MULTI_TENANT, ORDER_TEXT, \
+    RANDOM_SONGS_COUNT, REQUESTS_PAGE_SIZE, RESTORE_TEXT, SEARCH_PAGE_SIZE, STORAGE_UNAVAILABLE_TEXT, \
+    TELEGRAM_FILE_URL, TENANTS, admin_menu_markup, admin_owner, backup_file_name, client_menu_markup, \
+    command_argument, create_logger, create_state_store, create_storage, format_add_result, format_csv_result, \
+    format_order, format_random_songs, format_request_digest, format_restore_progress, format_stats, \
+    format_tag_counts, format_tag_songs, is_admin, marked_rating, needs_storage, order_markup, owner_by_name, \
+    parse_backup_command, parse_callback, parse_csv_rows, random_song_reply, rating_markup, requests_page, \
+    search_page, search_query_from_message, throttled, update_chat_id
+from storage_manager import BACKUP_SPOOL_SIZE
+from storage_manager.rating_writer import RatingWriter
+from telegram_sender import PRIORITY_LOW, RateLimitedBot, RateLimiter
+from webhook_server import run_webhook
+
+logger = create_logger()
 
-# Создание директории для логов, если она еще не создана
-log_dir = 'logs'
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
+# Пример логирования
+logger.info('Repertuar bot started')
 
-# Имя файла и путь к логам
-log_file = os.path.join(log_dir, 'repertuar_bot.log')
+# Хранилище создаётся в фоне: бот начинает принимать сообщения, не дожидаясь БД
+storage = create_storage(logger)
+# Оценки записываются в БД отложенно и пачками
+ratings = RatingWriter(storage, **getattr(env, 'RATING_WRITER_PARAMS', {}))
 
-# Создаем logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+# Инициализация бота
+if getattr(env, 'TELEGRAM_API_URL', None):
+    apihelper.API_URL = env.TELEGRAM_API_URL
+# Отправка сообщений - с учётом лимитов Telegram (см. telegram_sender.py)
+bot = RateLimitedBot(telebot.TeleBot(env.TELEGRAM_BOT_TOKEN),
+                     RateLimiter(**getattr(env, 'TELEGRAM_RATE_LIMITS', {})), logger=logger)
 
-# Создаем обработчик для ротации логов
-handler = RotatingFileHandler(log_file, maxBytes=100000, backupCount=5)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
+# Многошаговые диалоги (/add, /addcsv, заказ композиции): в хранилище состояний сохраняется имя
+# следующего шага и его аргументы, поэтому диалог переживает перезапуск и продолжается любым процессом бота
+states = create_state_store(storage)
+dialog_steps = {}
 
-# Добавляем обработчик к logger
-logger.addHandler(handler)
 
-# Пример логирования
-logger.info('Repertuar bot started')
+def dialog_step(function):
+    """Регистрация функции как шага диалога (по имени)"""
+    dialog_steps[function.__name__] = function
+    return function
 
-## Оставьте нужный тип сервера, ненужный - закомментируйте
-# storage = MysqlStorageManager(logger, env.MYSQL_CONNECTOR_PARAMS)
-storage = PostgresqlStorageManager(logger, env.POSTGRESQL_CONNECTOR_PARAMS)
 
-# Инициализация бота
-bot = telebot.TeleBot(env.TELEGRAM_BOT_TOKEN)
-telegram_admin_chat_id = None
+def register_next_step(message, step, *args):
+    states.set(message.chat.id, step.__name__, args)
+
+
+class PendingStepFilter(SimpleCustomFilter):
+    """Сообщение, которого ждёт диалог чата; найденное состояние сохраняется в message.pending_step"""
+    key = 'pending_step'
+
+    def check(self, message):
+        message.pending_step = states.get(message.chat.id)
+        return message.pending_step is not None
+
+
+bot.add_custom_filter(PendingStepFilter())
+
+
+# Пока хранилище запускается (см. create_storage), вместо обработчиков, которым нужна БД, отвечаем,
+# что бот временно недоступен. Регистрируется раньше всех, поэтому до готовности хранилища остальные не вызываются
+@bot.message_handler(content_types=['text', 'document'],
+                     func=lambda message: not storage.ready and needs_storage(message))
+def storage_unavailable(message):
+    bot.send_message(message.chat.id, STORAGE_UNAVAILABLE_TEXT)
+
+
+@bot.callback_query_handler(func=lambda call: not storage.ready)
+def storage_unavailable_callback(call):
+    bot.answer_callback_query(call.id, STORAGE_UNAVAILABLE_TEXT)
+
+
+# Следующий после проверки готовности, чтобы ответ в многошаговом диалоге не перехватили другие обработчики
+@bot.message_handler(content_types=['text', 'document'], pending_step=True)
+def next_step(message):
+    step, args = message.pending_step
+    states.delete(message.chat.id)
+    if step not in dialog_steps:
+        logger.warning(f"Неизвестный шаг диалога {step}")
+        return
+    dialog_steps[step](message, *args)
+
+
+def owner_of(update):
+    """Владелец репертуара, с которым работает отправитель: свой - у администратора,
+    выбранный по ссылке на музыканта - у слушателя"""
+    owner_id = admin_owner(update)
+    if owner_id is None and MULTI_TENANT:
+        owner_id = storage.get_chat_owner(update_chat_id(update))
+    return DEFAULT_TENANT_ID if owner_id is None else owner_id
+
+
+def storage_of(update):
+    """Хранилище репертуара владельца, с которым работает отправитель"""
+    return storage.for_owner(owner_of(update))
 
 
 def send_admin_menu(chat_id):
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    btn1 = types.KeyboardButton('/random')
-    btn2 = types.KeyboardButton('/random20')
-    btn3 = types.KeyboardButton('/stats')
-    btn4 = types.KeyboardButton('/add')
-    btn5 = types.KeyboardButton('/addcsv')
-    btn6 = types.KeyboardButton('/backup')
-    btn7 = types.KeyboardButton('/tags')
-    markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-    bot.send_message(chat_id, "Выберите пункт меню", reply_markup=markup)
+    bot.send_message(chat_id, "Выберите пункт меню", reply_markup=admin_menu_markup())
 
 
 def send_client_menu(chat_id):
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    btn1 = types.KeyboardButton('Случайная композиция')
-    btn2 = types.KeyboardButton('Заказать композицию')
-    btn3 = types.KeyboardButton('Написать отзыв')
-    btn4 = types.KeyboardButton('Поддержать музыканта')
-    markup.add(btn1, btn2, btn3, btn4)
-    bot.send_message(chat_id, "Выберите пункт меню", reply_markup=markup)
+    bot.send_message(chat_id, "Выберите пункт меню", reply_markup=client_menu_markup())
 
 
 @bot.message_handler(commands=['start'])
 def start(message):
-    if message.from_user.username == env.TELEGRAM_ADMIN_USERNAME:
-        global telegram_admin_chat_id
-        if telegram_admin_chat_id is None:
-            telegram_admin_chat_id = message.chat.id
+    owner_id = admin_owner(message)
+    if owner_id is not None:
         send_admin_menu(message.chat.id)
+        # Чат администратора - для сводок заказов (см. send_request_digest). /start отвечает и без БД,
+        # тогда чат запомнится при следующем /start
+        if storage.ready:
+            storage.for_owner(owner_id).set_admin_chat(message.chat.id)
     else:
+        # "/start <музыкант>" - слушатель пришёл по ссылке на музыканта (t.me/<бот>?start=<музыкант>)
+        name = command_argument(message.text)
+        owner_id = owner_by_name(name) if name else None
+        if owner_id is not None:
+            storage.set_chat_owner(message.chat.id, owner_id)
         bot.send_message(message.chat.id, "Добро пожаловать!")
         send_client_menu(message.chat.id)
 
 
 @bot.message_handler(commands=['stats'])
 def stats(message):
-    if message.from_user.username == env.TELEGRAM_ADMIN_USERNAME:
-        count = storage.get_songs_count()
-        bot.send_message(message.chat.id, f"У вас {count} музыкальных композиций в репертуаре")
+    if is_admin(message):
+        # Одно чтение сводных таблиц вместо подсчёта по всему репертуару
+        bot.send_message(message.chat.id, format_stats(storage_of(message).get_stats()))
     else:
         bot.send_message(message.chat.id, "У вас нет доступа к этой команде")
 
 
 @bot.message_handler(commands=['tags'])
 def tags(message):
-    tag_list = storage.get_tags()
-    bot.send_message(message.chat.id, f"Список всех тегов: {tag_list}")
+    bot.send_message(message.chat.id, format_tag_counts(storage_of(message).get_tag_counts()))
+
+
+# Команда "/tag ретро" - список композиций с тегом
+@bot.message_handler(commands=['tag'])
+def songs_by_tag(message):
+    tag = command_argument(message.text)
+    if tag is None:
+        bot.send_message(message.chat.id, "Укажите тег: /tag ретро")
+        return
+    bot.send_message(message.chat.id, format_tag_songs(tag, storage_of(message).get_songs_by_tag(tag)))
 
 
 # Команда /add для добавления музыкального произведения
 @bot.message_handler(commands=['add'])
 def add_music(message):
-    if message.from_user.username == env.TELEGRAM_ADMIN_USERNAME:
+    if is_admin(message):
         bot.send_message(message.chat.id, "Введите название музыкального произведения:")
-        bot.register_next_step_handler(message, add_artist)
+        register_next_step(message, add_artist)
     else:
         bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
 
 
+@dialog_step
 def add_artist(message):
     title = message.text
     bot.send_message(message.chat.id, "Введите исполнителя:")
-    bot.register_next_step_handler(message, add_tags, title)
+    register_next_step(message, add_tags, title)
 
 
+@dialog_step
 def add_tags(message, title):
     artist = message.text
     bot.send_message(message.chat.id, "Введите теги через запятую:")
-    bot.register_next_step_handler(message, add_mark, title, artist)
+    register_next_step(message, add_mark, title, artist)
 
 
+@dialog_step
 def add_mark(message, title, artist):
     tags = message.text
     bot.send_message(message.chat.id, "Введите оценку от 0 до 5:")
-    bot.register_next_step_handler(message, add_to_database, title, artist, tags)
+    register_next_step(message, add_to_database, title, artist, tags)
 
 
+@dialog_step
 def add_to_database(message, title, artist, tags):
     mark = int(message.text)
-    result = storage.add_song(title, artist, tags, mark)
-    if result == 0:
-        bot.send_message(message.chat.id, f"Музыкальное произведение '{title}' успешно добавлено!")
-    elif result == 1:
-        bot.send_message(message.chat.id, f"Музыкальное произведение '{title}' уже есть в БД")
-    else:
-        bot.send_message(message.chat.id, f"Ошибка при добавлении")
+    result = storage_of(message).add_song(title, artist, tags, mark)
+    bot.send_message(message.chat.id, format_add_result(title, result))
 
 
 # Команда /addcsv для добавления нескольких музыкальных произведений из CSV
 @bot.message_handler(commands=['addcsv'])
 def add_csv(message):
-    if message.from_user.username == env.TELEGRAM_ADMIN_USERNAME:
-        bot.send_message(message.chat.id, "Вставьте список мулькальных композиций в формате CSV:\n"
-                                          "Название;Исполнитель;Тэги через запятую (не обязательно);"
-                                          "Оценка от 0 до 5 (не обязательно)\n\n"
-                                          "Или отправьте CSV-файл с вышеописанным содержимым.")
-        bot.register_next_step_handler(message, process_csv_input)  # Регистрируем следующий шаг обработки
+    if is_admin(message):
+        bot.send_message(message.chat.id, ADD_CSV_TEXT)
+        register_next_step(message, process_csv_input)
     else:
         bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
 
 
+@dialog_step
 def process_csv_input(message):
     """Процесс обработки входного текста или файла"""
-    if message.from_user.username == env.TELEGRAM_ADMIN_USERNAME:
+    if is_admin(message):
         if message.content_type in ['text', 'document']:
             if message.content_type == 'text':
-                music_data = message.text.split("\n")
+                rows = parse_csv_rows(message.text)
             elif message.content_type == 'document':
                 # Получаем файл
                 file_info = bot.get_file(message.document.file_id)
-                music_data = bot.download_file(file_info.file_path).decode('utf-8').split("\n")
-            result_as_text = insert_csv_data(music_data)
-            bot.send_message(message.chat.id, result_as_text)
+                rows = parse_csv_rows(bot.download_file(file_info.file_path).decode('utf-8'))
+            logger.info("Получено CSV-сообщение с " + str(len(rows)) + " композиций")
+            bot.send_message(message.chat.id, format_csv_result(storage_of(message).add_songs_bulk(rows)))
         else:
             bot.send_message(chat_id=message.chat.id,
                              text="Неподдерживаемый тип сообщения. Пожалуйста, отправьте текст или CSV-файл.")
@@ -164,133 +226,277 @@ def process_csv_input(message):
         bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
 
 
-def insert_csv_data(music_data):
-    logger.info("Получено CSV-сообщение с " + str(len(music_data)) + " композиций")
-    count_success, count_duplicates, count_dberror, count_error, count_skipped = 0, 0, 0, 0, 0
-    for data in music_data:
-        row = re.split(";", data)
-        if 2 <= len(row) <= 4:
-            title, artist = row[0], row[1]
-            tags = row[2] if len(row) > 2 else ""
-            mark = row[3] if len(row) > 3 else 0
-            logger.info(f"Добавляется: {artist}, {title}, {tags}, {mark}")
-            result = storage.add_song(title, artist, tags, mark)
-            if result == 0:
-                count_success += 1
-            elif result == 1:
-                count_duplicates += 1
-            elif result == 2:
-                count_dberror += 1
-            else:
-                count_error += 1
-        else:
-            count_skipped += 1
-
-    if count_duplicates == 0 and count_dberror == 0 and count_error == 0 and count_skipped == 0:
-        result_text = f"Музыкальные композиции успешно добавлены ({count_success} шт)"
-    elif count_success > 0:
-        result_text = f"Музыкальные композиции успешно добавлены ({count_success} шт)\n" \
-                      f"Дубликатов - {count_duplicates} шт\n" \
-                      f"Ошибок с БД - {count_dberror} шт\n" \
-                      f"Прочих ошибок - {count_error} шт\n" \
-                      f"Пропущено - {count_skipped} шт"
-    else:
-        result_text = f"Музыкальные композиции не были добавлены:\n" \
-                      f"Дубликатов - {count_duplicates} шт\n" \
-                      f"Ошибок с БД - {count_dberror} шт\n" \
-                      f"Прочих ошибок - {count_error} шт\n" \
-                      f"Пропущено - {count_skipped} шт"
-    return result_text
-
-
 # Команда /random для получения случайного музыкального произведения
+# ("/random ретро" - случайное произведение с тегом "ретро")
 @bot.message_handler(commands=['random'])
 def random_music(message):
-    song = storage.get_random_song()
-    if song is None:
-        bot.send_message(message.chat.id, "Нет композиций в базе данных")
-        return
+    send_random_song(message, command_argument(message.text))
+
+
+# Сообщение "#ретро" - случайное музыкальное произведение с этим тегом
+@bot.message_handler(func=lambda message: message.text is not None and message.text.startswith('#'))
+def random_music_by_tag(message):
+    send_random_song(message, message.text.split()[0])
 
-    # "80е,советские,ретро" => "#80е #советские #ретро"
-    tags_list = " ".join(["#" + tag.strip().replace(" ", "_") for tag in song.tags.split(',') if tag])
 
-    if message.from_user.username == env.TELEGRAM_ADMIN_USERNAME:
-        markup = types.InlineKeyboardMarkup(row_width=7)
-        buttons = [types.InlineKeyboardButton(i_mark + ("✔️" if i_mark == str(song.mark) else ""),
-                                              callback_data=f"update_rating_{song.id}_{i_mark}")
-                   for i_mark in "012345"]
-        buttons.append(types.InlineKeyboardButton("✍️", callback_data=f"edit_{song.id}"))
-        markup.add(*buttons)
+def send_random_song(message, tag=None):
+    text, markup = random_song_reply(storage_of(message).get_random_song(tag), tag, is_admin(message))
+    bot.send_message(message.chat.id, text, reply_markup=markup)
 
-        bot.send_message(message.chat.id, f"{song.artist} - {song.title}\n{tags_list}",
-                         reply_markup=markup)
-    #        bot.register_next_step_handler(message, update_rating, result[0])
+
+# Команда /random20 - 20 случайных композиций одним сообщением
+@bot.message_handler(commands=['random20'])
+def random20_music(message):
+    if is_admin(message):
+        bot.send_message(message.chat.id, format_random_songs(storage_of(message).get_random_songs(RANDOM_SONGS_COUNT)))
     else:
-        bot.send_message(message.chat.id, f"{song.artist} - {song.title}\n{tags_list}")
+        bot.send_message(message.chat.id, "У вас нет доступа к этой команде")
 
 
-def update_rating(message, repertuar_id, mark):
-    try:
-        rows_updated = storage.update_rating(repertuar_id, mark)
-
-        if rows_updated == 1:
-            markup = types.InlineKeyboardMarkup(row_width=7)
-            buttons = [types.InlineKeyboardButton(i_mark + ("✔️" if i_mark == str(mark) else ""),
-                                                  callback_data=f"update_rating_{repertuar_id}_{i_mark}")
-                       for i_mark in "012345"]
-            markup.add(*buttons)
-            bot.edit_message_reply_markup(message.chat.id, message.id, reply_markup=markup)
-        else:
-            bot.send_message(message.chat.id, "Композиция не найдена в базе данных")
-    except Exception as e:
-        logger.error(e)
-        bot.send_message(message.chat.id, "Не удалось сохранить оценку, смотрите логи")
+def update_rating(message, song_id, mark, owner_id):
+    # Повторное нажатие на уже отмеченную оценку ничего не меняет
+    if marked_rating(message.reply_markup) == mark:
+        return
+    # Оценка записывается в БД позже (RatingWriter), поэтому композиция проверяется заранее (обычно - по кэшу)
+    if storage.for_owner(owner_id).get_song(song_id) is None:
+        bot.send_message(message.chat.id, "Композиция не найдена в базе данных")
+        return
+    ratings.set(song_id, mark, owner_id)
+    bot.edit_message_reply_markup(message.chat.id, message.id,
+                                   reply_markup=rating_markup(song_id, mark, with_edit=False))
+
+
+# Команда "/search кино" - поиск по названию и исполнителю
+@bot.message_handler(commands=['search'])
+def search(message):
+    query = command_argument(message.text)
+    if query is None:
+        bot.send_message(message.chat.id, "Укажите, что искать: /search кино")
+        return
+    query = query.strip()
+    text, markup = search_page(query, 0, storage_of(message).search_songs(query, SEARCH_PAGE_SIZE + 1, 0))
+    bot.send_message(message.chat.id, text, reply_markup=markup)
+
+
+def show_search_page(message, offset, owner_storage):
+    query = search_query_from_message(message)
+    text, markup = search_page(query, offset, owner_storage.search_songs(query, SEARCH_PAGE_SIZE + 1, offset))
+    bot.edit_message_text(text, message.chat.id, message.id, reply_markup=markup)
 
 
 @bot.callback_query_handler(func=lambda call: True)
 def callback_handler(call):
-    if call.data.startswith("update_rating_"):
-        repertuar_id, mark = re.findall(r"\d+", call.data)
-        update_rating(call.message, int(repertuar_id), int(mark))
+    # Нажатие подтверждается сразу, чтобы у кнопки пропали "часики", не дожидаясь БД
+    bot.answer_callback_query(call.id)
+    # Владелец - по нажавшему кнопку (call), а не по автору сообщения с кнопкой (бота)
+    owner_id = owner_of(call)
+    owner_storage = storage.for_owner(owner_id)
+    action, *args = parse_callback(call.data, is_admin(call)) or [None]
+    if action == 'update_rating':
+        song_id, mark = args
+        update_rating(call.message, song_id, mark, owner_id)
+    elif action == 'search':
+        show_search_page(call.message, args[0], owner_storage)
+    elif action == 'requests':
+        show_requests_page(call.message, args[0], owner_storage)
+    elif action == 'request_done':
+        request_id, offset = args
+        owner_storage.set_song_requests_status([request_id], 'done')
+        show_requests_page(call.message, offset, owner_storage)
 
 
 @bot.message_handler(func=lambda message: message.text == 'Заказать композицию')
 def zakaz_song(message):
-    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-    itembtn = types.KeyboardButton('Назад')
-    markup.add(itembtn)
-    msg = bot.send_message(message.chat.id,
-                           "Введите название песни, которую вы хотели бы заказать или нажмите 'Назад' для возврата.",
-                           reply_markup=markup)
-    bot.register_next_step_handler(msg, send_composition_to_admin)
+    msg = bot.send_message(message.chat.id, ORDER_TEXT, reply_markup=order_markup())
+    register_next_step(msg, send_composition_to_admin)
 
 
+@dialog_step
 def send_composition_to_admin(message):
     if message.text.lower() != 'назад':
-        # TODO в таблицу какую-нибудь сохранять
         composition = message.text
-        global telegram_admin_chat_id
-        if telegram_admin_chat_id is not None:
-            bot.send_message(telegram_admin_chat_id,
-                             f"Пользователь {message.from_user.username} заказал композицию: {composition}")
-            bot.send_message(message.chat.id, "Заявка отправлена")
-        else:
+        # Заказ сохраняется в очередь, администратор получает их сводками (см. send_request_digest)
+        try:
+            owner_storage = storage_of(message)
+            owner_storage.add_song_request(message.chat.id, message.from_user.username, composition)
+            # Похожие композиции из репертуара - подсказка заказчику
+            bot.send_message(message.chat.id, format_order(owner_storage.search_songs(composition, 3)))
+        except Exception as e:
+            logger.error(e)
             bot.send_message(message.chat.id, "Не удалось отправить заявку музыканту")
     send_client_menu(message.chat.id)
 
 
+# Владельцы, о неотправленных заказах которых журнал уже предупредил
+digest_warned_owners = set()
+
+
+def send_request_digest():
+    """Сводки новых заказов администраторам: по сообщению на владельца репертуара вместо сообщения на каждый заказ.
+    Заказы владельца дождутся, пока его администратор не выполнит /start"""
+    for owner_id in TENANTS:
+        owner_storage = storage.for_owner(owner_id)
+        chat_id = owner_storage.get_admin_chat()
+        if chat_id is None:
+            if owner_id not in digest_warned_owners and owner_storage.get_pending_song_requests(limit=1):
+                digest_warned_owners.add(owner_id)
+                logger.warning(f"Есть заказы композиций владельца {owner_id}, но чат его администратора неизвестен: "
+                               "сводки будут отправляться после /start администратора")
+            continue
+        requests = owner_storage.claim_song_requests(getattr(env, 'REQUEST_DIGEST_PARAMS', {}).get('limit', 50))
+        if not requests:
+            continue
+        request_ids = [request.id for request in requests]
+        # Сводка несрочная: уходит через очередь отправки с низким приоритетом.
+        # Если отправить не удастся, заказы вернутся в очередь до следующей сводки
+        bot.enqueue('send_message', chat_id, format_request_digest(requests), priority=PRIORITY_LOW,
+                    on_error=lambda e, owner_storage=owner_storage, request_ids=request_ids:
+                    owner_storage.set_song_requests_status(request_ids, 'new'))
+
+
+def request_digest_loop():
+    interval = getattr(env, 'REQUEST_DIGEST_PARAMS', {}).get('interval', 300)
+    while True:
+        time.sleep(interval)
+        try:
+            send_request_digest()
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки заказов: {e}")
+
+
+def stats_refresh_loop(interval):
+    """Периодический пересчёт сводных таблиц статистики (исправляет изменения в обход бота)"""
+    while True:
+        time.sleep(interval)
+        try:
+            storage.refresh_stats()
+        except Exception as e:
+            logger.error(f"Ошибка пересчёта статистики: {e}")
+
+
+# Команда /requests - невыполненные заказы композиций
+@bot.message_handler(commands=['requests'])
+def requests_command(message):
+    if is_admin(message):
+        text, markup = requests_page(0, storage_of(message).get_pending_song_requests(REQUESTS_PAGE_SIZE + 1, 0))
+        bot.send_message(message.chat.id, text, reply_markup=markup)
+    else:
+        bot.send_message(message.chat.id, "У вас нет доступа к этой команде")
+
+
+def show_requests_page(message, offset, owner_storage):
+    requests = owner_storage.get_pending_song_requests(REQUESTS_PAGE_SIZE + 1, offset)
+    if not requests and offset > 0:
+        # Последний заказ страницы выполнен - показываем предыдущую
+        offset = max(offset - REQUESTS_PAGE_SIZE, 0)
+        requests = owner_storage.get_pending_song_requests(REQUESTS_PAGE_SIZE + 1, offset)
+    text, markup = requests_page(offset, requests)
+    bot.edit_message_text(text, message.chat.id, message.id, reply_markup=markup)
+
+
 @bot.message_handler(commands=['backup'])
 def backup_command(message):
-    """Обработчик команды /backup"""
+    """Обработчик команды /backup: "/backup [inc|diff] [gz]" - полный, инкрементный (изменения после
+    предыдущего бэкапа) или дифференциальный (после предыдущего полного) бэкап, gz - сжатый"""
     try:
-        file_path = 'backup_repertuar.csv'  # Путь к файлу
-        backup_file = storage.backup(file_path)
-        with open(backup_file, 'rb') as file:
-            bot.send_document(chat_id=message.chat.id, document=file)
-        os.remove(backup_file)  # Удаляем файл после отправки
+        kind, compress = parse_backup_command(message.text)
+        with storage_of(message).backup(compress, kind) as backup_file:
+            bot.send_document(chat_id=message.chat.id, document=backup_file,
+                              visible_file_name=backup_file_name(kind, compress))
     except Exception as e:
         bot.send_message(chat_id=message.chat.id, text=f"Произошла ошибка: {str(e)}")
 
 
-# Запуск бота
-bot.polling()
+def download_document(document):
+    """Скачивание документа во временный файл по частям, без загрузки файла в память целиком"""
+    file_info = bot.get_file(document.file_id)
+    url = (apihelper.FILE_URL or TELEGRAM_FILE_URL).format(env.TELEGRAM_BOT_TOKEN, file_info.file_path)
+    buffer = tempfile.SpooledTemporaryFile(BACKUP_SPOOL_SIZE)
+    try:
+        with requests.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                buffer.write(chunk)
+    except BaseException:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+
+@bot.message_handler(commands=['restore'])
+def restore_command(message):
+    """Обработчик команды /restore: восстановление композиций из файла бэкапа"""
+    if is_admin(message):
+        bot.send_message(message.chat.id, RESTORE_TEXT)
+        register_next_step(message, process_restore_file)
+    else:
+        bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
+
+
+@dialog_step
+def process_restore_file(message):
+    """Восстановление из присланного файла бэкапа в одной транзакции с сообщением о ходе восстановления"""
+    if not is_admin(message):
+        bot.send_message(message.chat.id, "У вас нет доступа к этой команде.")
+        return
+    if message.content_type != 'document':
+        bot.send_message(message.chat.id, "Пожалуйста, отправьте файл бэкапа.")
+        return
+    status = bot.send_message(message.chat.id, format_restore_progress())
+
+    def report(result):
+        # Через очередь: восстановление не ждёт отправки, правки сообщения идут по порядку
+        bot.enqueue('edit_message_text', format_restore_progress(result), message.chat.id, status.message_id)
+
+    try:
+        with download_document(message.document) as backup_file:
+            result = storage_of(message).restore(backup_file, throttled(report))
+    except Exception as e:
+        logger.error(f"Ошибка восстановления из бэкапа: {e}")
+        bot.send_message(message.chat.id, f"Восстановление не выполнено, данные не изменены: {str(e)}")
+        return
+    logger.info(f"Восстановление из бэкапа: {result}")
+    bot.enqueue('edit_message_text', format_restore_progress(result, done=True), message.chat.id, status.message_id)
+    bot.send_message(message.chat.id, format_csv_result(result))
+
+
+@bot.message_handler(commands=['metrics'])
+def metrics_command(message):
+    """Метрики бота в формате Prometheus (файлом - текст бывает длиннее сообщения)"""
+    if is_admin(message):
+        bot.send_document(message.chat.id, io.BytesIO(REGISTRY.render().encode('utf-8')),
+                          visible_file_name='metrics.txt')
+    else:
+        bot.send_message(message.chat.id, "У вас нет доступа к этой команде")
+
+
+# Замер времени всех обработчиков и счётчики ошибок Telegram API
+instrument_handlers(bot)
+register_sender_metrics(bot)
+
+
+async def process_update(update):
+    """Обработка обновления, полученного через webhook (см. webhook_server.py)"""
+    await asyncio.to_thread(bot.process_new_updates, [telebot.types.Update.de_json(update)])
+
+
+async def setup_webhook():
+    params = env.WEBHOOK_PARAMS
+    await asyncio.to_thread(bot.set_webhook, url=params['url'], secret_token=params.get('secret_token'),
+                            max_connections=params.get('max_connections', 40))
+
+
+# Запуск бота: webhook, если он настроен в repertuar_env.py, иначе long polling
+if __name__ == '__main__':
+    if getattr(env, 'METRICS_PARAMS', None):
+        start_http_server(**env.METRICS_PARAMS, status=storage.status)
+    threading.Thread(target=request_digest_loop, name='request-digest', daemon=True).start()
+    if getattr(env, 'STATS_REFRESH_PARAMS', None):
+        threading.Thread(target=stats_refresh_loop, args=(env.STATS_REFRESH_PARAMS['interval'],),
+                         name='stats-refresh', daemon=True).start()
+    if getattr(env, 'WEBHOOK_PARAMS', None):
+        run_webhook(env.WEBHOOK_PARAMS, process_update, setup_webhook, 'repertuar_tgbot', logger)
+    else:
+        bot.remove_webhook()
+        bot.polling()
@@ -1,6 +1,44 @@
+import copy
+import csv
+import gzip
+import io
+import itertools
+import logging
 from abc import ABCMeta, abstractmethod
+from collections import Counter
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import List
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from storage_manager.song_deck import SongDeck
+
+# Количество строк в одном многострочном INSERT при массовой загрузке
+BULK_BATCH_SIZE = 1000
+# Бэкап до этого размера держится в памяти, больший - во временном файле
+BACKUP_SPOOL_SIZE = 1024 * 1024
+# Количество строк, читаемых из БД за раз при выгрузке бэкапа
+BACKUP_FETCH_SIZE = 1000
+# При массовой загрузке в журнал (на уровне DEBUG) пишется каждая такая по счёту строка
+BULK_LOG_SAMPLE = 100
+# Виды бэкапов: полный, инкрементный (изменения после последнего бэкапа любого вида)
+# и дифференциальный (изменения после последнего полного бэкапа)
+BACKUP_FULL = 'full'
+BACKUP_INCREMENTAL = 'incremental'
+BACKUP_DIFFERENTIAL = 'differential'
+GZIP_MAGIC = b'\x1f\x8b'
+# Частичный бэкап захватывает изменения и за эти секунды до контрольной точки: транзакции,
+# начатые до неё и зафиксированные после, не пропадают (повторное восстановление строки ничего не меняет)
+BACKUP_OVERLAP_SECONDS = 60
+# Количество недавно добавленных или оценённых композиций в сводной статистике
+STATS_RECENT_LIMIT = 5
+# Имя блокировки, под которой применяются миграции схемы (процессы бота, запущенные одновременно,
+# применяют их по очереди), и сколько секунд её ждать
+MIGRATION_LOCK = 'repertuar_migrations'
+MIGRATION_LOCK_TIMEOUT = 300
+# Владелец репертуара (музыкант) по умолчанию: единственный без многопользовательского режима;
+# ему принадлежат и композиции, сохранённые до появления столбца owner_id
+DEFAULT_OWNER_ID = 0
 
 
 @dataclass(init=True)
@@ -12,9 +50,137 @@ class Song:
     mark: int
 
 
+def normalize_tag(tag) -> str:
+    """Приведение тега к виду, в котором он хранится в таблице tags: "#Русский_рок" => "русский рок" """
+    return tag.strip().lstrip('#').replace('_', ' ').strip().lower()
+
+
+def split_tags(tags) -> List[str]:
+    """Разбор строки тегов через запятую в список различных нормализованных тегов"""
+    names = []
+    for tag in (tags or '').split(','):
+        name = normalize_tag(tag)
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+@contextmanager
+def open_backup_stream(buffer, compress=False):
+    """Двоичный поток для записи бэкапа в buffer, со сжатием gzip при compress=True"""
+    if not compress:
+        yield buffer
+        return
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as stream:
+        yield stream
+
+
+def read_backup_rows(stream) -> Iterator[List[str]]:
+    """Строки CSV бэкапа (через точку с запятой) из двоичного файла, сжатого gzip или нет.
+    Файл разбирается по мере чтения строк; сжатие распознаётся по первым байтам, поэтому файл
+    должен поддерживать seek().
+    """
+    compressed = stream.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    stream.seek(0)
+    if compressed:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    try:
+        yield from csv.reader(text_stream, delimiter=';')
+    finally:
+        text_stream.detach()  # файл закрывает вызывающий
+
+
+@dataclass(init=True)
+class SongRequest:
+    """Заказ композиции слушателем.
+    status: 'new' - ещё не отправлен администратору, 'sent' - вошёл в сводку, 'done' - выполнен
+    """
+    id: int
+    chat_id: int
+    username: Optional[str]
+    composition: str
+    status: str
+    created_at: datetime
+
+
+@dataclass(init=True)
+class RepertuarStats:
+    """Сводная статистика репертуара (см. StorageManager.get_stats)"""
+    total: int
+    marks: List[tuple]  # пары (оценка, количество композиций) по возрастанию оценки
+    tags: List[tuple]  # пары (тег, количество композиций) по убыванию количества
+    recent: List[Song]  # недавно добавленные или оценённые композиции, от новых к старым
+
+
+@dataclass(init=True)
+class BulkInsertResult:
+    """Итоги массовой загрузки композиций (по категориям, как в add_song)"""
+    success: int = 0
+    duplicates: int = 0
+    db_errors: int = 0
+    errors: int = 0
+    skipped: int = 0
+
+    @property
+    def total(self) -> int:
+        """Количество обработанных строк"""
+        return self.success + self.duplicates + self.db_errors + self.errors + self.skipped
+
+
 class StorageManager:
+    """Репертуар одного владельца (owner_id): все методы, кроме состояний диалогов и выбора владельца чатом,
+    читают и изменяют только его композиции, заказы, сводки и бэкапы. Хранилища других владельцев -
+    for_owner(); они работают на том же пуле соединений.
+    """
     __metaclass__ = ABCMeta
 
+    owner_id = DEFAULT_OWNER_ID
+
+    def for_owner(self, owner_id):
+        """Хранилище репертуара владельца owner_id на том же пуле соединений, со своей колодой случайного выбора.
+        Создаётся без обращения к БД.
+        """
+        storage = copy.copy(self)
+        storage.owner_id = owner_id
+        storage.deck = SongDeck(storage.get_song_marks, storage.save_last_shown)
+        return storage
+
+    @abstractmethod
+    def migrations(self) -> List[Tuple[str, Sequence]]:
+        """Миграции схемы БД по порядку: пары (описание, шаги), шаг - SQL-запрос или функция step(cursor).
+        Версия схемы - номер последней применённой миграции (с 1), применённые записываются в schema_version.
+        Новые миграции добавляются только в конец списка. Шаги должны выдерживать повторное выполнение:
+        БД, созданные до появления schema_version, проходят все миграции заново.
+        """
+
+    @abstractmethod
+    def migrate(self) -> int:
+        """Применение недостающих миграций под блокировкой MIGRATION_LOCK; возвращает версию схемы.
+        Если схема актуальна, это одна короткая транзакция.
+        """
+
+    def apply_migrations(self, cursor, version, record_sql, commit=None) -> int:
+        """Применение миграций с номерами больше version.
+        record_sql - запрос, добавляющий в schema_version (номер, описание);
+        commit - фиксация после каждой миграции (для БД, где DDL не откатывается)
+        """
+        migrations = self.migrations()
+        if version > len(migrations):
+            self.logger.warning(f"Схема БД новее бота: версия {version}, известно миграций {len(migrations)}")
+            return version
+        for number, (description, steps) in enumerate(migrations[version:], start=version + 1):
+            self.logger.info(f"Миграция схемы БД {number}: {description}")
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(record_sql, (number, description))
+            if commit is not None:
+                commit()
+        return len(migrations)
+
     @abstractmethod
     def add_song(self, title, artist, tags, mark) -> int:
         """Добавление композиции в БД
@@ -25,22 +191,243 @@ class StorageManager:
         99 - прочие ошибки
         """
 
+    @abstractmethod
+    def add_songs_bulk(self, rows: Sequence[Sequence[str]]) -> BulkInsertResult:
+        """Массовое добавление композиций в одной транзакции.
+        Каждая строка - [название, исполнитель, теги (не обязательно), оценка (не обязательно)].
+        Строки с неверным количеством полей пропускаются, дубли не прерывают загрузку.
+        """
+
+    @abstractmethod
+    def upsert_songs_bulk(self, rows: Iterable[Sequence[str]], progress=None) -> BulkInsertResult:
+        """Массовая загрузка композиций в одной транзакции с обновлением тегов и оценок уже сохранённых
+        (восстановление из бэкапа). Строки - как в add_songs_bulk; они читаются из rows пачками
+        по BULK_BATCH_SIZE, так что rows может быть и итератором по большому файлу.
+        progress(result) вызывается после каждой пачки с итогами на текущий момент.
+        В итогах success - добавленные и изменённые композиции, duplicates - совпавшие с сохранёнными.
+        """
+
+    def restore(self, stream, progress=None) -> BulkInsertResult:
+        """Восстановление из файла бэкапа (см. backup) в одной транзакции: файл разбирается по мере загрузки,
+        память не зависит от его размера. progress - как в upsert_songs_bulk.
+        """
+        return self.upsert_songs_bulk(read_backup_rows(stream), progress)
+
+    @staticmethod
+    def prepare_bulk_rows(rows, result: BulkInsertResult, logger=None) -> List[tuple]:
+        """Проверка и приведение строк CSV к кортежам (title, artist, tags, mark).
+        С logger каждая BULK_LOG_SAMPLE-я строка пишется в журнал на уровне DEBUG.
+        """
+        return list(StorageManager.iter_bulk_rows(rows, result, logger))
+
+    @staticmethod
+    def iter_bulk_rows(rows, result: BulkInsertResult, logger=None) -> Iterator[tuple]:
+        """Как prepare_bulk_rows, но строки проверяются по мере чтения из rows"""
+        log_rows = logger is not None and logger.isEnabledFor(logging.DEBUG)
+        for number, row in enumerate(rows):
+            if log_rows and number % BULK_LOG_SAMPLE == 0:
+                logger.debug(f"Строка CSV {number + 1}: {row}")
+            if not 2 <= len(row) <= 4:
+                result.skipped += 1
+                continue
+            title, artist = row[0], row[1]
+            tags = row[2] if len(row) > 2 else ""
+            mark = row[3].strip() if len(row) > 3 else ""
+            try:
+                mark = int(mark) if mark else 0
+            except ValueError:
+                # Неверную оценку раньше отвергала БД (столбец mark - целый): это ошибка БД, как и прежде
+                result.db_errors += 1
+                continue
+            yield title, artist, tags.strip(), mark
+
+    @staticmethod
+    def bulk_batches(songs) -> Iterator[List[tuple]]:
+        """Пачки по BULK_BATCH_SIZE композиций"""
+        songs = iter(songs)
+        batch = list(itertools.islice(songs, BULK_BATCH_SIZE))
+        while batch:
+            yield batch
+            batch = list(itertools.islice(songs, BULK_BATCH_SIZE))
+
+    @staticmethod
+    def upsert_batches(songs, result: BulkInsertResult) -> Iterator[List[tuple]]:
+        """Пачки для upsert: из композиций пачки с одинаковыми названием и исполнителем остаётся последняя
+        (одна команда INSERT ... ON CONFLICT DO UPDATE не может изменить строку дважды)"""
+        for batch in StorageManager.bulk_batches(songs):
+            unique = {}
+            for song in batch:
+                unique[song[:2]] = song
+            result.duplicates += len(batch) - len(unique)
+            yield list(unique.values())
+
+    @staticmethod
+    def stats_deltas(removed, added) -> Tuple[List[tuple], List[tuple]]:
+        """Изменения сводных таблиц tag_stats и mark_stats по парам (теги, оценка) композиций до изменения
+        (removed) и после него (added). Результат - ненулевые пары (тег, изменение) и (оценка, изменение),
+        упорядоченные по ключу: параллельные транзакции блокируют строки сводок в одном порядке.
+        """
+        tag_deltas, mark_deltas = Counter(), Counter()
+        for sign, songs in ((-1, removed), (1, added)):
+            for tags, mark in songs:
+                mark_deltas[mark or 0] += sign
+                for name in split_tags(tags):
+                    tag_deltas[name] += sign
+        return (sorted(item for item in tag_deltas.items() if item[1]),
+                sorted(item for item in mark_deltas.items() if item[1]))
+
     @abstractmethod
     def get_songs_count(self) -> int:
-        """Функция для получения количества музыкальных композиций"""
+        """Функция для получения количества музыкальных композиций (по сводной таблице mark_stats)"""
+
+    @abstractmethod
+    def get_stats(self, recent_limit=STATS_RECENT_LIMIT) -> RepertuarStats:
+        """Сводная статистика: количество композиций по оценкам и тегам из сводных таблиц
+        и recent_limit последних добавленных или оценённых (по индексу repertuar_owner_open_time_idx).
+        Сводные таблицы обновляются в тех же транзакциях, что и композиции, поэтому чтение не зависит
+        от размера репертуара.
+        """
+
+    @abstractmethod
+    def refresh_stats(self):
+        """Пересчёт сводных таблиц (всех владельцев) по композициям и тегам - на случай изменений в обход хранилища"""
 
     @abstractmethod
     def get_tags(self) -> List[str]:
         """Функция для получения списка тегов"""
 
     @abstractmethod
-    def get_random_song(self) -> Song:
-        ...
+    def get_tag_counts(self) -> List[tuple]:
+        """Пары (тег, количество композиций), по убыванию количества (по сводной таблице tag_stats)"""
+
+    @abstractmethod
+    def get_songs_by_tag(self, tag, limit=50) -> List[Song]:
+        """Композиции с заданным тегом (поиск по индексу song_tags)"""
+
+    @abstractmethod
+    def get_random_song_by_tag(self, tag) -> Optional[Song]:
+        """Случайная композиция с заданным (нормализованным) тегом"""
+
+    @abstractmethod
+    def search_songs(self, query, limit=10, offset=0) -> List[Song]:
+        """Поиск композиций по названию и исполнителю, от наиболее похожих к менее похожим"""
+
+    @abstractmethod
+    def get_song_marks(self) -> List[tuple]:
+        """Тройки (идентификатор, оценка, секунд с последнего показа или None) всех композиций
+        (для взвешенного случайного выбора, см. SongDeck)"""
+
+    @abstractmethod
+    def save_last_shown(self, shown):
+        """Сохранение времени последнего показа {идентификатор: секунд с показа} (по часам сервера БД).
+        Более позднее время, сохранённое другим процессом, не перезаписывается.
+        """
+
+    @abstractmethod
+    def get_song(self, song_id) -> Optional[Song]:
+        """Композиция по идентификатору"""
+
+    @abstractmethod
+    def get_songs(self, song_ids) -> List[Song]:
+        """Композиции по списку идентификаторов (одним запросом)"""
+
+    def get_random_song(self, tag=None) -> Optional[Song]:
+        """Случайная композиция: чаще - с высокой оценкой, реже - недавно показанные (см. SongDeck в self.deck).
+        Вместо сортировки всей таблицы - выбор идентификатора в памяти за O(log n) и чтение по первичному ключу.
+        С tag - случайная композиция среди отмеченных тегом (по индексу song_tags).
+        """
+        if tag is not None:
+            song = self.get_random_song_by_tag(normalize_tag(tag))
+            if song is not None:
+                self.deck.mark_shown([song.id])
+            return song
+        while True:
+            song_ids = self.deck.draw()
+            if not song_ids:
+                return None
+            song = self.get_song(song_ids[0])
+            if song is not None:
+                return song
+            # Композицию удалили в обход этого процесса
+            self.deck.discard(song_ids[0])
+
+    def get_random_songs(self, n, min_mark=None) -> List[Song]:
+        """До n различных случайных композиций (с теми же весами, что в get_random_song) одним запросом к БД.
+        min_mark - отбирать только композиции с оценкой не ниже заданной.
+        """
+        song_ids = self.deck.draw(n, min_mark)
+        songs = {song.id: song for song in self.get_songs(song_ids)} if song_ids else {}
+        for song_id in song_ids:
+            if song_id not in songs:
+                self.deck.discard(song_id)
+        return [songs[song_id] for song_id in song_ids if song_id in songs]
 
     @abstractmethod
     def update_rating(self, song_id, rating):
         ...
 
     @abstractmethod
-    def backup(self, file_path):
-        """Выгрузка всех композиций в CSV файл."""
+    def update_ratings(self, marks) -> int:
+        """Запись оценок {идентификатор: оценка} в одной транзакции; не изменившиеся оценки не перезаписываются.
+        Возвращает количество изменённых композиций.
+        """
+
+    @abstractmethod
+    def add_song_request(self, chat_id, username, composition) -> int:
+        """Сохранение заказа композиции со статусом 'new'; возвращает идентификатор заказа"""
+
+    @abstractmethod
+    def claim_song_requests(self, limit) -> List[SongRequest]:
+        """До limit самых старых заказов со статусом 'new', переводимых в статус 'sent' в той же транзакции.
+        Заказы, уже забранные другим процессом, пропускаются.
+        """
+
+    @abstractmethod
+    def set_song_requests_status(self, request_ids, status) -> int:
+        """Смена статуса заказов; возвращает количество изменённых"""
+
+    @abstractmethod
+    def get_pending_song_requests(self, limit=10, offset=0) -> List[SongRequest]:
+        """Невыполненные заказы (статусы 'new' и 'sent') от старых к новым"""
+
+    @abstractmethod
+    def get_state(self, chat_id) -> Optional[str]:
+        """Сохранённое состояние диалога чата (строка), если его срок ещё не истёк"""
+
+    @abstractmethod
+    def set_state(self, chat_id, state, ttl):
+        """Сохранение состояния диалога чата на ttl секунд (по часам сервера БД)"""
+
+    @abstractmethod
+    def delete_state(self, chat_id):
+        """Удаление состояния диалога чата"""
+
+    @abstractmethod
+    def purge_states(self) -> int:
+        """Удаление истёкших состояний диалогов; возвращает их количество"""
+
+    @abstractmethod
+    def get_chat_owner(self, chat_id) -> Optional[int]:
+        """Владелец репертуара, выбранный чатом слушателя (None, если чат его не выбирал)"""
+
+    @abstractmethod
+    def set_chat_owner(self, chat_id, owner_id):
+        """Запоминание владельца репертуара, выбранного чатом слушателя"""
+
+    @abstractmethod
+    def get_admin_chat(self) -> Optional[int]:
+        """Чат администратора владельца - для сводок заказов (None, если администратор ещё не выполнил /start)"""
+
+    @abstractmethod
+    def set_admin_chat(self, chat_id):
+        """Запоминание чата администратора владельца"""
+
+    @abstractmethod
+    def backup(self, compress=False, kind=BACKUP_FULL):
+        """Выгрузка композиций в CSV (через точку с запятой, при compress=True - сжатый gzip).
+        kind=BACKUP_INCREMENTAL/BACKUP_DIFFERENTIAL - только композиции, добавленные или изменённые
+        (по open_time) после предыдущего бэкапа / предыдущего полного бэкапа; если такого бэкапа ещё нет,
+        выгружаются все композиции. Время начала каждого бэкапа сохраняется как контрольная точка.
+        Восстановление - полный бэкап, затем частичные по порядку (upsert_songs_bulk).
+        Возвращает временный файл (SpooledTemporaryFile), позиционированный на начало; закрывает его вызывающий.
+        """
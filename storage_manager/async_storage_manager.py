@@ -0,0 +1,32 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncStorageManager:
+    """Асинхронный фасад над StorageManager для бота на asyncio.
+    Каждый метод хранилища превращается в корутину, которая выполняет синхронный вызов в отдельном
+    пуле потоков, не блокируя цикл событий. Размер пула потоков стоит брать равным размеру пула соединений:
+    большее число потоков всё равно ждало бы свободного соединения.
+    """
+
+    def __init__(self, storage, max_workers=10, executor=None):
+        self.storage = storage
+        self.executor = executor or ThreadPoolExecutor(max_workers, thread_name_prefix='storage')
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(attr, *args, **kwargs))
+        return call
+
+    def for_owner(self, owner_id):
+        """Асинхронный фасад хранилища владельца owner_id на том же пуле потоков (создаётся без обращения к БД)"""
+        return AsyncStorageManager(self.storage.for_owner(owner_id), executor=self.executor)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Потокобезопасный кэш с ограничением времени жизни записей (TTL) и вытеснением давно не читавшихся (LRU)"""
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # ключ -> (значение, момент устаревания)
+        # Поколения: invalidate увеличивает поколение ключа, clear - общее поколение. Значение, загруженное
+        # при другом поколении, уже могло устареть и в кэш не сохраняется
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def generation(self, key):
+        """Поколение ключа - запоминается перед загрузкой значения и передаётся в set"""
+        with self._lock:
+            return self._epoch, self._generations.get(key, 0)
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(key, 0)):
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, load):
+        """Значение из кэша, а при промахе - из load() с сохранением в кэш"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            generation = self.generation(key)
+            value = load()
+            self.set(key, value, generation)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+            self._epoch += 1
+
+    def stats(self):
+        """Счётчики кэша: попадания, промахи, доля попаданий, вытеснения, размер"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses,
+                        hit_rate=round(self.hits / requests, 3) if requests else 0.0,
+                        evictions=self.evictions, size=len(self._data))
+
+
+_MISSING = object()
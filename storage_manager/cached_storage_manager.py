@@ -0,0 +1,159 @@
+from storage_manager import BACKUP_FULL, STATS_RECENT_LIMIT, StorageManager
+from storage_manager.cache import TTLCache
+
+COUNT_KEY = ('count',)
+TAGS_KEY = ('tags',)
+TAG_COUNTS_KEY = ('tag_counts',)
+STATS_KEY = ('stats',)
+
+
+class CachedStorageManager(StorageManager):
+    """Кэширующая обёртка над StorageManager.
+    Количество композиций, списки тегов и композиции по идентификатору читаются из кэша;
+    методы записи сбрасывают ровно те записи кэша, которые они могли изменить.
+    TTL ограничивает время, в течение которого видны устаревшие данные после записи другим процессом.
+    """
+
+    def __init__(self, storage, maxsize=1000, ttl=300):
+        self.storage = storage
+        self.logger = storage.logger
+        self.deck = storage.deck
+        self.owner_id = storage.owner_id
+        self.cache = TTLCache(maxsize, ttl)
+
+    def __getattr__(self, name):
+        # Остальные атрибуты (пул соединений и т.п.) - от обёрнутого хранилища
+        return getattr(self.storage, name)
+
+    def for_owner(self, owner_id):
+        # У каждого владельца свой кэш: ключи кэша не содержат владельца
+        return CachedStorageManager(self.storage.for_owner(owner_id), self.cache.maxsize, self.cache.ttl)
+
+    def add_song(self, title, artist, tags, mark=0):
+        result = self.storage.add_song(title, artist, tags, mark)
+        if result == 0:
+            self.cache.invalidate(COUNT_KEY, TAGS_KEY, TAG_COUNTS_KEY, STATS_KEY)
+        return result
+
+    def add_songs_bulk(self, rows):
+        result = self.storage.add_songs_bulk(rows)
+        if result.success:
+            self.cache.invalidate(COUNT_KEY, TAGS_KEY, TAG_COUNTS_KEY, STATS_KEY)
+        return result
+
+    def upsert_songs_bulk(self, rows, progress=None):
+        result = self.storage.upsert_songs_bulk(rows, progress)
+        if result.success:
+            # Изменённые композиции заранее неизвестны
+            self.cache.clear()
+        return result
+
+    def get_songs_count(self):
+        return self.cache.get_or_load(COUNT_KEY, self.storage.get_songs_count)
+
+    def get_tags(self):
+        return self.cache.get_or_load(TAGS_KEY, self.storage.get_tags)
+
+    def get_tag_counts(self):
+        return self.cache.get_or_load(TAG_COUNTS_KEY, self.storage.get_tag_counts)
+
+    def get_stats(self, recent_limit=STATS_RECENT_LIMIT):
+        if recent_limit != STATS_RECENT_LIMIT:
+            return self.storage.get_stats(recent_limit)
+        return self.cache.get_or_load(STATS_KEY, self.storage.get_stats)
+
+    def refresh_stats(self):
+        try:
+            return self.storage.refresh_stats()
+        finally:
+            self.cache.invalidate(COUNT_KEY, TAGS_KEY, TAG_COUNTS_KEY, STATS_KEY)
+
+    def get_songs_by_tag(self, tag, limit=50):
+        return self.storage.get_songs_by_tag(tag, limit)
+
+    def get_random_song_by_tag(self, tag):
+        return self.storage.get_random_song_by_tag(tag)
+
+    def search_songs(self, query, limit=10, offset=0):
+        return self.storage.search_songs(query, limit, offset)
+
+    def get_song_marks(self):
+        return self.storage.get_song_marks()
+
+    def save_last_shown(self, shown):
+        return self.storage.save_last_shown(shown)
+
+    def get_song(self, song_id):
+        song = self.cache.get(('song', song_id))
+        if song is None:
+            generation = self.cache.generation(('song', song_id))
+            song = self.storage.get_song(song_id)
+            if song is not None:
+                self.cache.set(('song', song_id), song, generation)
+        return song
+
+    def get_songs(self, song_ids):
+        songs, missing = [], []
+        for song_id in song_ids:
+            song = self.cache.get(('song', song_id))
+            if song is None:
+                missing.append(song_id)
+            else:
+                songs.append(song)
+        if missing:
+            generations = {song_id: self.cache.generation(('song', song_id)) for song_id in missing}
+            for song in self.storage.get_songs(missing):
+                self.cache.set(('song', song.id), song, generations.get(song.id))
+                songs.append(song)
+        return songs
+
+    def update_rating(self, song_id, mark):
+        try:
+            return self.storage.update_rating(song_id, mark)
+        finally:
+            self.cache.invalidate(('song', song_id), STATS_KEY)
+
+    def update_ratings(self, marks):
+        try:
+            return self.storage.update_ratings(marks)
+        finally:
+            self.cache.invalidate(STATS_KEY, *[('song', song_id) for song_id in marks])
+
+    def add_song_request(self, chat_id, username, composition):
+        return self.storage.add_song_request(chat_id, username, composition)
+
+    def claim_song_requests(self, limit):
+        return self.storage.claim_song_requests(limit)
+
+    def set_song_requests_status(self, request_ids, status):
+        return self.storage.set_song_requests_status(request_ids, status)
+
+    def get_pending_song_requests(self, limit=10, offset=0):
+        return self.storage.get_pending_song_requests(limit, offset)
+
+    def get_state(self, chat_id):
+        return self.storage.get_state(chat_id)
+
+    def set_state(self, chat_id, state, ttl):
+        return self.storage.set_state(chat_id, state, ttl)
+
+    def delete_state(self, chat_id):
+        return self.storage.delete_state(chat_id)
+
+    def purge_states(self):
+        return self.storage.purge_states()
+
+    def get_chat_owner(self, chat_id):
+        return self.storage.get_chat_owner(chat_id)
+
+    def set_chat_owner(self, chat_id, owner_id):
+        return self.storage.set_chat_owner(chat_id, owner_id)
+
+    def get_admin_chat(self):
+        return self.storage.get_admin_chat()
+
+    def set_admin_chat(self, chat_id):
+        return self.storage.set_admin_chat(chat_id)
+
+    def backup(self, compress=False, kind=BACKUP_FULL):
+        return self.storage.backup(compress, kind)
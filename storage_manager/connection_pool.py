@@ -0,0 +1,167 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """Пул соединений с БД, общий для всех потоков-обработчиков бота.
+    Соединение выдаётся на время одного вызова через контекстный менеджер connection() или run().
+    Соединение проверяется отдельным запросом только если оно долго простаивало;
+    в остальных случаях потеря соединения обнаруживается по ошибке самого запроса (см. run()).
+    """
+
+    def __init__(self, logger, connect, is_alive, disconnect_errors=(), min_size=1, max_size=10, timeout=30,
+                 probe_idle_seconds=60):
+        """
+        connect - функция, открывающая новое соединение
+        is_alive - функция проверки соединения (True, если соединение рабочее)
+        disconnect_errors - исключения, после которых соединение считается потерянным
+        probe_idle_seconds - простой соединения, после которого оно проверяется при выдаче из пула
+        """
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(f"Неверные размеры пула соединений: min_size={min_size}, max_size={max_size}")
+        self.logger = logger
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.probe_idle_seconds = probe_idle_seconds
+        self._connect = connect
+        self._is_alive = is_alive
+        self._disconnect_errors = disconnect_errors
+        self._idle = []  # свободные соединения (соединение, время возврата в пул), последнее - в конце
+        self._size = 0  # количество открытых соединений (свободных и выданных)
+        self._condition = threading.Condition()
+        # Счётчики: выдачи соединений (обращения к БД), открытые соединения, потерянные соединения,
+        # проверки, повторы запросов
+        self._stats = dict(checkouts=0, connects=0, disconnects=0, probes=0, retries=0)
+        for _ in range(min_size):
+            self._idle.append((self._open(), time.monotonic()))
+            self._size += 1
+
+    def _count(self, name):
+        with self._condition:
+            self._stats[name] += 1
+
+    def stats(self):
+        """Значения счётчиков пула"""
+        with self._condition:
+            return dict(self._stats, size=self._size, idle=len(self._idle))
+
+    def _open(self):
+        self.logger.info("Попытка соединения с БД")
+        db = self._connect()
+        self._count('connects')
+        self.logger.info("Соединение с БД установлено")
+        return db
+
+    def _close(self, db):
+        try:
+            db.close()
+        except Exception as e:
+            self.logger.error(f"Error closing connection: {e}")
+
+    def _acquire(self):
+        """Взять свободное соединение из пула или место под новое соединение"""
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Нет свободных соединений с БД (max_size={self.max_size})")
+                self._condition.wait(remaining)
+
+    def _checkout(self):
+        db, released_at = self._acquire()
+        self._count('checkouts')
+        try:
+            if db is not None and time.monotonic() - released_at > self.probe_idle_seconds:
+                self._count('probes')
+                if not self._is_alive(db):
+                    self.logger.info("Соединение с БД потеряно, переподключение")
+                    self._count('disconnects')
+                    self._close(db)
+                    db = None
+            if db is None:
+                db = self._open()
+        except BaseException:
+            self._release_slot()
+            raise
+        return db
+
+    def _checkin(self, db):
+        try:
+            # Не оставляем в пуле соединений с незавершённой транзакцией
+            if getattr(db, 'in_transaction', True):
+                db.rollback()
+        except Exception as e:
+            self.logger.error(f"Error resetting connection: {e}")
+            self._discard(db)
+            return
+        with self._condition:
+            self._idle.append((db, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, db):
+        self._close(db)
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """Соединение из пула на время блока with.
+        По выходу из блока незафиксированная транзакция откатывается, соединение возвращается в пул.
+        """
+        db = self._checkout()
+        broken = False
+        try:
+            yield db
+        except self._disconnect_errors:
+            broken = True
+            raise
+        finally:
+            if broken:
+                self._count('disconnects')
+                self._discard(db)
+                self._expire_idle()
+            else:
+                self._checkin(db)
+
+    def _expire_idle(self):
+        """Пометить свободные соединения для проверки при следующей выдаче.
+        Если одно соединение потеряно (например, сервер БД перезапускался), остальные, скорее всего, тоже.
+        """
+        with self._condition:
+            self._idle = [(db, float('-inf')) for db, _ in self._idle]
+
+    def run(self, operation, retry=True):
+        """Выполнение operation(db) на соединении из пула.
+        Если соединение оказалось потерянным, а операция идемпотентна (retry=True),
+        она повторяется один раз на новом соединении.
+        """
+        try:
+            with self.connection() as db:
+                return operation(db)
+        except self._disconnect_errors as e:
+            if not retry:
+                raise
+            self._count('retries')
+            self.logger.warning(f"Соединение с БД потеряно ({e}), повтор запроса. Счётчики пула: {self.stats()}")
+        with self.connection() as db:
+            return operation(db)
+
+    def close(self):
+        """Закрытие всех свободных соединений"""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for db, _ in idle:
+            self._close(db)
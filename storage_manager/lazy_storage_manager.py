@@ -0,0 +1,61 @@
+import threading
+import time
+
+
+class StorageUnavailable(Exception):
+    """Хранилище ещё не готово: БД недоступна или не закончены миграции схемы"""
+
+
+class LazyStorageManager:
+    """Хранилище, которое создаётся в фоновом потоке, - бот запускается, не дожидаясь БД.
+    create() строит хранилище целиком (соединение с БД, миграции схемы); при ошибке попытка повторяется
+    с растущей паузой. Пока хранилище не готово, обращение к любому его атрибуту выбрасывает StorageUnavailable,
+    готовность показывают ready и status().
+    """
+
+    def __init__(self, create, logger, retry_seconds=1, max_retry_seconds=30):
+        self.logger = logger
+        self.storage = None
+        self.error = None  # ошибка последней попытки создания
+        self._create = create
+        self._ready = threading.Event()
+        threading.Thread(target=self._start, args=(retry_seconds, max_retry_seconds), name='storage-start',
+                         daemon=True).start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def status(self):
+        """'ready', 'starting' или 'unavailable: <ошибка последней попытки>'"""
+        if self.ready:
+            return 'ready'
+        error = self.error
+        return 'starting' if error is None else f"unavailable: {error}"
+
+    def wait(self, timeout=None):
+        """Дождаться готовности хранилища; False, если не дождались за timeout секунд"""
+        return self._ready.wait(timeout)
+
+    def _start(self, retry_seconds, max_retry_seconds):
+        started = time.monotonic()
+        delay = retry_seconds
+        while True:
+            try:
+                storage = self._create()
+            except Exception as e:
+                self.error = e
+                self.logger.error(f"Хранилище недоступно ({e}), повтор через {delay} с")
+                time.sleep(delay)
+                delay = min(delay * 2, max_retry_seconds)
+                continue
+            self.storage, self.error = storage, None
+            self._ready.set()
+            self.logger.info(f"Хранилище готово за {time.monotonic() - started:.2f} с")
+            return
+
+    def __getattr__(self, name):
+        storage = self.__dict__.get('storage')
+        if storage is None:
+            raise StorageUnavailable(f"Хранилище не готово ({self.status()})")
+        return getattr(storage, name)
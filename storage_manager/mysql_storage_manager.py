@@ -1,100 +1,489 @@
 import csv
+import io
+import tempfile
 
 import mysql.connector
 
-from storage_manager import Song, StorageManager
+from storage_manager import BACKUP_DIFFERENTIAL, BACKUP_FETCH_SIZE, BACKUP_FULL, BACKUP_OVERLAP_SECONDS, \
+    BACKUP_SPOOL_SIZE, BULK_BATCH_SIZE, MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT, STATS_RECENT_LIMIT, BulkInsertResult, \
+    RepertuarStats, Song, SongRequest, StorageManager, normalize_tag, open_backup_stream, split_tags
+from storage_manager.connection_pool import ConnectionPool
+from storage_manager.song_deck import SongDeck
 
 
 class MysqlStorageManager(StorageManager):
 
-    def __init__(self, logger, mysql_connection_params):
+    def __init__(self, logger, mysql_connection_params, pool_params=None):
         self.logger = logger
         self.connection_params = mysql_connection_params
-        self.db = None
-        self.cursor = None
-        self.connect_if_need()
-        # Создание таблицы 'repertuar', если её нет
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS repertuar (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                title VARCHAR(255) DEFAULT '',
-                artist VARCHAR(255) DEFAULT '',
-                tags VARCHAR(255) DEFAULT '',
-                open_time TIMESTAMP DEFAULT NOW(),
-                content TEXT,
-                mark INT DEFAULT 0,
-                UNIQUE(title, artist)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
-        """);
+        self.pool = ConnectionPool(logger, self.connect, self.is_connected,
+                                   (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError),
+                                   **(pool_params or {}))
+        self.deck = SongDeck(self.get_song_marks, self.save_last_shown)
+        self.migrate()
 
-    def __deinit__(self):
-        self.cursor.close()
-        self.db.close()
+    def migrations(self):
+        def copy_tags(cursor):
+            # Перенос тегов из столбца repertuar.tags (если song_tags ещё пуста)
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM song_tags)")
+            if not cursor.fetchone()[0]:
+                cursor.execute("SELECT id, tags FROM repertuar WHERE tags <> ''")
+                self.save_song_tags(cursor, cursor.fetchall())
 
-    # Функция для проверки  соединения
-    def is_connected(self):
-        if self.db is not None and self.cursor is not None:
+        def has_index(cursor, table, name):
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.statistics
+                WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            """, (table, name))
+            return cursor.fetchone()[0] > 0
+
+        def add_index(name, sql, table='repertuar'):
+            # В MySQL нет CREATE INDEX IF NOT EXISTS
+            def step(cursor):
+                if not has_index(cursor, table, name):
+                    cursor.execute(sql)
+            return step
+
+        def drop_index(table, name):
+            def step(cursor):
+                if has_index(cursor, table, name):
+                    cursor.execute(f"ALTER TABLE {table} DROP INDEX {name}")
+            return step
+
+        def add_column(table, name, definition):
+            # В MySQL нет ADD COLUMN IF NOT EXISTS
+            def step(cursor):
+                cursor.execute("""
+                    SELECT COUNT(*) FROM information_schema.columns
+                    WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+                """, (table, name))
+                if not cursor.fetchone()[0]:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            return step
+
+        return [
+            ("таблица repertuar", ["""
+                CREATE TABLE IF NOT EXISTS repertuar (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    title VARCHAR(255) DEFAULT '',
+                    artist VARCHAR(255) DEFAULT '',
+                    tags VARCHAR(255) DEFAULT '',
+                    open_time TIMESTAMP DEFAULT NOW(),
+                    content TEXT,
+                    mark INT DEFAULT 0,
+                    UNIQUE(title, artist)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """]),
+            # Нормализованные теги: справочник тегов и связь композиций с тегами.
+            # Имена тегов сравниваются побайтно, чтобы "ёлка" и "елка" оставались разными тегами
+            ("нормализованные теги", ["""
+                CREATE TABLE IF NOT EXISTS tags (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    name VARCHAR(255) COLLATE utf8mb4_bin NOT NULL,
+                    UNIQUE(name)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """, """
+                CREATE TABLE IF NOT EXISTS song_tags (
+                    song_id INT NOT NULL,
+                    tag_id INT NOT NULL,
+                    PRIMARY KEY (song_id, tag_id),
+                    KEY song_tags_tag_id_idx (tag_id, song_id),
+                    FOREIGN KEY (song_id) REFERENCES repertuar (id) ON DELETE CASCADE,
+                    FOREIGN KEY (tag_id) REFERENCES tags (id) ON DELETE CASCADE
+                ) ENGINE=InnoDB;
+            """, copy_tags]),
+            # Полнотекстовый индекс для поиска по названию и исполнителю (n-граммы - для кириллицы и частей слов)
+            ("индекс поиска", [add_index('repertuar_search_idx', "ALTER TABLE repertuar ADD FULLTEXT INDEX "
+                                                                 "repertuar_search_idx (title, artist) "
+                                                                 "WITH PARSER ngram")]),
+            # Заказы композиций слушателями: очередь для сводок администратору
+            ("заказы композиций", ["""
+                CREATE TABLE IF NOT EXISTS song_requests (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    username VARCHAR(255),
+                    composition VARCHAR(255) NOT NULL,
+                    status VARCHAR(16) NOT NULL DEFAULT 'new',
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    KEY song_requests_status_created_at_idx (status, created_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """]),
+            # Состояния многошаговых диалогов (см. storage_manager/state_store.py)
+            ("состояния диалогов", ["""
+                CREATE TABLE IF NOT EXISTS chat_states (
+                    chat_id BIGINT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    expires_at DATETIME NOT NULL,
+                    KEY chat_states_expires_at_idx (expires_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """]),
+            # Контрольные точки бэкапов и индекс по времени изменения композиций для частичных бэкапов
+            ("контрольные точки бэкапов", ["""
+                CREATE TABLE IF NOT EXISTS backups (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    kind VARCHAR(16) NOT NULL,
+                    started_at DATETIME NOT NULL
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """, add_index('repertuar_open_time_idx',
+                           "CREATE INDEX repertuar_open_time_idx ON repertuar (open_time)")]),
+            # Сводные таблицы для статистики: количество композиций по тегам и по оценкам
+            ("сводные таблицы статистики", ["""
+                CREATE TABLE IF NOT EXISTS tag_stats (
+                    name VARCHAR(255) COLLATE utf8mb4_bin PRIMARY KEY,
+                    songs INT NOT NULL
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """, """
+                CREATE TABLE IF NOT EXISTS mark_stats (
+                    mark INT PRIMARY KEY,
+                    songs INT NOT NULL
+                ) ENGINE=InnoDB;
+            """, self.rebuild_stats]),
+            # Время последнего показа композиции - для взвешенного случайного выбора (см. SongDeck)
+            ("время показа композиций", [add_column('repertuar', 'last_shown', "DATETIME NULL")]),
+            # Репертуары нескольких владельцев (музыкантов) в одной БД: owner_id у композиций, заказов
+            # и контрольных точек бэкапов, составные индексы с owner_id в начале.
+            # title - имя, которое MySQL дал уникальному ключу UNIQUE(title, artist)
+            ("владельцы репертуаров", [
+                add_column('repertuar', 'owner_id', "INT NOT NULL DEFAULT 0"),
+                add_index('repertuar_owner_title_artist_idx',
+                          "CREATE UNIQUE INDEX repertuar_owner_title_artist_idx "
+                          "ON repertuar (owner_id, title, artist)"),
+                drop_index('repertuar', 'title'),
+                add_index('repertuar_owner_open_time_idx',
+                          "CREATE INDEX repertuar_owner_open_time_idx ON repertuar (owner_id, open_time)"),
+                drop_index('repertuar', 'repertuar_open_time_idx'),
+                add_column('song_requests', 'owner_id', "INT NOT NULL DEFAULT 0"),
+                add_index('song_requests_owner_status_created_at_idx',
+                          "CREATE INDEX song_requests_owner_status_created_at_idx "
+                          "ON song_requests (owner_id, status, created_at)", 'song_requests'),
+                drop_index('song_requests', 'song_requests_status_created_at_idx'),
+                add_column('backups', 'owner_id', "INT NOT NULL DEFAULT 0"),
+                add_index('backups_owner_kind_started_at_idx',
+                          "CREATE INDEX backups_owner_kind_started_at_idx ON backups (owner_id, kind, started_at)",
+                          'backups'),
+                # Владелец, которого выбрал чат слушателя (ссылкой на музыканта)
+                """
+                    CREATE TABLE IF NOT EXISTS chat_owners (
+                        chat_id BIGINT PRIMARY KEY,
+                        owner_id INT NOT NULL
+                    ) ENGINE=InnoDB;
+                """,
+                # Сводные таблицы пересоздаются с владельцем в первичном ключе и заполняются заново
+                "DROP TABLE IF EXISTS tag_stats, mark_stats", """
+                    CREATE TABLE tag_stats (
+                        owner_id INT NOT NULL,
+                        name VARCHAR(255) COLLATE utf8mb4_bin NOT NULL,
+                        songs INT NOT NULL,
+                        PRIMARY KEY (owner_id, name)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """, """
+                    CREATE TABLE mark_stats (
+                        owner_id INT NOT NULL,
+                        mark INT NOT NULL,
+                        songs INT NOT NULL,
+                        PRIMARY KEY (owner_id, mark)
+                    ) ENGINE=InnoDB;
+                """, self.rebuild_stats]),
+            # Чат администратора владельца - для сводок заказов из любого процесса и после перезапуска
+            ("чаты администраторов", ["""
+                CREATE TABLE IF NOT EXISTS admin_chats (
+                    owner_id INT PRIMARY KEY,
+                    chat_id BIGINT NOT NULL
+                ) ENGINE=InnoDB;
+            """]),
+        ]
+
+    def migrate(self):
+        with self.pool.connection() as db, db.cursor() as cursor:
+            # Именованная блокировка сеанса: другой процесс дождётся её и увидит уже применённые миграции
+            cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+            if not cursor.fetchone()[0]:
+                raise RuntimeError(f"Не дождались блокировки {MIGRATION_LOCK} для миграций схемы БД")
             try:
-                self.cursor.execute("SELECT 1")
-                result = self.cursor.fetchone()
-                if result is not None:
-                    return True
-            except mysql.connector.Error as e:
-                self.logger.error(f"Error checking connection: {e}")
-            except Exception as e:
-                self.logger.error(f"Unknown error in is_connected: {e}")
-        return False
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INT PRIMARY KEY,
+                        description VARCHAR(255) NOT NULL,
+                        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                # DDL в MySQL фиксируется сразу, поэтому и номер миграции фиксируется сразу после неё
+                version = self.apply_migrations(cursor, cursor.fetchone()[0],
+                                                "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                                                db.commit)
+                db.commit()
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+                cursor.fetchone()
+        return version
+
+    def __deinit__(self):
+        self.pool.close()
 
     # Подключение к базе данных MySQL
-    def connect_if_need(self):
-        if not self.is_connected():
-            self.logger.info("Попытка соединения с БД")
-            self.db = mysql.connector.connect(**self.connection_params)
-            self.cursor = self.db.cursor()
-            self.logger.info("Соединение с БД установлено")
+    def connect(self):
+        return mysql.connector.connect(**self.connection_params)
+
+    # Функция для проверки  соединения
+    def is_connected(self, db):
+        try:
+            with db.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                return cursor.fetchone() is not None
+        except mysql.connector.Error as e:
+            self.logger.error(f"Error checking connection: {e}")
+        except Exception as e:
+            self.logger.error(f"Unknown error in is_connected: {e}")
+        return False
 
     def get_songs_count(self):
-        self.connect_if_need()
-        self.cursor.execute("SELECT COUNT(*) FROM repertuar")
-        return self.cursor.fetchone()[0]
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(SUM(songs), 0) FROM mark_stats WHERE owner_id = %s", (self.owner_id,))
+                return int(cursor.fetchone()[0])
+        return self.pool.run(query)
 
-    def get_tags(self):
-        self.connect_if_need()
-        self.cursor.execute("""
-            SELECT DISTINCT tag
-            FROM repertuar,
-                JSON_TABLE(
-                    CONCAT('["', REPLACE(tags, ',', '","'), '"]'),
-                    "$[*]" COLUMNS(
-                        tag VARCHAR(255) PATH "$"
-                    )
-                ) AS tags;
+    def get_stats(self, recent_limit=STATS_RECENT_LIMIT):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT mark, songs FROM mark_stats WHERE owner_id = %s AND songs > 0 ORDER BY mark",
+                               (self.owner_id,))
+                marks = cursor.fetchall()
+                cursor.execute("SELECT name, songs FROM tag_stats WHERE owner_id = %s AND songs > 0 "
+                               "ORDER BY songs DESC, name", (self.owner_id,))
+                tags = cursor.fetchall()
+                cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar WHERE owner_id = %s "
+                               "ORDER BY open_time DESC, id DESC LIMIT %s", (self.owner_id, recent_limit))
+                return marks, tags, cursor.fetchall()
+        marks, tags, recent = self.pool.run(query)
+        return RepertuarStats(sum(songs for _, songs in marks), marks, tags, [Song(*row) for row in recent])
+
+    def save_stats(self, cursor, tag_deltas, mark_deltas):
+        """Применение изменений (см. stats_deltas) к сводкам владельца в tag_stats и mark_stats"""
+        for table, key, deltas in (('tag_stats', 'name', tag_deltas), ('mark_stats', 'mark', mark_deltas)):
+            for start in range(0, len(deltas), BULK_BATCH_SIZE):
+                chunk = deltas[start:start + BULK_BATCH_SIZE]
+                cursor.execute(f"INSERT INTO {table} (owner_id, {key}, songs) VALUES "
+                               + ", ".join(["(%s, %s, %s)"] * len(chunk))
+                               + " ON DUPLICATE KEY UPDATE songs = songs + VALUES(songs)",
+                               [value for item in chunk for value in (self.owner_id, *item)])
+
+    def rebuild_stats(self, cursor):
+        """Пересчёт сводных таблиц всех владельцев по repertuar и song_tags.
+        Из миграции "сводные таблицы статистики" вызывается до появления owner_id - тогда без владельцев
+        """
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = 'tag_stats' AND column_name = 'owner_id'
         """)
-        tag_list = ', '.join([row[0] for row in self.cursor.fetchall()])
-        return tag_list
+        column, owner = ("owner_id, ", "r.owner_id, ") if cursor.fetchone()[0] else ("", "")
+        # DELETE блокирует строки сводок: пишущие транзакции применяют свои изменения после пересчёта
+        cursor.execute("DELETE FROM tag_stats")
+        cursor.execute("DELETE FROM mark_stats")
+        cursor.execute(f"""
+            INSERT INTO tag_stats ({column}name, songs)
+            SELECT {owner}tags.name, COUNT(*) FROM song_tags
+            JOIN tags ON tags.id = song_tags.tag_id
+            JOIN repertuar r ON r.id = song_tags.song_id
+            GROUP BY {owner}tags.name
+        """)
+        cursor.execute(f"""
+            INSERT INTO mark_stats ({column}mark, songs)
+            SELECT {owner}COALESCE(r.mark, 0), COUNT(*) FROM repertuar r GROUP BY {owner}COALESCE(r.mark, 0)
+        """)
+
+    def refresh_stats(self):
+        def query(db):
+            with db.cursor() as cursor:
+                self.rebuild_stats(cursor)
+            db.commit()
+        self.pool.run(query)
 
-    def get_random_song(self) -> Song:
-        self.connect_if_need()
-        self.cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar ORDER BY RAND() LIMIT 1")
-        result = self.cursor.fetchone()
+    def save_song_tags(self, cursor, songs):
+        """Заполнение tags и song_tags для пар (идентификатор композиции, строка тегов через запятую)"""
+        pairs = [(song_id, name) for song_id, tags in songs for name in split_tags(tags)]
+        if not pairs:
+            return
+        names = sorted({name for _, name in pairs})
+        tag_ids = {}
+        for start in range(0, len(names), BULK_BATCH_SIZE):
+            chunk = names[start:start + BULK_BATCH_SIZE]
+            cursor.execute("INSERT INTO tags (name) VALUES " + ", ".join(["(%s)"] * len(chunk))
+                           + " ON DUPLICATE KEY UPDATE id = id", chunk)
+            cursor.execute("SELECT name, id FROM tags WHERE name IN (" + ", ".join(["%s"] * len(chunk)) + ")",
+                           chunk)
+            tag_ids.update(cursor.fetchall())
+        for start in range(0, len(pairs), BULK_BATCH_SIZE):
+            chunk = pairs[start:start + BULK_BATCH_SIZE]
+            cursor.execute("INSERT INTO song_tags (song_id, tag_id) VALUES "
+                           + ", ".join(["(%s, %s)"] * len(chunk)) + " ON DUPLICATE KEY UPDATE tag_id = tag_id",
+                           [value for song_id, name in chunk for value in (song_id, tag_ids[name])])
+
+    def get_tags(self):
+        def query(db):
+            with db.cursor() as cursor:
+                # Теги с композициями владельца - по его сводке tag_stats
+                cursor.execute("SELECT name FROM tag_stats WHERE owner_id = %s AND songs > 0 ORDER BY name",
+                               (self.owner_id,))
+                return ', '.join([row[0] for row in cursor.fetchall()])
+        return self.pool.run(query)
+
+    def get_tag_counts(self):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT name, songs FROM tag_stats WHERE owner_id = %s AND songs > 0 "
+                               "ORDER BY songs DESC, name", (self.owner_id,))
+                return cursor.fetchall()
+        return self.pool.run(query)
+
+    def get_songs_by_tag(self, tag, limit=50):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT r.id, r.title, r.artist, r.tags, r.mark FROM tags
+                    JOIN song_tags st ON st.tag_id = tags.id
+                    JOIN repertuar r ON r.id = st.song_id
+                    WHERE tags.name = %s AND r.owner_id = %s
+                    ORDER BY r.artist, r.title
+                    LIMIT %s;
+                """, (normalize_tag(tag), self.owner_id, limit))
+                return cursor.fetchall()
+        return [Song(*row) for row in self.pool.run(query)]
+
+    def get_random_song_by_tag(self, tag):
+        # Сортируются только композиции владельца с этим тегом, найденные по индексу song_tags_tag_id_idx
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT r.id, r.title, r.artist, r.tags, r.mark FROM tags
+                    JOIN song_tags st ON st.tag_id = tags.id
+                    JOIN repertuar r ON r.id = st.song_id
+                    WHERE tags.name = %s AND r.owner_id = %s
+                    ORDER BY RAND() LIMIT 1;
+                """, (tag, self.owner_id))
+                return cursor.fetchone()
+        result = self.pool.run(query)
+        if result is not None:
+            return Song(*result)
+
+    def get_song_marks(self):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT id, mark, TIMESTAMPDIFF(SECOND, last_shown, NOW()) FROM repertuar "
+                               "WHERE owner_id = %s", (self.owner_id,))
+                return cursor.fetchall()
+        return self.pool.run(query)
+
+    def save_last_shown(self, shown):
+        # Повтор безопасен: то же время показа записывается повторно
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.executemany("""
+                    UPDATE repertuar SET last_shown = NOW() - INTERVAL %(age)s SECOND
+                    WHERE id = %(id)s AND (last_shown IS NULL OR last_shown < NOW() - INTERVAL %(age)s SECOND)
+                """, [dict(id=song_id, age=round(age)) for song_id, age in sorted(shown.items())])
+            db.commit()
+        if shown:
+            self.pool.run(query)
+
+    def get_song(self, song_id) -> Song:
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar WHERE id = %s AND owner_id = %s",
+                               (song_id, self.owner_id))
+                return cursor.fetchone()
+        result = self.pool.run(query)
         if result is not None:
             id, title, artist, tags, mark = result
             return Song(id, title, artist, tags, mark)
 
+    def get_songs(self, song_ids):
+        song_ids = list(song_ids)
+
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar WHERE owner_id = %s AND id IN ("
+                               + ", ".join(["%s"] * len(song_ids)) + ")", [self.owner_id] + song_ids)
+                return cursor.fetchall()
+        return [Song(*row) for row in self.pool.run(query)] if song_ids else []
+
+    def search_songs(self, query, limit=10, offset=0):
+        query = query.strip()
+
+        def search(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT id, title, artist, tags, mark FROM repertuar
+                    WHERE owner_id = %(owner_id)s
+                      AND MATCH (title, artist) AGAINST (%(query)s IN NATURAL LANGUAGE MODE)
+                    ORDER BY MATCH (title, artist) AGAINST (%(query)s IN NATURAL LANGUAGE MODE) DESC,
+                             artist, title
+                    LIMIT %(limit)s OFFSET %(offset)s;
+                """, dict(query=query, limit=limit, offset=offset, owner_id=self.owner_id))
+                return cursor.fetchall()
+        return [Song(*row) for row in self.pool.run(search)] if query else []
+
     def update_rating(self, song_id, mark):
-        self.connect_if_need()
-        self.cursor.execute("UPDATE repertuar SET mark = %s, open_time = NOW() WHERE id = %s", (mark, song_id))
-        rows_updated = self.cursor.rowcount
-        self.db.commit()
+        # Повтор безопасен: повторная установка той же оценки ничего не меняет
+        def query(db):
+            with db.cursor() as cursor:
+                # Прежняя оценка - для сводной таблицы mark_stats; строка блокируется до конца транзакции
+                cursor.execute("SELECT mark FROM repertuar WHERE id = %s AND owner_id = %s FOR UPDATE",
+                               (song_id, self.owner_id))
+                old_marks = cursor.fetchall()
+                cursor.execute("UPDATE repertuar SET mark = %s, open_time = NOW() WHERE id = %s AND owner_id = %s",
+                               (mark, song_id, self.owner_id))
+                rows_updated = cursor.rowcount
+                self.save_stats(cursor, *self.stats_deltas([(None, old_mark) for old_mark, in old_marks],
+                                                           [(None, mark)] * len(old_marks)))
+            db.commit()
+            return rows_updated
+        rows_updated = self.pool.run(query)
+        self.deck.set_mark(song_id, mark)
+        return rows_updated
+
+    def update_ratings(self, marks):
+        marks = dict(marks)
+        if not marks:
+            return 0
+
+        def query(db):
+            with db.cursor() as cursor:
+                # Прежние оценки изменяемых композиций - для mark_stats (блокировка в порядке идентификаторов)
+                cursor.execute("SELECT id, mark FROM repertuar WHERE owner_id = %s AND id IN ("
+                               + ", ".join(["%s"] * len(marks)) + ") ORDER BY id FOR UPDATE",
+                               [self.owner_id] + list(marks))
+                changed = [(song_id, old_mark) for song_id, old_mark in cursor.fetchall() if old_mark != marks[song_id]]
+                cursor.executemany("UPDATE repertuar SET mark = %s, open_time = NOW() "
+                                   "WHERE id = %s AND owner_id = %s AND mark <> %s",
+                                   [(mark, song_id, self.owner_id, mark) for song_id, mark in marks.items()])
+                rows_updated = cursor.rowcount
+                self.save_stats(cursor, *self.stats_deltas([(None, old_mark) for _, old_mark in changed],
+                                                           [(None, marks[song_id]) for song_id, _ in changed]))
+            db.commit()
+            return rows_updated
+        rows_updated = self.pool.run(query)
+        for song_id, mark in marks.items():
+            self.deck.set_mark(song_id, mark)
         return rows_updated
 
     def add_song(self, title, artist, tags, mark=0):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO repertuar (owner_id, title, artist, tags, mark) VALUES (%s, %s, %s, %s, %s)",
+                    (self.owner_id, title, artist, tags, mark))
+                song_id = cursor.lastrowid
+                self.save_song_tags(cursor, [(song_id, tags)])
+                self.save_stats(cursor, *self.stats_deltas([], [(tags, mark)]))
+            db.commit()
+            return song_id
+
         try:
-            self.connect_if_need()
-            self.cursor.execute(
-                "INSERT INTO repertuar (title, artist, tags, mark) VALUES (%s, %s, %s, %s)",
-                (title, artist, tags, mark))
-            self.db.commit()
+            # Без повтора: при обрыве после фиксации повторная вставка дала бы ложный дубль
+            song_id = self.pool.run(query, retry=False)
+            self.deck.add([(song_id, mark)])
             return 0
         except mysql.connector.errors.IntegrityError as e:
             self.logger.error(e)
@@ -106,18 +495,273 @@ class MysqlStorageManager(StorageManager):
             self.logger.error(e)
         return 99
 
-    def backup(self, file_path):
-        """Выгрузка всех композиций в CSV файл."""
-        self.connect_if_need()
-        self.cursor.execute("SELECT title, artist, tags, mark FROM repertuar")
-        rows = self.cursor.fetchall()
-
-        # Запись данных в CSV файл
-        with open(file_path, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file, delimiter=';')  # Используем точку с запятой в качестве разделителя
-            # Запись данных
-            for row in rows:
-                writer.writerow(row)
-
-        self.logger.info(f"Бэкап завершён. Файл сохранен по пути: {file_path}")
-        return file_path
+    def add_songs_bulk(self, rows):
+        result = BulkInsertResult()
+        songs = self.prepare_bulk_rows(rows, result, self.logger)
+        if not songs:
+            return result
+        return self.load_songs_bulk(self.bulk_batches(songs), result, self.insert_batch)
+
+    def upsert_songs_bulk(self, rows, progress=None):
+        result = BulkInsertResult()
+        songs = self.iter_bulk_rows(rows, result, self.logger)
+        return self.load_songs_bulk(self.upsert_batches(songs, result), result, self.upsert_batch, progress)
+
+    def select_batch(self, cursor, batch):
+        """Сохранённые композиции пачки: идентификатор -> (оценка, теги)"""
+        cursor.execute(
+            "SELECT id, mark, tags FROM repertuar WHERE (owner_id, title, artist) IN ("
+            + ", ".join(["(%s, %s, %s)"] * len(batch)) + ")",
+            [value for song in batch for value in (self.owner_id, *song[:2])])
+        return {song_id: (mark, tags) for song_id, mark, tags in cursor.fetchall()}
+
+    def insert_batch(self, cursor, batch):
+        """Вставка пачки без дублей; возвращает добавленные и изменённые пары (идентификатор, оценка)"""
+        # Дубли пропускает ON DUPLICATE KEY UPDATE, а не INSERT IGNORE: IGNORE превращает в предупреждения и
+        # прочие ошибки (слишком длинное название обрезалось бы и считалось дублем), а так ошибка откатывает
+        # пачку и считается ошибкой БД. Идентификаторы добавленных строк многострочная вставка не сообщает -
+        # они находятся по ключу как отсутствовавшие до вставки
+        before = self.select_batch(cursor, batch)
+        cursor.execute(
+            "INSERT INTO repertuar (owner_id, title, artist, tags, mark) VALUES "
+            + ", ".join(["(%s, %s, %s, %s, %s)"] * len(batch))
+            + " ON DUPLICATE KEY UPDATE id = id",
+            [value for song in batch for value in (self.owner_id, *song)])
+        inserted = [(song_id, mark, tags) for song_id, (mark, tags) in self.select_batch(cursor, batch).items()
+                    if song_id not in before]
+        self.save_song_tags(cursor, [(song_id, tags) for song_id, _, tags in inserted])
+        self.save_stats(cursor, *self.stats_deltas([], [(tags, mark) for _, mark, tags in inserted]))
+        return [(song_id, mark) for song_id, mark, _ in inserted], []
+
+    def upsert_batch(self, cursor, batch):
+        """Вставка пачки с обновлением тегов и оценок сохранённых композиций, если они отличаются"""
+        before = self.select_batch(cursor, batch)
+        # open_time присваивается первым: в ON DUPLICATE KEY UPDATE столбцы меняются слева направо
+        cursor.execute(
+            "INSERT INTO repertuar (owner_id, title, artist, tags, mark) VALUES "
+            + ", ".join(["(%s, %s, %s, %s, %s)"] * len(batch))
+            + " ON DUPLICATE KEY UPDATE"
+              " open_time = IF(mark <=> VALUES(mark) AND tags <=> VALUES(tags), open_time, NOW()),"
+              " tags = VALUES(tags), mark = VALUES(mark)",
+            [value for song in batch for value in (self.owner_id, *song)])
+        after = self.select_batch(cursor, batch)
+        added = [(song_id, mark) for song_id, (mark, _) in after.items() if song_id not in before]
+        updated = [(song_id, mark) for song_id, (mark, tags) in after.items()
+                   if song_id in before and before[song_id] != (mark, tags)]
+        if updated:
+            cursor.execute("DELETE FROM song_tags WHERE song_id IN (" + ", ".join(["%s"] * len(updated)) + ")",
+                           [song_id for song_id, _ in updated])
+        self.save_song_tags(cursor, [(song_id, after[song_id][1]) for song_id, _ in added + updated])
+        removed = [before[song_id] for song_id, _ in updated]
+        self.save_stats(cursor, *self.stats_deltas([(tags, mark) for mark, tags in removed],
+                                                   [(after[song_id][1], mark) for song_id, mark in added + updated]))
+        return added, updated
+
+    def load_songs_bulk(self, batches, result, load_batch, progress=None):
+        """Загрузка пачек композиций в одной транзакции через load_batch(cursor, batch)"""
+        songs_added, songs_updated = [], []
+        try:
+            with self.pool.connection() as db, db.cursor() as cursor:
+                for batch in batches:
+                    # Точка сохранения, чтобы ошибка в одной пачке не откатывала всю загрузку
+                    cursor.execute("SAVEPOINT bulk_batch")
+                    try:
+                        added, updated = load_batch(cursor, batch)
+                    except mysql.connector.errors.DatabaseError as e:
+                        self.logger.error(e)
+                        cursor.execute("ROLLBACK TO SAVEPOINT bulk_batch")
+                        result.db_errors += len(batch)
+                        continue
+                    cursor.execute("RELEASE SAVEPOINT bulk_batch")
+                    songs_added.extend(added)
+                    songs_updated.extend(updated)
+                    result.success += len(added) + len(updated)
+                    result.duplicates += len(batch) - len(added) - len(updated)
+                    if progress is not None:
+                        progress(result)
+                db.commit()
+            self.deck.add(songs_added)
+            for song_id, mark in songs_updated:
+                self.deck.set_mark(song_id, mark)
+        except mysql.connector.errors.DatabaseError as e:
+            self.logger.error(e)
+            # Транзакция не зафиксирована - всё, что считалось добавленным, не сохранилось
+            result.db_errors += result.success
+            result.success = 0
+        return result
+
+    def add_song_request(self, chat_id, username, composition):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("INSERT INTO song_requests (owner_id, chat_id, username, composition) "
+                               "VALUES (%s, %s, %s, %s)", (self.owner_id, chat_id, username, composition[:255]))
+                request_id = cursor.lastrowid
+            db.commit()
+            return request_id
+        # Без повтора: при обрыве после фиксации заказ сохранился бы дважды
+        return self.pool.run(query, retry=False)
+
+    def claim_song_requests(self, limit):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT id, chat_id, username, composition, created_at FROM song_requests
+                    WHERE owner_id = %s AND status = 'new'
+                    ORDER BY created_at, id
+                    LIMIT %s FOR UPDATE SKIP LOCKED;
+                """, (self.owner_id, limit))
+                rows = cursor.fetchall()
+                if rows:
+                    cursor.execute("UPDATE song_requests SET status = 'sent' WHERE id IN ("
+                                   + ", ".join(["%s"] * len(rows)) + ")", [row[0] for row in rows])
+            db.commit()
+            return rows
+        return [SongRequest(request_id, chat_id, username, composition, 'sent', created_at)
+                for request_id, chat_id, username, composition, created_at in self.pool.run(query)]
+
+    def set_song_requests_status(self, request_ids, status):
+        request_ids = list(request_ids)
+        if not request_ids:
+            return 0
+
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("UPDATE song_requests SET status = %s WHERE owner_id = %s AND id IN ("
+                               + ", ".join(["%s"] * len(request_ids)) + ")", [status, self.owner_id] + request_ids)
+                rows_updated = cursor.rowcount
+            db.commit()
+            return rows_updated
+        return self.pool.run(query)
+
+    def get_pending_song_requests(self, limit=10, offset=0):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT id, chat_id, username, composition, status, created_at FROM song_requests
+                    WHERE owner_id = %s AND status IN ('new', 'sent')
+                    ORDER BY created_at, id
+                    LIMIT %s OFFSET %s;
+                """, (self.owner_id, limit, offset))
+                return cursor.fetchall()
+        return [SongRequest(*row) for row in self.pool.run(query)]
+
+    def get_state(self, chat_id):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT state FROM chat_states WHERE chat_id = %s AND expires_at > NOW()", (chat_id,))
+                return cursor.fetchone()
+        result = self.pool.run(query)
+        if result is not None:
+            return result[0]
+
+    def set_state(self, chat_id, state, ttl):
+        # Повтор безопасен: запись перезаписывает состояние целиком
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO chat_states (chat_id, state, expires_at)
+                    VALUES (%s, %s, NOW() + INTERVAL %s SECOND)
+                    ON DUPLICATE KEY UPDATE state = VALUES(state), expires_at = VALUES(expires_at);
+                """, (chat_id, state, ttl))
+            db.commit()
+        self.pool.run(query)
+
+    def delete_state(self, chat_id):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("DELETE FROM chat_states WHERE chat_id = %s", (chat_id,))
+            db.commit()
+        self.pool.run(query)
+
+    def purge_states(self):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("DELETE FROM chat_states WHERE expires_at <= NOW()")
+                rows_deleted = cursor.rowcount
+            db.commit()
+            return rows_deleted
+        return self.pool.run(query)
+
+    def get_chat_owner(self, chat_id):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT owner_id FROM chat_owners WHERE chat_id = %s", (chat_id,))
+                return cursor.fetchone()
+        result = self.pool.run(query)
+        if result is not None:
+            return result[0]
+
+    def set_chat_owner(self, chat_id, owner_id):
+        # Повтор безопасен: запись перезаписывает выбор целиком
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("INSERT INTO chat_owners (chat_id, owner_id) VALUES (%s, %s) "
+                               "ON DUPLICATE KEY UPDATE owner_id = VALUES(owner_id)", (chat_id, owner_id))
+            db.commit()
+        self.pool.run(query)
+
+    def get_admin_chat(self):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT chat_id FROM admin_chats WHERE owner_id = %s", (self.owner_id,))
+                return cursor.fetchone()
+        result = self.pool.run(query)
+        if result is not None:
+            return result[0]
+
+    def set_admin_chat(self, chat_id):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("INSERT INTO admin_chats (owner_id, chat_id) VALUES (%s, %s) "
+                               "ON DUPLICATE KEY UPDATE chat_id = VALUES(chat_id)", (self.owner_id, chat_id))
+            db.commit()
+        self.pool.run(query)
+
+    def backup_since(self, cursor, kind):
+        """Время, начиная с которого выгружаются изменения для бэкапа вида kind (None - выгружаются все)"""
+        if kind == BACKUP_FULL:
+            return None
+        cursor.execute("SELECT MAX(started_at) - INTERVAL %s SECOND FROM backups WHERE owner_id = %s"
+                       + (" AND kind = %s" if kind == BACKUP_DIFFERENTIAL else ""),
+                       (BACKUP_OVERLAP_SECONDS, self.owner_id, BACKUP_FULL) if kind == BACKUP_DIFFERENTIAL
+                       else (BACKUP_OVERLAP_SECONDS, self.owner_id))
+        return cursor.fetchone()[0]
+
+    def backup(self, compress=False, kind=BACKUP_FULL):
+        """Выгрузка композиций в CSV порциями по BACKUP_FETCH_SIZE строк, без загрузки таблицы в память"""
+        buffer = tempfile.SpooledTemporaryFile(BACKUP_SPOOL_SIZE)
+
+        def query(db):
+            # При повторе после обрыва соединения начинаем запись заново
+            buffer.seek(0)
+            buffer.truncate()
+            with db.cursor() as cursor, open_backup_stream(buffer, compress) as stream:
+                since = self.backup_since(cursor, kind)
+                # Контрольная точка - время до начала выгрузки, фиксируется вместе с ней
+                cursor.execute("INSERT INTO backups (owner_id, kind, started_at) VALUES (%s, %s, NOW())",
+                               (self.owner_id, kind if since is not None else BACKUP_FULL))
+                text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+                writer = csv.writer(text_stream, delimiter=';', lineterminator='\n')
+                # Изменения после контрольной точки находятся по индексу repertuar_owner_open_time_idx
+                if since is None:
+                    cursor.execute("SELECT title, artist, tags, mark FROM repertuar WHERE owner_id = %s ORDER BY id",
+                                   (self.owner_id,))
+                else:
+                    cursor.execute("SELECT title, artist, tags, mark FROM repertuar "
+                                   "WHERE owner_id = %s AND open_time >= %s ORDER BY id", (self.owner_id, since))
+                rows = cursor.fetchmany(BACKUP_FETCH_SIZE)
+                while rows:
+                    writer.writerows(rows)
+                    rows = cursor.fetchmany(BACKUP_FETCH_SIZE)
+                text_stream.flush()
+                text_stream.detach()  # stream закрывается не здесь
+            db.commit()
+
+        try:
+            self.pool.run(query)
+        except BaseException:
+            buffer.close()
+            raise
+        self.logger.info(f"Бэкап ({kind}) завершён. Размер: {buffer.tell()} байт")
+        buffer.seek(0)
+        return buffer
@@ -1,95 +1,441 @@
-import csv
+import tempfile
 
 import psycopg2
+import psycopg2.extras
 
-from storage_manager import Song, StorageManager
+from storage_manager import BACKUP_DIFFERENTIAL, BACKUP_FULL, BACKUP_OVERLAP_SECONDS, BACKUP_SPOOL_SIZE, \
+    BULK_BATCH_SIZE, MIGRATION_LOCK, STATS_RECENT_LIMIT, BulkInsertResult, RepertuarStats, Song, SongRequest, \
+    StorageManager, normalize_tag, open_backup_stream, split_tags
+from storage_manager.connection_pool import ConnectionPool
+from storage_manager.song_deck import SongDeck
 
 
 class PostgresqlStorageManager(StorageManager):
 
-    def __init__(self, logger, postgresql_connection_params):
+    def __init__(self, logger, postgresql_connection_params, pool_params=None):
         self.logger = logger
         self.connection_params = postgresql_connection_params
-        self.db = None
-        self.cursor = None
-        self.connect_if_need()
-        # Создание таблицы 'repertuar', если её нет
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS repertuar (
-                id SERIAL PRIMARY KEY,
-                title VARCHAR(255) NOT NULL,
-                artist VARCHAR(255) NOT NULL,
-                tags TEXT,
-                open_time TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW(),
-                content TEXT,
-                mark INT DEFAULT 0,
-                UNIQUE (title, artist)
-            );
-        """)
+        self.pool = ConnectionPool(logger, self.connect, self.is_connected,
+                                   (psycopg2.OperationalError, psycopg2.InterfaceError),
+                                   **(pool_params or {}))
+        self.deck = SongDeck(self.get_song_marks, self.save_last_shown)
+        self.migrate()
+
+    def migrations(self):
+        def copy_tags(cursor):
+            # Перенос тегов из столбца repertuar.tags (если song_tags ещё пуста)
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM song_tags)")
+            if not cursor.fetchone()[0]:
+                cursor.execute("SELECT id, tags FROM repertuar WHERE tags <> ''")
+                self.save_song_tags(cursor, cursor.fetchall())
+
+        return [
+            ("таблица repertuar", ["""
+                CREATE TABLE IF NOT EXISTS repertuar (
+                    id SERIAL PRIMARY KEY,
+                    title VARCHAR(255) NOT NULL,
+                    artist VARCHAR(255) NOT NULL,
+                    tags TEXT,
+                    open_time TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW(),
+                    content TEXT,
+                    mark INT DEFAULT 0,
+                    UNIQUE (title, artist)
+                );
+            """]),
+            # Нормализованные теги: справочник тегов и связь композиций с тегами
+            ("нормализованные теги", ["""
+                CREATE TABLE IF NOT EXISTS tags (
+                    id SERIAL PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL UNIQUE
+                );
+                CREATE TABLE IF NOT EXISTS song_tags (
+                    song_id INT NOT NULL REFERENCES repertuar (id) ON DELETE CASCADE,
+                    tag_id INT NOT NULL REFERENCES tags (id) ON DELETE CASCADE,
+                    PRIMARY KEY (song_id, tag_id)
+                );
+                CREATE INDEX IF NOT EXISTS song_tags_tag_id_idx ON song_tags (tag_id, song_id);
+            """, copy_tags]),
+            # Триграммный индекс для поиска по названию и исполнителю
+            ("индекс поиска", ["""
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE INDEX IF NOT EXISTS repertuar_search_trgm_idx
+                    ON repertuar USING GIN ((lower(title || ' ' || artist)) gin_trgm_ops);
+            """]),
+            # Заказы композиций слушателями: очередь для сводок администратору
+            ("заказы композиций", ["""
+                CREATE TABLE IF NOT EXISTS song_requests (
+                    id SERIAL PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    username VARCHAR(255),
+                    composition VARCHAR(255) NOT NULL,
+                    status VARCHAR(16) NOT NULL DEFAULT 'new',
+                    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS song_requests_status_created_at_idx
+                    ON song_requests (status, created_at);
+            """]),
+            # Состояния многошаговых диалогов (см. storage_manager/state_store.py)
+            ("состояния диалогов", ["""
+                CREATE TABLE IF NOT EXISTS chat_states (
+                    chat_id BIGINT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS chat_states_expires_at_idx ON chat_states (expires_at);
+            """]),
+            # Контрольные точки бэкапов и индекс по времени изменения композиций для частичных бэкапов
+            ("контрольные точки бэкапов", ["""
+                CREATE TABLE IF NOT EXISTS backups (
+                    id SERIAL PRIMARY KEY,
+                    kind VARCHAR(16) NOT NULL,
+                    started_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS repertuar_open_time_idx ON repertuar (open_time);
+            """]),
+            # Сводные таблицы для статистики: количество композиций по тегам и по оценкам
+            ("сводные таблицы статистики", ["""
+                CREATE TABLE IF NOT EXISTS tag_stats (
+                    name VARCHAR(255) PRIMARY KEY,
+                    songs INT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS mark_stats (
+                    mark INT PRIMARY KEY,
+                    songs INT NOT NULL
+                );
+            """, self.rebuild_stats]),
+            # Время последнего показа композиции - для взвешенного случайного выбора (см. SongDeck)
+            ("время показа композиций", [
+                "ALTER TABLE repertuar ADD COLUMN IF NOT EXISTS last_shown TIMESTAMP WITHOUT TIME ZONE"]),
+            # Репертуары нескольких владельцев (музыкантов) в одной БД: owner_id у композиций, заказов
+            # и контрольных точек бэкапов, составные индексы с owner_id в начале
+            ("владельцы репертуаров", ["""
+                ALTER TABLE repertuar ADD COLUMN IF NOT EXISTS owner_id INT NOT NULL DEFAULT 0;
+                CREATE UNIQUE INDEX IF NOT EXISTS repertuar_owner_title_artist_idx
+                    ON repertuar (owner_id, title, artist);
+                ALTER TABLE repertuar DROP CONSTRAINT IF EXISTS repertuar_title_artist_key;
+                CREATE INDEX IF NOT EXISTS repertuar_owner_open_time_idx ON repertuar (owner_id, open_time);
+                DROP INDEX IF EXISTS repertuar_open_time_idx;
+                ALTER TABLE song_requests ADD COLUMN IF NOT EXISTS owner_id INT NOT NULL DEFAULT 0;
+                CREATE INDEX IF NOT EXISTS song_requests_owner_status_created_at_idx
+                    ON song_requests (owner_id, status, created_at);
+                DROP INDEX IF EXISTS song_requests_status_created_at_idx;
+                ALTER TABLE backups ADD COLUMN IF NOT EXISTS owner_id INT NOT NULL DEFAULT 0;
+                CREATE INDEX IF NOT EXISTS backups_owner_kind_started_at_idx ON backups (owner_id, kind, started_at);
+                -- Владелец, которого выбрал чат слушателя (ссылкой на музыканта)
+                CREATE TABLE IF NOT EXISTS chat_owners (
+                    chat_id BIGINT PRIMARY KEY,
+                    owner_id INT NOT NULL
+                );
+                -- Сводные таблицы пересоздаются с владельцем в первичном ключе и заполняются заново
+                DROP TABLE IF EXISTS tag_stats, mark_stats;
+                CREATE TABLE tag_stats (
+                    owner_id INT NOT NULL,
+                    name VARCHAR(255) NOT NULL,
+                    songs INT NOT NULL,
+                    PRIMARY KEY (owner_id, name)
+                );
+                CREATE TABLE mark_stats (
+                    owner_id INT NOT NULL,
+                    mark INT NOT NULL,
+                    songs INT NOT NULL,
+                    PRIMARY KEY (owner_id, mark)
+                );
+            """, self.rebuild_stats]),
+            # Чат администратора владельца - для сводок заказов из любого процесса и после перезапуска
+            ("чаты администраторов", ["""
+                CREATE TABLE IF NOT EXISTS admin_chats (
+                    owner_id INT PRIMARY KEY,
+                    chat_id BIGINT NOT NULL
+                );
+            """]),
+        ]
+
+    def migrate(self):
+        with self.pool.connection() as db, db.cursor() as cursor:
+            # Блокировка до конца транзакции: другой процесс дождётся её и увидит уже применённые миграции
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (MIGRATION_LOCK,))
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW()
+                );
+            """)
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            version = self.apply_migrations(cursor, cursor.fetchone()[0],
+                                            "INSERT INTO schema_version (version, description) VALUES (%s, %s)")
+            db.commit()
+        return version
 
     def __deinit__(self):
-        self.cursor.close()
-        self.db.close()
+        self.pool.close()
+
+    # Подключение к базе данных PostgreSQL
+    def connect(self):
+        return psycopg2.connect(**self.connection_params)
 
     # Функция для проверки  соединения
-    def is_connected(self):
-        if self.db is not None and self.cursor is not None:
-            try:
-                self.cursor.execute("SELECT 1")
-                result = self.cursor.fetchone()
-                if result is not None:
-                    return True
-            except psycopg2.Error as e:
-                self.logger.error(f"Error checking connection: {e}")
-            except Exception as e:
-                self.logger.error(f"Unknown error in is_connected: {e}")
+    def is_connected(self, db):
+        try:
+            with db.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                return cursor.fetchone() is not None
+        except psycopg2.Error as e:
+            self.logger.error(f"Error checking connection: {e}")
+        except Exception as e:
+            self.logger.error(f"Unknown error in is_connected: {e}")
         return False
 
-    # Подключение к базе данных PostgreSQL
-    def connect_if_need(self):
-        if not self.is_connected():
-            self.logger.info("Попытка соединения с БД")
-            self.db = psycopg2.connect(**self.connection_params)
-            self.cursor = self.db.cursor()
-            self.logger.info("Соединение с БД установлено")
-
     def get_songs_count(self):
-        self.connect_if_need()
-        self.cursor.execute("SELECT COUNT(*) FROM repertuar")
-        return self.cursor.fetchone()[0]
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(SUM(songs), 0) FROM mark_stats WHERE owner_id = %s", (self.owner_id,))
+                return cursor.fetchone()[0]
+        return self.pool.run(query)
 
-    def get_tags(self):
-        self.connect_if_need()
-        self.cursor.execute("""
-            SELECT DISTINCT tag
-            FROM repertuar,
-                unnest(string_to_array(tags, ',')) AS tag;
+    def get_stats(self, recent_limit=STATS_RECENT_LIMIT):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT mark, songs FROM mark_stats WHERE owner_id = %s AND songs > 0 ORDER BY mark",
+                               (self.owner_id,))
+                marks = cursor.fetchall()
+                cursor.execute("SELECT name, songs FROM tag_stats WHERE owner_id = %s AND songs > 0 "
+                               "ORDER BY songs DESC, name", (self.owner_id,))
+                tags = cursor.fetchall()
+                cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar WHERE owner_id = %s "
+                               "ORDER BY open_time DESC, id DESC LIMIT %s", (self.owner_id, recent_limit))
+                return marks, tags, cursor.fetchall()
+        marks, tags, recent = self.pool.run(query)
+        return RepertuarStats(sum(songs for _, songs in marks), marks, tags, [Song(*row) for row in recent])
+
+    def save_stats(self, cursor, tag_deltas, mark_deltas):
+        """Применение изменений (см. stats_deltas) к сводкам владельца в tag_stats и mark_stats"""
+        if tag_deltas:
+            psycopg2.extras.execute_values(
+                cursor, "INSERT INTO tag_stats AS s (owner_id, name, songs) VALUES %s "
+                        "ON CONFLICT (owner_id, name) DO UPDATE SET songs = s.songs + EXCLUDED.songs",
+                [(self.owner_id, *delta) for delta in tag_deltas], page_size=BULK_BATCH_SIZE)
+        if mark_deltas:
+            psycopg2.extras.execute_values(
+                cursor, "INSERT INTO mark_stats AS s (owner_id, mark, songs) VALUES %s "
+                        "ON CONFLICT (owner_id, mark) DO UPDATE SET songs = s.songs + EXCLUDED.songs",
+                [(self.owner_id, *delta) for delta in mark_deltas], page_size=BULK_BATCH_SIZE)
+
+    def rebuild_stats(self, cursor):
+        """Пересчёт сводных таблиц всех владельцев по repertuar и song_tags.
+        Из миграции "сводные таблицы статистики" вызывается до появления owner_id - тогда без владельцев
+        """
+        cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_schema = current_schema() AND table_name = 'tag_stats'
+                           AND column_name = 'owner_id')
+        """)
+        column, owner = ("owner_id, ", "r.owner_id, ") if cursor.fetchone()[0] else ("", "")
+        # Пишущие транзакции ждут пересчёта и применяют свои изменения уже к пересчитанным сводкам
+        cursor.execute(f"""
+            LOCK TABLE tag_stats, mark_stats IN EXCLUSIVE MODE;
+            DELETE FROM tag_stats;
+            DELETE FROM mark_stats;
+            INSERT INTO tag_stats ({column}name, songs)
+                SELECT {owner}tags.name, COUNT(*) FROM song_tags
+                JOIN tags ON tags.id = song_tags.tag_id
+                JOIN repertuar r ON r.id = song_tags.song_id
+                GROUP BY {owner}tags.name;
+            INSERT INTO mark_stats ({column}mark, songs)
+                SELECT {owner}COALESCE(r.mark, 0), COUNT(*) FROM repertuar r GROUP BY {owner}COALESCE(r.mark, 0);
         """)
-        tag_list = ', '.join([row[0] for row in self.cursor.fetchall()])
-        return tag_list
 
-    def get_random_song(self) -> Song:
-        self.connect_if_need()
-        self.cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar ORDER BY RANDOM() LIMIT 1")
-        result = self.cursor.fetchone()
+    def refresh_stats(self):
+        def query(db):
+            with db.cursor() as cursor:
+                self.rebuild_stats(cursor)
+            db.commit()
+        self.pool.run(query)
+
+    def save_song_tags(self, cursor, songs):
+        """Заполнение tags и song_tags для пар (идентификатор композиции, строка тегов через запятую)"""
+        pairs = [(song_id, name) for song_id, tags in songs for name in split_tags(tags)]
+        if not pairs:
+            return
+        names = sorted({name for _, name in pairs})
+        psycopg2.extras.execute_values(
+            cursor, "INSERT INTO tags (name) VALUES %s ON CONFLICT (name) DO NOTHING",
+            [(name,) for name in names], page_size=BULK_BATCH_SIZE)
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO song_tags (song_id, tag_id) "
+            "SELECT v.song_id, tags.id FROM (VALUES %s) AS v (song_id, name) JOIN tags ON tags.name = v.name "
+            "ON CONFLICT DO NOTHING",
+            pairs, page_size=BULK_BATCH_SIZE)
+
+    def get_tags(self):
+        def query(db):
+            with db.cursor() as cursor:
+                # Теги с композициями владельца - по его сводке tag_stats
+                cursor.execute("SELECT name FROM tag_stats WHERE owner_id = %s AND songs > 0 ORDER BY name",
+                               (self.owner_id,))
+                return ', '.join([row[0] for row in cursor.fetchall()])
+        return self.pool.run(query)
+
+    def get_tag_counts(self):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT name, songs FROM tag_stats WHERE owner_id = %s AND songs > 0 "
+                               "ORDER BY songs DESC, name", (self.owner_id,))
+                return cursor.fetchall()
+        return self.pool.run(query)
+
+    def get_songs_by_tag(self, tag, limit=50):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT r.id, r.title, r.artist, r.tags, r.mark FROM tags
+                    JOIN song_tags st ON st.tag_id = tags.id
+                    JOIN repertuar r ON r.id = st.song_id
+                    WHERE tags.name = %s AND r.owner_id = %s
+                    ORDER BY r.artist, r.title
+                    LIMIT %s;
+                """, (normalize_tag(tag), self.owner_id, limit))
+                return cursor.fetchall()
+        return [Song(*row) for row in self.pool.run(query)]
+
+    def get_random_song_by_tag(self, tag):
+        # Сортируются только композиции владельца с этим тегом, найденные по индексу song_tags_tag_id_idx
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT r.id, r.title, r.artist, r.tags, r.mark FROM tags
+                    JOIN song_tags st ON st.tag_id = tags.id
+                    JOIN repertuar r ON r.id = st.song_id
+                    WHERE tags.name = %s AND r.owner_id = %s
+                    ORDER BY RANDOM() LIMIT 1;
+                """, (tag, self.owner_id))
+                return cursor.fetchone()
+        result = self.pool.run(query)
+        if result is not None:
+            return Song(*result)
+
+    def get_song_marks(self):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT id, mark, EXTRACT(EPOCH FROM NOW() - last_shown) FROM repertuar "
+                               "WHERE owner_id = %s", (self.owner_id,))
+                return cursor.fetchall()
+        return self.pool.run(query)
+
+    def save_last_shown(self, shown):
+        # Повтор безопасен: то же время показа записывается повторно
+        def query(db):
+            with db.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, """
+                    UPDATE repertuar AS r SET last_shown = NOW() - v.age * INTERVAL '1 second'
+                    FROM (VALUES %s) AS v (id, age)
+                    WHERE r.id = v.id AND (r.last_shown IS NULL OR r.last_shown < NOW() - v.age * INTERVAL '1 second')
+                """, sorted(shown.items()), page_size=BULK_BATCH_SIZE)
+            db.commit()
+        if shown:
+            self.pool.run(query)
+
+    def get_song(self, song_id) -> Song:
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar WHERE id = %s AND owner_id = %s",
+                               (song_id, self.owner_id))
+                return cursor.fetchone()
+        result = self.pool.run(query)
         if result is not None:
             id, title, artist, tags, mark = result
             return Song(id, title, artist, tags, mark)
 
+    def get_songs(self, song_ids):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar "
+                               "WHERE id = ANY(%s) AND owner_id = %s", (list(song_ids), self.owner_id))
+                return cursor.fetchall()
+        return [Song(*row) for row in self.pool.run(query)]
+
+    def search_songs(self, query, limit=10, offset=0):
+        # Похожие по триграммам слова (опечатки) или точное вхождение подстроки; оба условия - по индексу
+        query = query.strip().lower()
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+        def search(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT id, title, artist, tags, mark FROM repertuar
+                    WHERE owner_id = %(owner_id)s
+                      AND (%(query)s <%% lower(title || ' ' || artist)
+                           OR lower(title || ' ' || artist) LIKE %(pattern)s)
+                    ORDER BY lower(title || ' ' || artist) LIKE %(pattern)s DESC,
+                             word_similarity(%(query)s, lower(title || ' ' || artist)) DESC,
+                             artist, title
+                    LIMIT %(limit)s OFFSET %(offset)s;
+                """, dict(query=query, pattern=pattern, limit=limit, offset=offset, owner_id=self.owner_id))
+                return cursor.fetchall()
+        return [Song(*row) for row in self.pool.run(search)] if query else []
+
     def update_rating(self, song_id, mark):
-        self.connect_if_need()
-        self.cursor.execute("UPDATE repertuar SET mark = %s, open_time = NOW() WHERE id = %s", (mark, song_id))
-        rows_updated = self.cursor.rowcount
-        self.db.commit()
+        # Повтор безопасен: повторная установка той же оценки ничего не меняет
+        def query(db):
+            with db.cursor() as cursor:
+                # Прежняя оценка - для сводной таблицы mark_stats; строка блокируется до конца транзакции
+                cursor.execute("SELECT mark FROM repertuar WHERE id = %s AND owner_id = %s FOR UPDATE",
+                               (song_id, self.owner_id))
+                old_marks = cursor.fetchall()
+                cursor.execute("UPDATE repertuar SET mark = %s, open_time = NOW() WHERE id = %s AND owner_id = %s",
+                               (mark, song_id, self.owner_id))
+                rows_updated = cursor.rowcount
+                self.save_stats(cursor, *self.stats_deltas([(None, old_mark) for old_mark, in old_marks],
+                                                           [(None, mark)] * len(old_marks)))
+            db.commit()
+            return rows_updated
+        rows_updated = self.pool.run(query)
+        self.deck.set_mark(song_id, mark)
+        return rows_updated
+
+    def update_ratings(self, marks):
+        marks = dict(marks)
+        if not marks:
+            return 0
+
+        def query(db):
+            with db.cursor() as cursor:
+                # Прежние оценки изменяемых композиций - для mark_stats (блокировка в порядке идентификаторов)
+                cursor.execute("SELECT id, mark FROM repertuar WHERE id = ANY(%s) AND owner_id = %s "
+                               "ORDER BY id FOR UPDATE", (list(marks), self.owner_id))
+                changed = [(song_id, old_mark) for song_id, old_mark in cursor.fetchall() if old_mark != marks[song_id]]
+                psycopg2.extras.execute_values(cursor, """
+                    UPDATE repertuar AS r SET mark = v.mark, open_time = NOW()
+                    FROM (VALUES %s) AS v (id, mark, owner_id)
+                    WHERE r.id = v.id AND r.owner_id = v.owner_id AND r.mark <> v.mark
+                """, [(song_id, mark, self.owner_id) for song_id, mark in marks.items()], page_size=len(marks))
+                rows_updated = cursor.rowcount
+                self.save_stats(cursor, *self.stats_deltas([(None, old_mark) for _, old_mark in changed],
+                                                           [(None, marks[song_id]) for song_id, _ in changed]))
+            db.commit()
+            return rows_updated
+        rows_updated = self.pool.run(query)
+        for song_id, mark in marks.items():
+            self.deck.set_mark(song_id, mark)
         return rows_updated
 
     def add_song(self, title, artist, tags, mark=0):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO repertuar (owner_id, title, artist, tags, mark) VALUES (%s, %s, %s, %s, %s) "
+                    "RETURNING id", (self.owner_id, title, artist, tags, mark))
+                song_id = cursor.fetchone()[0]
+                self.save_song_tags(cursor, [(song_id, tags)])
+                self.save_stats(cursor, *self.stats_deltas([], [(tags, mark)]))
+            db.commit()
+            return song_id
+
         try:
-            self.connect_if_need()
-            self.cursor.execute(
-                "INSERT INTO repertuar (title, artist, tags, mark) VALUES (%s, %s, %s, %s)",
-                (title, artist, tags, mark))
-            self.db.commit()
+            # Без повтора: при обрыве после фиксации повторная вставка дала бы ложный дубль
+            song_id = self.pool.run(query, retry=False)
+            self.deck.add([(song_id, mark)])
             return 0
         except psycopg2.errors.UniqueViolation as e:
             self.logger.error(e)
@@ -101,18 +447,244 @@ class PostgresqlStorageManager(StorageManager):
             self.logger.error(e)
         return 99
 
-    def backup(self, file_path):
-        """Выгрузка всех композиций в CSV файл."""
-        self.connect_if_need()  # Убедитесь, что соединение с БД активно
-        self.cursor.execute("SELECT title, artist, tags, mark FROM repertuar")
-        rows = self.cursor.fetchall()  # Получаем все строки из результата запроса
-
-        # Запись данных в CSV файл
-        with open(file_path, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file, delimiter=';')  # Используем точку с запятой в качестве разделителя
-            # Запись данных
-            for row in rows:
-                writer.writerow(row)  # Запись каждой строки в CSV-файл
-
-        self.logger.info(f"Бэкап завершён. Файл сохранен по пути: {file_path}")  # Информация о завершении
-        return file_path  # Возвращаем путь к сохраненному файлу
+    def add_songs_bulk(self, rows):
+        result = BulkInsertResult()
+        songs = self.prepare_bulk_rows(rows, result, self.logger)
+        if not songs:
+            return result
+        return self.load_songs_bulk(self.bulk_batches(songs), result, self.insert_batch)
+
+    def upsert_songs_bulk(self, rows, progress=None):
+        result = BulkInsertResult()
+        songs = self.iter_bulk_rows(rows, result, self.logger)
+        return self.load_songs_bulk(self.upsert_batches(songs, result), result, self.upsert_batch, progress)
+
+    def insert_batch(self, cursor, batch):
+        """Вставка пачки без дублей; возвращает добавленные и изменённые пары (идентификатор, оценка)"""
+        inserted = psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO repertuar (owner_id, title, artist, tags, mark) VALUES %s "
+            "ON CONFLICT (owner_id, title, artist) DO NOTHING RETURNING id, mark, tags",
+            [(self.owner_id, *song) for song in batch], page_size=len(batch), fetch=True)
+        self.save_song_tags(cursor, [(song_id, tags) for song_id, _, tags in inserted])
+        self.save_stats(cursor, *self.stats_deltas([], [(tags, mark) for _, mark, tags in inserted]))
+        return [(song_id, mark) for song_id, mark, _ in inserted], []
+
+    def upsert_batch(self, cursor, batch):
+        """Вставка пачки с обновлением тегов и оценок сохранённых композиций, если они отличаются"""
+        # Прежние теги и оценки сохранённых композиций - для сводных таблиц
+        before = psycopg2.extras.execute_values(cursor, """
+            SELECT r.id, r.tags, r.mark FROM repertuar AS r
+            JOIN (VALUES %s) AS v (owner_id, title, artist)
+                ON r.owner_id = v.owner_id AND r.title = v.title AND r.artist = v.artist
+            ORDER BY r.id FOR UPDATE OF r
+        """, [(self.owner_id, *song[:2]) for song in batch], page_size=len(batch), fetch=True)
+        before = {song_id: (tags, mark) for song_id, tags, mark in before}
+        changed = psycopg2.extras.execute_values(cursor, """
+            INSERT INTO repertuar AS r (owner_id, title, artist, tags, mark) VALUES %s
+            ON CONFLICT (owner_id, title, artist) DO UPDATE
+                SET tags = EXCLUDED.tags, mark = EXCLUDED.mark, open_time = NOW()
+            WHERE r.tags IS DISTINCT FROM EXCLUDED.tags OR r.mark IS DISTINCT FROM EXCLUDED.mark
+            RETURNING id, mark, tags, xmax = 0
+        """, [(self.owner_id, *song) for song in batch], page_size=len(batch), fetch=True)
+        updated = [(song_id, mark) for song_id, mark, _, inserted in changed if not inserted]
+        if updated:
+            cursor.execute("DELETE FROM song_tags WHERE song_id = ANY(%s)", ([song_id for song_id, _ in updated],))
+        self.save_song_tags(cursor, [(song_id, tags) for song_id, _, tags, _ in changed])
+        self.save_stats(cursor, *self.stats_deltas([before[song_id] for song_id, _ in updated],
+                                                   [(tags, mark) for _, mark, tags, _ in changed]))
+        return [(song_id, mark) for song_id, mark, _, inserted in changed if inserted], updated
+
+    def load_songs_bulk(self, batches, result, load_batch, progress=None):
+        """Загрузка пачек композиций в одной транзакции через load_batch(cursor, batch)"""
+        songs_added, songs_updated = [], []
+        try:
+            with self.pool.connection() as db, db.cursor() as cursor:
+                for batch in batches:
+                    # Точка сохранения, чтобы ошибка в одной пачке не откатывала всю загрузку
+                    cursor.execute("SAVEPOINT bulk_batch")
+                    try:
+                        added, updated = load_batch(cursor, batch)
+                    except psycopg2.DatabaseError as e:
+                        self.logger.error(e)
+                        cursor.execute("ROLLBACK TO SAVEPOINT bulk_batch")
+                        result.db_errors += len(batch)
+                        continue
+                    cursor.execute("RELEASE SAVEPOINT bulk_batch")
+                    songs_added.extend(added)
+                    songs_updated.extend(updated)
+                    result.success += len(added) + len(updated)
+                    result.duplicates += len(batch) - len(added) - len(updated)
+                    if progress is not None:
+                        progress(result)
+                db.commit()
+            self.deck.add(songs_added)
+            for song_id, mark in songs_updated:
+                self.deck.set_mark(song_id, mark)
+        except psycopg2.DatabaseError as e:
+            self.logger.error(e)
+            # Транзакция не зафиксирована - всё, что считалось добавленным, не сохранилось
+            result.db_errors += result.success
+            result.success = 0
+        return result
+
+    def add_song_request(self, chat_id, username, composition):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("INSERT INTO song_requests (owner_id, chat_id, username, composition) "
+                               "VALUES (%s, %s, %s, %s) RETURNING id",
+                               (self.owner_id, chat_id, username, composition[:255]))
+                request_id = cursor.fetchone()[0]
+            db.commit()
+            return request_id
+        # Без повтора: при обрыве после фиксации заказ сохранился бы дважды
+        return self.pool.run(query, retry=False)
+
+    def claim_song_requests(self, limit):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE song_requests SET status = 'sent'
+                    WHERE id IN (SELECT id FROM song_requests WHERE owner_id = %s AND status = 'new'
+                                 ORDER BY created_at LIMIT %s FOR UPDATE SKIP LOCKED)
+                    RETURNING id, chat_id, username, composition, status, created_at;
+                """, (self.owner_id, limit))
+                rows = cursor.fetchall()
+            db.commit()
+            return rows
+        return sorted((SongRequest(*row) for row in self.pool.run(query)),
+                      key=lambda request: (request.created_at, request.id))
+
+    def set_song_requests_status(self, request_ids, status):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("UPDATE song_requests SET status = %s WHERE id = ANY(%s) AND owner_id = %s",
+                               (status, list(request_ids), self.owner_id))
+                rows_updated = cursor.rowcount
+            db.commit()
+            return rows_updated
+        return self.pool.run(query)
+
+    def get_pending_song_requests(self, limit=10, offset=0):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    SELECT id, chat_id, username, composition, status, created_at FROM song_requests
+                    WHERE owner_id = %s AND status IN ('new', 'sent')
+                    ORDER BY created_at, id
+                    LIMIT %s OFFSET %s;
+                """, (self.owner_id, limit, offset))
+                return cursor.fetchall()
+        return [SongRequest(*row) for row in self.pool.run(query)]
+
+    def get_state(self, chat_id):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT state FROM chat_states WHERE chat_id = %s AND expires_at > NOW()", (chat_id,))
+                return cursor.fetchone()
+        result = self.pool.run(query)
+        if result is not None:
+            return result[0]
+
+    def set_state(self, chat_id, state, ttl):
+        # Повтор безопасен: запись перезаписывает состояние целиком
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO chat_states (chat_id, state, expires_at)
+                    VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+                    ON CONFLICT (chat_id) DO UPDATE SET state = EXCLUDED.state, expires_at = EXCLUDED.expires_at;
+                """, (chat_id, state, ttl))
+            db.commit()
+        self.pool.run(query)
+
+    def delete_state(self, chat_id):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("DELETE FROM chat_states WHERE chat_id = %s", (chat_id,))
+            db.commit()
+        self.pool.run(query)
+
+    def purge_states(self):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("DELETE FROM chat_states WHERE expires_at <= NOW()")
+                rows_deleted = cursor.rowcount
+            db.commit()
+            return rows_deleted
+        return self.pool.run(query)
+
+    def get_chat_owner(self, chat_id):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT owner_id FROM chat_owners WHERE chat_id = %s", (chat_id,))
+                return cursor.fetchone()
+        result = self.pool.run(query)
+        if result is not None:
+            return result[0]
+
+    def set_chat_owner(self, chat_id, owner_id):
+        # Повтор безопасен: запись перезаписывает выбор целиком
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("INSERT INTO chat_owners (chat_id, owner_id) VALUES (%s, %s) "
+                               "ON CONFLICT (chat_id) DO UPDATE SET owner_id = EXCLUDED.owner_id", (chat_id, owner_id))
+            db.commit()
+        self.pool.run(query)
+
+    def get_admin_chat(self):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("SELECT chat_id FROM admin_chats WHERE owner_id = %s", (self.owner_id,))
+                return cursor.fetchone()
+        result = self.pool.run(query)
+        if result is not None:
+            return result[0]
+
+    def set_admin_chat(self, chat_id):
+        def query(db):
+            with db.cursor() as cursor:
+                cursor.execute("INSERT INTO admin_chats (owner_id, chat_id) VALUES (%s, %s) "
+                               "ON CONFLICT (owner_id) DO UPDATE SET chat_id = EXCLUDED.chat_id",
+                               (self.owner_id, chat_id))
+            db.commit()
+        self.pool.run(query)
+
+    def backup_since(self, cursor, kind):
+        """Время, начиная с которого выгружаются изменения для бэкапа вида kind (None - выгружаются все)"""
+        if kind == BACKUP_FULL:
+            return None
+        cursor.execute("SELECT MAX(started_at) - %(overlap)s * INTERVAL '1 second' FROM backups "
+                       "WHERE owner_id = %(owner_id)s"
+                       + (" AND kind = %(full)s" if kind == BACKUP_DIFFERENTIAL else ""),
+                       dict(overlap=BACKUP_OVERLAP_SECONDS, full=BACKUP_FULL, owner_id=self.owner_id))
+        return cursor.fetchone()[0]
+
+    def backup(self, compress=False, kind=BACKUP_FULL):
+        """Выгрузка композиций в CSV через COPY TO STDOUT, без загрузки таблицы в память"""
+        buffer = tempfile.SpooledTemporaryFile(BACKUP_SPOOL_SIZE)
+
+        def query(db):
+            # При повторе после обрыва соединения начинаем запись заново
+            buffer.seek(0)
+            buffer.truncate()
+            with db.cursor() as cursor, open_backup_stream(buffer, compress) as stream:
+                since = self.backup_since(cursor, kind)
+                # Контрольная точка - начало транзакции (NOW()), фиксируется вместе с выгрузкой
+                cursor.execute("INSERT INTO backups (owner_id, kind, started_at) VALUES (%s, %s, NOW())",
+                               (self.owner_id, kind if since is not None else BACKUP_FULL))
+                # Изменения после контрольной точки находятся по индексу repertuar_owner_open_time_idx
+                select = cursor.mogrify("SELECT title, artist, tags, mark FROM repertuar WHERE owner_id = %s"
+                                        + (" AND open_time >= %s" if since is not None else "") + " ORDER BY id",
+                                        (self.owner_id, since) if since is not None else (self.owner_id,))
+                cursor.copy_expert(f"COPY ({select.decode()}) TO STDOUT WITH (FORMAT csv, DELIMITER ';')", stream)
+            db.commit()
+
+        try:
+            self.pool.run(query)
+        except BaseException:
+            buffer.close()
+            raise
+        self.logger.info(f"Бэкап ({kind}) завершён. Размер: {buffer.tell()} байт")
+        buffer.seek(0)
+        return buffer
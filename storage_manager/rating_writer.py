@@ -0,0 +1,87 @@
+import atexit
+import threading
+import time
+
+from storage_manager import DEFAULT_OWNER_ID
+
+
+class RatingWriter:
+    """Отложенная пакетная запись оценок.
+    Оценка композиции записывается, только когда её не меняли delay секунд: при быстром перещёлкивании
+    оценок в БД попадает лишь последняя. Готовые к записи оценки разных композиций записываются
+    пачками до max_batch в одной транзакции (StorageManager.update_ratings) фоновым потоком;
+    оценки разных владельцев репертуаров записываются отдельными транзакциями через storage.for_owner().
+    set() не обращается к БД, поэтому его можно вызывать и из цикла событий асинхронного бота.
+    """
+
+    def __init__(self, storage, delay=2.0, max_batch=100, logger=None):
+        self.storage = storage
+        self.delay = delay
+        self.max_batch = max_batch
+        self.logger = logger or storage.logger
+        self._pending = {}  # (владелец, идентификатор) -> (оценка, когда записать)
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='rating-writer', daemon=True)
+        self._thread.start()
+        # Несохранённые оценки записываются при завершении процесса
+        atexit.register(self.flush)
+
+    def set(self, song_id, mark, owner_id=DEFAULT_OWNER_ID):
+        with self._condition:
+            self._pending[owner_id, song_id] = (mark, time.monotonic() + self.delay)
+            self._condition.notify()
+
+    def _take(self, now=None):
+        """Забрать до max_batch оценок, которые пора записать (при now=None - любые)"""
+        keys = [key for key, (_, write_at) in self._pending.items() if now is None or write_at <= now][:self.max_batch]
+        return {key: self._pending.pop(key)[0] for key in keys}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    now = time.monotonic()
+                    write_at = min((write_at for _, write_at in self._pending.values()), default=None)
+                    if write_at is not None and write_at <= now:
+                        break
+                    self._condition.wait(None if write_at is None else write_at - now)
+                batch = self._take(now)
+            self._write(batch)
+
+    def _write(self, batch):
+        owners = {}
+        for (owner_id, song_id), mark in batch.items():
+            owners.setdefault(owner_id, {})[song_id] = mark
+        written = True
+        for owner_id, marks in owners.items():
+            try:
+                self.storage.for_owner(owner_id).update_ratings(marks)
+            except Exception as e:
+                self.logger.error(f"Не удалось сохранить оценки: {e}")
+                # Повторим позже, если оценку за это время не поменяли ещё раз
+                with self._condition:
+                    write_at = time.monotonic() + self.delay
+                    for song_id, mark in marks.items():
+                        self._pending.setdefault((owner_id, song_id), (mark, write_at))
+                written = False
+        return written
+
+    def close(self):
+        """Остановить фоновый поток и записать все отложенные оценки (при остановке бота)"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        atexit.unregister(self.flush)
+        self.flush()
+
+    def flush(self):
+        """Записать все отложенные оценки немедленно"""
+        while True:
+            with self._condition:
+                batch = self._take()
+            if not batch or not self._write(batch):
+                return
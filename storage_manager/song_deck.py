@@ -0,0 +1,245 @@
+import random
+import threading
+import time
+from array import array
+from collections import deque
+
+# Множители веса по давности показа: (секунд с показа, множитель) по возрастанию времени.
+# Только что показанная композиция почти не выпадает снова, через сутки её вес снова полный
+RECENCY_FACTORS = ((3600, 0.001), (6 * 3600, 0.2), (24 * 3600, 0.5))
+
+
+def mark_weight(mark):
+    """Множитель веса по оценке: без оценки - 1, оценка 5 - 6"""
+    return 1 + max(mark or 0, 0)
+
+
+class FenwickTree:
+    """Дерево Фенвика над весами: изменение веса, сумма префикса и поиск позиции по сумме - за O(log n)"""
+
+    def __init__(self, weights=()):
+        # Узел i (с 1) хранит сумму весов позиций (i - lowbit(i), i]
+        self._tree = array('d', [0.0])
+        self._tree.extend(weights)
+        for i in range(1, len(self._tree)):  # построение за O(n)
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def append(self, weight):
+        i = len(self._tree)
+        self._tree.append(weight + self.prefix_sum(i - 1) - self.prefix_sum(i - (i & -i)))
+
+    def add(self, position, delta):
+        """Изменение веса позиции position (с 0) на delta"""
+        i = position + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, count):
+        """Сумма весов первых count позиций"""
+        total = 0.0
+        while count > 0:
+            total += self._tree[count]
+            count -= count & -count
+        return total
+
+    def total(self):
+        return self.prefix_sum(len(self))
+
+    def find(self, value):
+        """Позиция, на которую приходится value из [0, total()): первая, где сумма весов до неё включительно
+        больше value"""
+        position = 0
+        step = 1 << len(self).bit_length()
+        while step:
+            if position + step < len(self._tree) and self._tree[position + step] <= value:
+                position += step
+                value -= self._tree[position]
+            step >>= 1
+        return min(position, len(self) - 1)
+
+
+class SongDeck:
+    """Взвешенный случайный выбор композиций без обращения к таблице целиком.
+    Вес композиции - множитель оценки (любимые выпадают чаще), умноженный на множитель давности показа
+    (только что показанные почти не повторяются). Веса лежат в дереве Фенвика, поэтому выбор и изменение
+    веса при новой оценке или показе - O(log n). Давность показа меняется ступенями (RECENCY_FACTORS):
+    показанная композиция стоит в очереди своей ступени и переходит на следующую, когда её время истекает.
+    Время показа сохраняется в БД (repertuar.last_shown) пачкой при перечитывании композиций - так его видят
+    другие процессы бота, и оно переживает перезапуск.
+    """
+
+    def __init__(self, load_songs, save_shown=None, refresh_seconds=600, recency=RECENCY_FACTORS,
+                 weight=mark_weight):
+        """
+        load_songs - функция, возвращающая тройки (идентификатор, оценка, секунд с последнего показа или None)
+        save_shown - функция, сохраняющая {идентификатор: секунд с последнего показа}
+        refresh_seconds - как часто перечитывать композиции (их могли добавить или показать другие процессы)
+        recency - ступени давности показа, weight - множитель веса по оценке
+        """
+        self._load_songs = load_songs
+        self._save_shown = save_shown
+        self.refresh_seconds = refresh_seconds
+        self.recency = recency
+        self.weight = weight
+        self._ids = None  # идентификаторы композиций по позициям в дереве; None на месте удалённых
+        self._index = {}  # идентификатор -> позиция
+        self._marks = {}  # идентификатор -> оценка
+        self._shown = {}  # идентификатор -> время показа (time.monotonic()), пока композиция в очереди ступени
+        self._stages = {}  # идентификатор -> номер ступени давности показа
+        self._queues = [deque() for _ in recency]  # очереди ступеней: (время показа, идентификатор)
+        self._unsaved = {}  # показы, ещё не сохранённые в БД: идентификатор -> время показа
+        self._weights = array('d')
+        self._tree = FenwickTree()
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Сохранить показы в БД и перечитать композиции (веса пересчитываются заново)"""
+        self.save()
+        songs = self._load_songs()
+        now = time.monotonic()
+        with self._lock:
+            shown = {song_id: now - float(age) for song_id, _, age in songs if age is not None}
+            # Показы этого процесса, случившиеся после сохранения, новее прочитанных из БД
+            for song_id, shown_at in self._shown.items():
+                shown[song_id] = max(shown_at, shown.get(song_id, shown_at))
+            self._ids = [song_id for song_id, _, _ in songs]
+            self._index = {song_id: position for position, song_id in enumerate(self._ids)}
+            self._marks = {song_id: mark for song_id, mark, _ in songs}
+            self._shown, self._stages = {}, {}
+            self._queues = [deque() for _ in self.recency]
+            for song_id, shown_at in sorted(shown.items(), key=lambda item: item[1]):
+                if song_id in self._index:
+                    self._enqueue(song_id, shown_at, now)
+            self._weights = array('d', (self._weight(song_id) for song_id in self._ids))
+            self._tree = FenwickTree(self._weights)
+            self._loaded_at = now
+
+    def save(self):
+        """Сохранить в БД ещё не сохранённые показы (при перечитывании и когда колода перестаёт использоваться)"""
+        if self._save_shown is None:
+            return
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, {}
+        if not unsaved:
+            return
+        now = time.monotonic()
+        try:
+            self._save_shown({song_id: now - shown_at for song_id, shown_at in unsaved.items()})
+        except BaseException:
+            with self._lock:
+                self._unsaved = dict(unsaved, **self._unsaved)
+            raise
+
+    def _weight(self, song_id):
+        stage = self._stages.get(song_id)
+        factor = self.recency[stage][1] if stage is not None else 1.0
+        return self.weight(self._marks.get(song_id, 0)) * factor
+
+    def _update(self, song_id):
+        position = self._index[song_id]
+        weight = self._weight(song_id)
+        self._tree.add(position, weight - self._weights[position])
+        self._weights[position] = weight
+
+    def _enqueue(self, song_id, shown_at, now):
+        """Поставить показанную композицию в очередь ступени давности (без обновления дерева)"""
+        for stage, (seconds, _) in enumerate(self.recency):
+            if now - shown_at < seconds:
+                self._shown[song_id] = shown_at
+                self._stages[song_id] = stage
+                self._queues[stage].append((shown_at, song_id))
+                return
+
+    def _expire(self, now):
+        """Перевод композиций, время которых на ступени истекло, на следующую ступень (или к полному весу)"""
+        for stage, (seconds, _) in enumerate(self.recency):
+            queue = self._queues[stage]
+            while queue and now - queue[0][0] >= seconds:
+                shown_at, song_id = queue.popleft()
+                if self._shown.get(song_id) != shown_at or self._stages.get(song_id) != stage:
+                    continue  # композицию показали снова или удалили
+                if stage + 1 < len(self.recency):
+                    self._stages[song_id] = stage + 1
+                    self._queues[stage + 1].append((shown_at, song_id))
+                else:
+                    del self._stages[song_id], self._shown[song_id]
+                self._update(song_id)
+
+    def _show(self, song_id, now):
+        self._stages.pop(song_id, None)
+        self._enqueue(song_id, now, now)
+        self._unsaved[song_id] = now
+        self._update(song_id)
+
+    def add(self, songs):
+        """Добавить новые композиции (пары (идентификатор, оценка)) с полным весом"""
+        with self._lock:
+            if self._ids is None:
+                return
+            for song_id, mark in songs:
+                if song_id in self._index:
+                    continue
+                self._index[song_id] = len(self._ids)
+                self._ids.append(song_id)
+                self._marks[song_id] = mark
+                self._weights.append(self._weight(song_id))
+                self._tree.append(self._weights[-1])
+
+    def set_mark(self, song_id, mark):
+        """Обновить оценку композиции (и её вес)"""
+        with self._lock:
+            if song_id in self._index:
+                self._marks[song_id] = mark
+                self._update(song_id)
+
+    def mark_shown(self, song_ids):
+        """Отметить композиции показанными (выбранные не через draw, например по тегу)"""
+        with self._lock:
+            now = time.monotonic()
+            for song_id in song_ids:
+                if song_id in self._index:
+                    self._show(song_id, now)
+
+    def discard(self, song_id):
+        """Убрать композицию, которой больше нет в БД"""
+        with self._lock:
+            position = self._index.pop(song_id, None)
+            if position is not None:
+                self._tree.add(position, -self._weights[position])
+                self._weights[position] = 0.0
+                self._ids[position] = None
+                self._marks.pop(song_id, None)
+                self._shown.pop(song_id, None)
+                self._stages.pop(song_id, None)
+
+    def draw(self, count=1, min_mark=None):
+        """Выбрать до count различных композиций с вероятностью, пропорциональной весу, и отметить их показанными.
+        С min_mark - только композиции с оценкой не ниже заданной.
+        Если подходящих композиций мало, может вернуться меньше count.
+        """
+        if self._ids is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+            self.refresh()
+        song_ids = []
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            misses = 0  # повторы и неподходящие по оценке попытки
+            while len(song_ids) < min(count, len(self._index)) and misses <= 20 * count + 100:
+                total = self._tree.total()
+                if total <= 0:
+                    break
+                song_id = self._ids[self._tree.find(random.random() * total)]
+                if song_id is None or song_id in song_ids or \
+                        (min_mark is not None and self._marks.get(song_id, 0) < min_mark):
+                    misses += 1
+                    continue
+                song_ids.append(song_id)
+                self._show(song_id, now)
+        return song_ids
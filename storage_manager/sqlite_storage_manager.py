@@ -0,0 +1,685 @@
+import csv
+import io
+import json
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime
+
+from storage_manager import BACKUP_DIFFERENTIAL, BACKUP_FETCH_SIZE, BACKUP_FULL, BACKUP_OVERLAP_SECONDS, \
+    BACKUP_SPOOL_SIZE, STATS_RECENT_LIMIT, BulkInsertResult, RepertuarStats, Song, SongRequest, StorageManager, \
+    normalize_tag, open_backup_stream, split_tags
+from storage_manager.connection_pool import ConnectionPool
+from storage_manager.song_deck import SongDeck
+
+# Запросы короче триграммы не ищутся по индексу FTS5 - для них просмотр таблицы
+FTS_MIN_QUERY_LENGTH = 3
+
+
+def _lower(value):
+    # Встроенная lower() SQLite меняет регистр только у ASCII
+    return value.lower() if isinstance(value, str) else value
+
+
+def _datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+class SqliteStorageManager(StorageManager):
+    """Хранилище в файле SQLite - для запуска на одном сервере без отдельного сервера БД.
+    Журнал WAL: чтения не ждут записи, запись фиксируется без fsync на каждую транзакцию.
+    Пишущие транзакции начинаются с BEGIN IMMEDIATE, чтобы блокировка записи бралась сразу,
+    а не при первом изменении (иначе параллельные транзакции получают "database is locked").
+    """
+
+    def __init__(self, logger, sqlite_connection_params, pool_params=None):
+        self.logger = logger
+        # database - путь к файлу БД, остальные параметры передаются в sqlite3.connect()
+        self.connection_params = dict(dict(timeout=30), **sqlite_connection_params)
+        self.pool = ConnectionPool(logger, self.connect, self.is_connected, (), **(pool_params or {}))
+        self.deck = SongDeck(self.get_song_marks, self.save_last_shown)
+        self.migrate()
+
+    def migrations(self):
+        def add_last_shown(cursor):
+            if 'last_shown' not in [row[1] for row in cursor.execute("PRAGMA table_info(repertuar)")]:
+                cursor.execute("ALTER TABLE repertuar ADD COLUMN last_shown REAL")
+
+        # Триггеры индекса поиска: создаются заново, если таблица repertuar пересоздаётся
+        search_triggers = ["""
+            CREATE TRIGGER IF NOT EXISTS repertuar_search_insert AFTER INSERT ON repertuar BEGIN
+                INSERT INTO repertuar_search (rowid, title, artist) VALUES (new.id, new.title, new.artist);
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS repertuar_search_delete AFTER DELETE ON repertuar BEGIN
+                INSERT INTO repertuar_search (repertuar_search, rowid, title, artist)
+                VALUES ('delete', old.id, old.title, old.artist);
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS repertuar_search_update AFTER UPDATE OF title, artist ON repertuar BEGIN
+                INSERT INTO repertuar_search (repertuar_search, rowid, title, artist)
+                VALUES ('delete', old.id, old.title, old.artist);
+                INSERT INTO repertuar_search (rowid, title, artist) VALUES (new.id, new.title, new.artist);
+            END
+        """]
+
+        return [
+            ("таблица repertuar", ["""
+                CREATE TABLE IF NOT EXISTS repertuar (
+                    id INTEGER PRIMARY KEY,
+                    title VARCHAR(255) NOT NULL,
+                    artist VARCHAR(255) NOT NULL,
+                    tags TEXT,
+                    open_time TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                    content TEXT,
+                    mark INT DEFAULT 0,
+                    UNIQUE (title, artist)
+                )
+            """]),
+            # Нормализованные теги: справочник тегов и связь композиций с тегами
+            ("нормализованные теги", ["""
+                CREATE TABLE IF NOT EXISTS tags (
+                    id INTEGER PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL UNIQUE
+                )
+            """, """
+                CREATE TABLE IF NOT EXISTS song_tags (
+                    song_id INT NOT NULL REFERENCES repertuar (id) ON DELETE CASCADE,
+                    tag_id INT NOT NULL REFERENCES tags (id) ON DELETE CASCADE,
+                    PRIMARY KEY (song_id, tag_id)
+                ) WITHOUT ROWID
+            """, "CREATE INDEX IF NOT EXISTS song_tags_tag_id_idx ON song_tags (tag_id, song_id)"]),
+            # Триграммный полнотекстовый индекс по названию и исполнителю, обновляется триггерами
+            ("индекс поиска", ["""
+                CREATE VIRTUAL TABLE IF NOT EXISTS repertuar_search
+                    USING fts5(title, artist, content='repertuar', content_rowid='id', tokenize='trigram')
+            """] + search_triggers),
+            # Заказы композиций слушателями: очередь для сводок администратору
+            ("заказы композиций", ["""
+                CREATE TABLE IF NOT EXISTS song_requests (
+                    id INTEGER PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    username VARCHAR(255),
+                    composition VARCHAR(255) NOT NULL,
+                    status VARCHAR(16) NOT NULL DEFAULT 'new',
+                    created_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+                )
+            """, """
+                CREATE INDEX IF NOT EXISTS song_requests_status_created_at_idx
+                    ON song_requests (status, created_at)
+            """]),
+            # Состояния многошаговых диалогов (см. storage_manager/state_store.py);
+            # срок хранения - в секундах с начала эпохи
+            ("состояния диалогов", ["""
+                CREATE TABLE IF NOT EXISTS chat_states (
+                    chat_id BIGINT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """, "CREATE INDEX IF NOT EXISTS chat_states_expires_at_idx ON chat_states (expires_at)"]),
+            # Контрольные точки бэкапов и индекс по времени изменения композиций для частичных бэкапов
+            ("контрольные точки бэкапов", ["""
+                CREATE TABLE IF NOT EXISTS backups (
+                    id INTEGER PRIMARY KEY,
+                    kind VARCHAR(16) NOT NULL,
+                    started_at TIMESTAMP NOT NULL
+                )
+            """, "CREATE INDEX IF NOT EXISTS repertuar_open_time_idx ON repertuar (open_time)"]),
+            # Сводные таблицы для статистики: количество композиций по тегам и по оценкам
+            ("сводные таблицы статистики", ["""
+                CREATE TABLE IF NOT EXISTS tag_stats (
+                    name VARCHAR(255) PRIMARY KEY,
+                    songs INT NOT NULL
+                ) WITHOUT ROWID
+            """, """
+                CREATE TABLE IF NOT EXISTS mark_stats (
+                    mark INT PRIMARY KEY,
+                    songs INT NOT NULL
+                ) WITHOUT ROWID
+            """, self.rebuild_stats]),
+            # Время последнего показа композиции (в секундах с начала эпохи) - для взвешенного случайного выбора
+            ("время показа композиций", [add_last_shown]),
+            # Репертуары нескольких владельцев (музыкантов) в одной БД: owner_id у композиций, заказов
+            # и контрольных точек бэкапов, составные индексы с owner_id в начале.
+            # Ограничение UNIQUE в SQLite не изменить - таблица repertuar пересоздаётся с теми же идентификаторами
+            # (индекс поиска остаётся верным). DROP TABLE удаляет каскадом song_tags - связи сохраняются
+            # во временной таблице и возвращаются
+            ("владельцы репертуаров", [
+                "CREATE TEMP TABLE song_tags_copy AS SELECT song_id, tag_id FROM song_tags", """
+                CREATE TABLE repertuar_new (
+                    id INTEGER PRIMARY KEY,
+                    owner_id INT NOT NULL DEFAULT 0,
+                    title VARCHAR(255) NOT NULL,
+                    artist VARCHAR(255) NOT NULL,
+                    tags TEXT,
+                    open_time TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                    content TEXT,
+                    mark INT DEFAULT 0,
+                    last_shown REAL,
+                    UNIQUE (owner_id, title, artist)
+                )
+            """, """
+                INSERT INTO repertuar_new (id, title, artist, tags, open_time, content, mark, last_shown)
+                SELECT id, title, artist, tags, open_time, content, mark, last_shown FROM repertuar
+            """, "DROP TABLE repertuar", "ALTER TABLE repertuar_new RENAME TO repertuar",
+                "INSERT INTO song_tags (song_id, tag_id) SELECT song_id, tag_id FROM song_tags_copy",
+                "DROP TABLE song_tags_copy"] + search_triggers + [
+                "CREATE INDEX repertuar_owner_open_time_idx ON repertuar (owner_id, open_time)",
+                "ALTER TABLE song_requests ADD COLUMN owner_id INT NOT NULL DEFAULT 0",
+                "DROP INDEX IF EXISTS song_requests_status_created_at_idx",
+                "CREATE INDEX song_requests_owner_status_created_at_idx "
+                "ON song_requests (owner_id, status, created_at)",
+                "ALTER TABLE backups ADD COLUMN owner_id INT NOT NULL DEFAULT 0",
+                "CREATE INDEX backups_owner_kind_started_at_idx ON backups (owner_id, kind, started_at)",
+                # Владелец, которого выбрал чат слушателя (ссылкой на музыканта)
+                """
+                CREATE TABLE chat_owners (
+                    chat_id BIGINT PRIMARY KEY,
+                    owner_id INT NOT NULL
+                )
+            """,
+                # Сводные таблицы пересоздаются с владельцем в первичном ключе и заполняются заново
+                "DROP TABLE tag_stats", "DROP TABLE mark_stats", """
+                CREATE TABLE tag_stats (
+                    owner_id INT NOT NULL,
+                    name VARCHAR(255) NOT NULL,
+                    songs INT NOT NULL,
+                    PRIMARY KEY (owner_id, name)
+                ) WITHOUT ROWID
+            """, """
+                CREATE TABLE mark_stats (
+                    owner_id INT NOT NULL,
+                    mark INT NOT NULL,
+                    songs INT NOT NULL,
+                    PRIMARY KEY (owner_id, mark)
+                ) WITHOUT ROWID
+            """, self.rebuild_stats]),
+            # Чат администратора владельца - для сводок заказов из любого процесса и после перезапуска
+            ("чаты администраторов", ["""
+                CREATE TABLE admin_chats (
+                    owner_id INT PRIMARY KEY,
+                    chat_id BIGINT NOT NULL
+                )
+            """]),
+        ]
+
+    def migrate(self):
+        def migrate(cursor):
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+                )
+            """)
+            version = cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            return self.apply_migrations(cursor, version,
+                                         "INSERT INTO schema_version (version, description) VALUES (?, ?)")
+        # BEGIN IMMEDIATE в write() - блокировка записи в файл БД: другой процесс дождётся её
+        # и увидит уже применённые миграции
+        return self.write(migrate)
+
+    def __deinit__(self):
+        self.pool.close()
+
+    # Подключение к базе данных SQLite
+    def connect(self):
+        # isolation_level=None - транзакции открываются явно (BEGIN IMMEDIATE в write());
+        # подготовленные запросы кэшируются на соединении (cached_statements)
+        db = sqlite3.connect(**self.connection_params, isolation_level=None, check_same_thread=False,
+                             cached_statements=256)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute("PRAGMA foreign_keys = ON")
+        db.create_function('lower', 1, _lower, deterministic=True)
+        return db
+
+    # Функция для проверки  соединения
+    def is_connected(self, db):
+        try:
+            return db.execute("SELECT 1").fetchone() is not None
+        except sqlite3.Error as e:
+            self.logger.error(f"Error checking connection: {e}")
+        except Exception as e:
+            self.logger.error(f"Unknown error in is_connected: {e}")
+        return False
+
+    def write(self, operation):
+        """Выполнение operation(cursor) в пишущей транзакции с фиксацией"""
+        def query(db):
+            with closing(db.cursor()) as cursor:
+                cursor.execute("BEGIN IMMEDIATE")
+                result = operation(cursor)
+            db.commit()
+            return result
+        # Соединение с файлом не обрывается, повторять нечего
+        return self.pool.run(query, retry=False)
+
+    def read(self, sql, parameters=()):
+        """Все строки результата запроса"""
+        return self.pool.run(lambda db: db.execute(sql, parameters).fetchall())
+
+    def get_songs_count(self):
+        return self.read("SELECT COALESCE(SUM(songs), 0) FROM mark_stats WHERE owner_id = ?", (self.owner_id,))[0][0]
+
+    def get_stats(self, recent_limit=STATS_RECENT_LIMIT):
+        def query(db):
+            with closing(db.cursor()) as cursor:
+                # Читающая транзакция: все три запроса видят один снимок БД
+                cursor.execute("BEGIN")
+                marks = cursor.execute("SELECT mark, songs FROM mark_stats WHERE owner_id = ? AND songs > 0 "
+                                       "ORDER BY mark", (self.owner_id,)).fetchall()
+                tags = cursor.execute("SELECT name, songs FROM tag_stats WHERE owner_id = ? AND songs > 0 "
+                                      "ORDER BY songs DESC, name", (self.owner_id,)).fetchall()
+                recent = cursor.execute("SELECT id, title, artist, tags, mark FROM repertuar WHERE owner_id = ? "
+                                        "ORDER BY open_time DESC, id DESC LIMIT ?",
+                                        (self.owner_id, recent_limit)).fetchall()
+            db.commit()
+            return marks, tags, recent
+        marks, tags, recent = self.pool.run(query)
+        return RepertuarStats(sum(songs for _, songs in marks), marks, tags, [Song(*row) for row in recent])
+
+    def save_stats(self, cursor, tag_deltas, mark_deltas):
+        """Применение изменений (см. stats_deltas) к сводкам владельца в tag_stats и mark_stats"""
+        cursor.executemany("INSERT INTO tag_stats (owner_id, name, songs) VALUES (?, ?, ?) "
+                           "ON CONFLICT (owner_id, name) DO UPDATE SET songs = songs + excluded.songs",
+                           [(self.owner_id, *delta) for delta in tag_deltas])
+        cursor.executemany("INSERT INTO mark_stats (owner_id, mark, songs) VALUES (?, ?, ?) "
+                           "ON CONFLICT (owner_id, mark) DO UPDATE SET songs = songs + excluded.songs",
+                           [(self.owner_id, *delta) for delta in mark_deltas])
+
+    def rebuild_stats(self, cursor):
+        """Пересчёт сводных таблиц всех владельцев по repertuar и song_tags.
+        Из миграции "сводные таблицы статистики" вызывается до появления owner_id - тогда без владельцев
+        """
+        cursor.execute("SELECT COUNT(*) FROM pragma_table_info('tag_stats') WHERE name = 'owner_id'")
+        column, owner = ("owner_id, ", "r.owner_id, ") if cursor.fetchone()[0] else ("", "")
+        cursor.execute("DELETE FROM tag_stats")
+        cursor.execute("DELETE FROM mark_stats")
+        cursor.execute(f"""
+            INSERT INTO tag_stats ({column}name, songs)
+            SELECT {owner}tags.name, COUNT(*) FROM song_tags
+            JOIN tags ON tags.id = song_tags.tag_id
+            JOIN repertuar r ON r.id = song_tags.song_id
+            GROUP BY {owner}tags.name
+        """)
+        cursor.execute(f"""
+            INSERT INTO mark_stats ({column}mark, songs)
+            SELECT {owner}COALESCE(r.mark, 0), COUNT(*) FROM repertuar r GROUP BY {owner}COALESCE(r.mark, 0)
+        """)
+
+    def refresh_stats(self):
+        self.write(self.rebuild_stats)
+
+    def save_song_tags(self, cursor, songs):
+        """Заполнение tags и song_tags для пар (идентификатор композиции, строка тегов через запятую)"""
+        pairs = [(song_id, name) for song_id, tags in songs for name in split_tags(tags)]
+        if not pairs:
+            return
+        names = sorted({name for _, name in pairs})
+        cursor.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(name,) for name in names])
+        cursor.executemany("INSERT OR IGNORE INTO song_tags (song_id, tag_id) SELECT ?, id FROM tags WHERE name = ?",
+                           pairs)
+
+    def get_tags(self):
+        # Теги с композициями владельца - по его сводке tag_stats
+        rows = self.read("SELECT name FROM tag_stats WHERE owner_id = ? AND songs > 0 ORDER BY name", (self.owner_id,))
+        return ', '.join([row[0] for row in rows])
+
+    def get_tag_counts(self):
+        return self.read("SELECT name, songs FROM tag_stats WHERE owner_id = ? AND songs > 0 "
+                         "ORDER BY songs DESC, name", (self.owner_id,))
+
+    def get_songs_by_tag(self, tag, limit=50):
+        rows = self.read("""
+            SELECT r.id, r.title, r.artist, r.tags, r.mark FROM tags
+            JOIN song_tags st ON st.tag_id = tags.id
+            JOIN repertuar r ON r.id = st.song_id
+            WHERE tags.name = ? AND r.owner_id = ?
+            ORDER BY r.artist, r.title
+            LIMIT ?;
+        """, (normalize_tag(tag), self.owner_id, limit))
+        return [Song(*row) for row in rows]
+
+    def get_random_song_by_tag(self, tag):
+        # Случайное смещение в индексе song_tags_tag_id_idx: без сортировки, читаются только записи тега
+        rows = self.read("""
+            SELECT r.id, r.title, r.artist, r.tags, r.mark FROM song_tags st
+            JOIN repertuar r ON r.id = st.song_id
+            WHERE st.tag_id = (SELECT id FROM tags WHERE name = :tag) AND r.owner_id = :owner_id
+            LIMIT 1 OFFSET (SELECT abs(random()) % max(COUNT(*), 1) FROM song_tags st
+                            JOIN repertuar r ON r.id = st.song_id
+                            WHERE st.tag_id = (SELECT id FROM tags WHERE name = :tag) AND r.owner_id = :owner_id);
+        """, dict(tag=tag, owner_id=self.owner_id))
+        if rows:
+            return Song(*rows[0])
+
+    def get_song_marks(self):
+        return self.read("SELECT id, mark, ? - last_shown FROM repertuar WHERE owner_id = ?",
+                         (time.time(), self.owner_id))
+
+    def save_last_shown(self, shown):
+        now = time.time()
+        self.write(lambda cursor: cursor.executemany(
+            "UPDATE repertuar SET last_shown = ?1 WHERE id = ?2 AND (last_shown IS NULL OR last_shown < ?1)",
+            [(now - age, song_id) for song_id, age in sorted(shown.items())]))
+
+    def get_song(self, song_id) -> Song:
+        rows = self.read("SELECT id, title, artist, tags, mark FROM repertuar WHERE id = ? AND owner_id = ?",
+                         (song_id, self.owner_id))
+        if rows:
+            id, title, artist, tags, mark = rows[0]
+            return Song(id, title, artist, tags, mark)
+
+    def get_songs(self, song_ids):
+        # Список передаётся одним параметром (JSON) - текст запроса и подготовленный запрос не зависят от длины
+        rows = self.read("SELECT id, title, artist, tags, mark FROM repertuar "
+                         "WHERE id IN (SELECT value FROM json_each(?)) AND owner_id = ?",
+                         (json.dumps(list(song_ids)), self.owner_id))
+        return [Song(*row) for row in rows]
+
+    def search_songs(self, query, limit=10, offset=0):
+        # Вхождение подстроки: по триграммному индексу, для запросов короче триграммы - просмотром таблицы
+        query = query.strip().lower()
+        if not query:
+            return []
+        if len(query) >= FTS_MIN_QUERY_LENGTH:
+            # Запрос целиком - одна фраза FTS5, кавычки внутри удваиваются
+            rows = self.read("""
+                SELECT r.id, r.title, r.artist, r.tags, r.mark FROM repertuar_search s
+                JOIN repertuar r ON r.id = s.rowid
+                WHERE repertuar_search MATCH ? AND r.owner_id = ?
+                ORDER BY s.rank, r.artist, r.title
+                LIMIT ? OFFSET ?;
+            """, ('"' + query.replace('"', '""') + '"', self.owner_id, limit, offset))
+        else:
+            rows = self.read("""
+                SELECT id, title, artist, tags, mark FROM repertuar
+                WHERE owner_id = ? AND instr(lower(title || ' ' || artist), ?) > 0
+                ORDER BY artist, title
+                LIMIT ? OFFSET ?;
+            """, (self.owner_id, query, limit, offset))
+        return [Song(*row) for row in rows]
+
+    def update_rating(self, song_id, mark):
+        def query(cursor):
+            # Прежняя оценка - для сводной таблицы mark_stats
+            old_marks = cursor.execute("SELECT mark FROM repertuar WHERE id = ? AND owner_id = ?",
+                                       (song_id, self.owner_id)).fetchall()
+            cursor.execute("UPDATE repertuar SET mark = ?, open_time = datetime('now', 'localtime') "
+                           "WHERE id = ? AND owner_id = ?", (mark, song_id, self.owner_id))
+            rows_updated = cursor.rowcount
+            self.save_stats(cursor, *self.stats_deltas([(None, old_mark) for old_mark, in old_marks],
+                                                       [(None, mark)] * len(old_marks)))
+            return rows_updated
+        rows_updated = self.write(query)
+        self.deck.set_mark(song_id, mark)
+        return rows_updated
+
+    def update_ratings(self, marks):
+        marks = dict(marks)
+        if not marks:
+            return 0
+
+        def query(cursor):
+            # Прежние оценки изменяемых композиций - для mark_stats
+            cursor.execute("SELECT id, mark FROM repertuar "
+                           "WHERE id IN (SELECT value FROM json_each(?)) AND owner_id = ?",
+                           (json.dumps(list(marks)), self.owner_id))
+            changed = [(song_id, old_mark) for song_id, old_mark in cursor.fetchall() if old_mark != marks[song_id]]
+            cursor.executemany("UPDATE repertuar SET mark = ?1, open_time = datetime('now', 'localtime') "
+                               "WHERE id = ?2 AND owner_id = ?3 AND mark <> ?1",
+                               [(mark, song_id, self.owner_id) for song_id, mark in marks.items()])
+            rows_updated = cursor.rowcount
+            self.save_stats(cursor, *self.stats_deltas([(None, old_mark) for _, old_mark in changed],
+                                                       [(None, marks[song_id]) for song_id, _ in changed]))
+            return rows_updated
+        rows_updated = self.write(query)
+        for song_id, mark in marks.items():
+            self.deck.set_mark(song_id, mark)
+        return rows_updated
+
+    def add_song(self, title, artist, tags, mark=0):
+        def query(cursor):
+            cursor.execute("INSERT INTO repertuar (owner_id, title, artist, tags, mark) VALUES (?, ?, ?, ?, ?)",
+                           (self.owner_id, title, artist, tags, mark))
+            song_id = cursor.lastrowid
+            self.save_song_tags(cursor, [(song_id, tags)])
+            self.save_stats(cursor, *self.stats_deltas([], [(tags, mark)]))
+            return song_id
+
+        try:
+            song_id = self.write(query)
+            self.deck.add([(song_id, mark)])
+            return 0
+        except sqlite3.IntegrityError as e:
+            self.logger.error(e)
+            return 1  # дубль
+        except sqlite3.DatabaseError as e:
+            self.logger.error(e)
+            return 2
+        except Exception as e:
+            self.logger.error(e)
+        return 99
+
+    def add_songs_bulk(self, rows):
+        result = BulkInsertResult()
+        songs = self.prepare_bulk_rows(rows, result, self.logger)
+        if not songs:
+            return result
+        return self.load_songs_bulk(self.bulk_batches(songs), result, self.insert_batch)
+
+    def upsert_songs_bulk(self, rows, progress=None):
+        result = BulkInsertResult()
+        songs = self.iter_bulk_rows(rows, result, self.logger)
+        return self.load_songs_bulk(self.upsert_batches(songs, result), result, self.upsert_batch, progress)
+
+    def insert_batch(self, cursor, batch):
+        """Вставка пачки без дублей; возвращает добавленные и изменённые пары (идентификатор, оценка)"""
+        # executemany не возвращает строки RETURNING - вставка по одной строке
+        # тем же подготовленным запросом, в одной транзакции это дёшево
+        inserted = []
+        for song in batch:
+            cursor.execute("INSERT INTO repertuar (owner_id, title, artist, tags, mark) VALUES (?, ?, ?, ?, ?) "
+                           "ON CONFLICT (owner_id, title, artist) DO NOTHING RETURNING id, mark, tags",
+                           (self.owner_id, *song))
+            inserted.extend(cursor.fetchall())
+        self.save_song_tags(cursor, [(song_id, tags) for song_id, _, tags in inserted])
+        self.save_stats(cursor, *self.stats_deltas([], [(tags, mark) for _, mark, tags in inserted]))
+        return [(song_id, mark) for song_id, mark, _ in inserted], []
+
+    def upsert_batch(self, cursor, batch):
+        """Вставка пачки с обновлением тегов и оценок сохранённых композиций, если они отличаются"""
+        inserted, updated, removed = [], [], []
+        for song in batch:
+            cursor.execute("INSERT INTO repertuar (owner_id, title, artist, tags, mark) VALUES (?, ?, ?, ?, ?) "
+                           "ON CONFLICT (owner_id, title, artist) DO NOTHING RETURNING id, mark, tags",
+                           (self.owner_id, *song))
+            rows = cursor.fetchall()
+            if not rows:
+                # Прежние теги и оценка - для сводных таблиц (RETURNING возвращает уже новые)
+                old = cursor.execute("SELECT tags, mark FROM repertuar WHERE owner_id = ? AND title = ? AND artist = ?",
+                                     (self.owner_id, *song[:2])).fetchone()
+                cursor.execute("UPDATE repertuar SET tags = ?3, mark = ?4, open_time = datetime('now', 'localtime') "
+                               "WHERE owner_id = ?5 AND title = ?1 AND artist = ?2 "
+                               "AND (tags IS NOT ?3 OR mark IS NOT ?4) RETURNING id, mark, tags",
+                               (*song, self.owner_id))
+                changed = cursor.fetchall()
+                if changed:
+                    removed.append(old)
+                updated.extend(changed)
+            inserted.extend(rows)
+        if updated:
+            cursor.execute("DELETE FROM song_tags WHERE song_id IN (SELECT value FROM json_each(?))",
+                           (json.dumps([song_id for song_id, _, _ in updated]),))
+        self.save_song_tags(cursor, [(song_id, tags) for song_id, _, tags in inserted + updated])
+        self.save_stats(cursor, *self.stats_deltas(removed, [(tags, mark) for _, mark, tags in inserted + updated]))
+        return [(song_id, mark) for song_id, mark, _ in inserted], [(song_id, mark) for song_id, mark, _ in updated]
+
+    def load_songs_bulk(self, batches, result, load_batch, progress=None):
+        """Загрузка пачек композиций в одной транзакции через load_batch(cursor, batch)"""
+        songs_added, songs_updated = [], []
+
+        def query(cursor):
+            for batch in batches:
+                # Точка сохранения, чтобы ошибка в одной пачке не откатывала всю загрузку
+                cursor.execute("SAVEPOINT bulk_batch")
+                try:
+                    added, updated = load_batch(cursor, batch)
+                except sqlite3.DatabaseError as e:
+                    self.logger.error(e)
+                    cursor.execute("ROLLBACK TO SAVEPOINT bulk_batch")
+                    cursor.execute("RELEASE SAVEPOINT bulk_batch")
+                    result.db_errors += len(batch)
+                    continue
+                cursor.execute("RELEASE SAVEPOINT bulk_batch")
+                songs_added.extend(added)
+                songs_updated.extend(updated)
+                result.success += len(added) + len(updated)
+                result.duplicates += len(batch) - len(added) - len(updated)
+                if progress is not None:
+                    progress(result)
+
+        try:
+            self.write(query)
+            self.deck.add(songs_added)
+            for song_id, mark in songs_updated:
+                self.deck.set_mark(song_id, mark)
+        except sqlite3.DatabaseError as e:
+            self.logger.error(e)
+            # Транзакция не зафиксирована - всё, что считалось добавленным, не сохранилось
+            result.db_errors += result.success
+            result.success = 0
+        return result
+
+    def add_song_request(self, chat_id, username, composition):
+        def query(cursor):
+            cursor.execute("INSERT INTO song_requests (owner_id, chat_id, username, composition) VALUES (?, ?, ?, ?)",
+                           (self.owner_id, chat_id, username, composition[:255]))
+            return cursor.lastrowid
+        return self.write(query)
+
+    def claim_song_requests(self, limit):
+        # Запись в SQLite одна на всю БД: BEGIN IMMEDIATE не даёт двум процессам забрать одни и те же заказы
+        def query(cursor):
+            cursor.execute("""
+                UPDATE song_requests SET status = 'sent'
+                WHERE id IN (SELECT id FROM song_requests WHERE owner_id = ? AND status = 'new'
+                             ORDER BY created_at, id LIMIT ?)
+                RETURNING id, chat_id, username, composition, status, created_at;
+            """, (self.owner_id, limit))
+            return cursor.fetchall()
+        requests = [SongRequest(*row[:5], _datetime(row[5])) for row in self.write(query)]
+        return sorted(requests, key=lambda request: (request.created_at, request.id))
+
+    def set_song_requests_status(self, request_ids, status):
+        def query(cursor):
+            cursor.execute("UPDATE song_requests SET status = ? "
+                           "WHERE id IN (SELECT value FROM json_each(?)) AND owner_id = ?",
+                           (status, json.dumps(list(request_ids)), self.owner_id))
+            return cursor.rowcount
+        return self.write(query)
+
+    def get_pending_song_requests(self, limit=10, offset=0):
+        rows = self.read("""
+            SELECT id, chat_id, username, composition, status, created_at FROM song_requests
+            WHERE owner_id = ? AND status IN ('new', 'sent')
+            ORDER BY created_at, id
+            LIMIT ? OFFSET ?;
+        """, (self.owner_id, limit, offset))
+        return [SongRequest(*row[:5], _datetime(row[5])) for row in rows]
+
+    def get_state(self, chat_id):
+        rows = self.read("SELECT state FROM chat_states WHERE chat_id = ? AND expires_at > ?",
+                         (chat_id, time.time()))
+        if rows:
+            return rows[0][0]
+
+    def set_state(self, chat_id, state, ttl):
+        def query(cursor):
+            cursor.execute("""
+                INSERT INTO chat_states (chat_id, state, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at;
+            """, (chat_id, state, time.time() + ttl))
+        self.write(query)
+
+    def delete_state(self, chat_id):
+        self.write(lambda cursor: cursor.execute("DELETE FROM chat_states WHERE chat_id = ?", (chat_id,)))
+
+    def purge_states(self):
+        def query(cursor):
+            cursor.execute("DELETE FROM chat_states WHERE expires_at <= ?", (time.time(),))
+            return cursor.rowcount
+        return self.write(query)
+
+    def get_chat_owner(self, chat_id):
+        rows = self.read("SELECT owner_id FROM chat_owners WHERE chat_id = ?", (chat_id,))
+        if rows:
+            return rows[0][0]
+
+    def set_chat_owner(self, chat_id, owner_id):
+        self.write(lambda cursor: cursor.execute(
+            "INSERT INTO chat_owners (chat_id, owner_id) VALUES (?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET owner_id = excluded.owner_id", (chat_id, owner_id)))
+
+    def get_admin_chat(self):
+        rows = self.read("SELECT chat_id FROM admin_chats WHERE owner_id = ?", (self.owner_id,))
+        if rows:
+            return rows[0][0]
+
+    def set_admin_chat(self, chat_id):
+        self.write(lambda cursor: cursor.execute(
+            "INSERT INTO admin_chats (owner_id, chat_id) VALUES (?, ?) "
+            "ON CONFLICT (owner_id) DO UPDATE SET chat_id = excluded.chat_id", (self.owner_id, chat_id)))
+
+    def backup_since(self, cursor, kind):
+        """Время, начиная с которого выгружаются изменения для бэкапа вида kind (None - выгружаются все)"""
+        if kind == BACKUP_FULL:
+            return None
+        cursor.execute("SELECT datetime(MAX(started_at), :overlap) FROM backups WHERE owner_id = :owner_id"
+                       + (" AND kind = :full" if kind == BACKUP_DIFFERENTIAL else ""),
+                       dict(overlap=f'-{BACKUP_OVERLAP_SECONDS} seconds', full=BACKUP_FULL, owner_id=self.owner_id))
+        return cursor.fetchone()[0]
+
+    def backup(self, compress=False, kind=BACKUP_FULL):
+        """Выгрузка композиций в CSV порциями по BACKUP_FETCH_SIZE строк, без загрузки таблицы в память"""
+        buffer = tempfile.SpooledTemporaryFile(BACKUP_SPOOL_SIZE)
+
+        def query(db):
+            with closing(db.cursor()) as cursor, open_backup_stream(buffer, compress) as stream:
+                # Читающая транзакция: выгрузка идёт по одному снимку БД и не блокирует запись
+                cursor.execute("BEGIN")
+                since = self.backup_since(cursor, kind)
+                cursor.execute("SELECT datetime('now', 'localtime')")
+                started_at = cursor.fetchone()[0]
+                text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+                writer = csv.writer(text_stream, delimiter=';', lineterminator='\n')
+                # Изменения после контрольной точки находятся по индексу repertuar_owner_open_time_idx
+                if since is None:
+                    cursor.execute("SELECT title, artist, tags, mark FROM repertuar WHERE owner_id = ? ORDER BY id",
+                                   (self.owner_id,))
+                else:
+                    cursor.execute("SELECT title, artist, tags, mark FROM repertuar "
+                                   "WHERE owner_id = ? AND open_time >= ? ORDER BY id", (self.owner_id, since))
+                rows = cursor.fetchmany(BACKUP_FETCH_SIZE)
+                while rows:
+                    writer.writerows(rows)
+                    rows = cursor.fetchmany(BACKUP_FETCH_SIZE)
+                text_stream.flush()
+                text_stream.detach()  # stream закрывается не здесь
+            db.commit()
+            return since, started_at
+
+        try:
+            since, started_at = self.pool.run(query)
+            # Контрольная точка - время до начала выгрузки, сохраняется после её завершения
+            self.write(lambda cursor: cursor.execute(
+                "INSERT INTO backups (owner_id, kind, started_at) VALUES (?, ?, ?)",
+                (self.owner_id, kind if since is not None else BACKUP_FULL, started_at)))
+        except BaseException:
+            buffer.close()
+            raise
+        self.logger.info(f"Бэкап ({kind}) завершён. Размер: {buffer.tell()} байт")
+        buffer.seek(0)
+        return buffer
@@ -0,0 +1,138 @@
+import itertools
+import json
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+from storage_manager.cache import TTLCache
+from storage_manager.lazy_storage_manager import StorageUnavailable
+
+
+class StateStore:
+    """Хранилище состояний многошаговых диалогов (/add, /addcsv, заказ композиции).
+    Состояние чата - имя следующего шага и его аргументы, сохранённые компактной JSON-строкой,
+    поэтому оно не привязано к замыканиям процесса. Состояние истекает через ttl секунд:
+    брошенные на полпути диалоги не копятся.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    @staticmethod
+    def dumps(step, args):
+        return json.dumps([step, list(args)], ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def loads(state):
+        step, args = json.loads(state)
+        return step, args
+
+    def get(self, chat_id):
+        """Пара (имя шага, список аргументов) или None, если диалога нет или он истёк"""
+        state = self._get(chat_id)
+        if state is not None:
+            return self.loads(state)
+
+    def set(self, chat_id, step, args=()):
+        self._set(chat_id, self.dumps(step, args))
+
+    @abstractmethod
+    def _get(self, chat_id):
+        ...
+
+    @abstractmethod
+    def _set(self, chat_id, state):
+        ...
+
+    @abstractmethod
+    def delete(self, chat_id):
+        ...
+
+
+class MemoryStateStore(StateStore):
+    """Состояния в памяти процесса: быстро, но теряются при перезапуске и не видны другим процессам"""
+
+    def __init__(self, ttl=3600, maxsize=10000):
+        super().__init__(ttl)
+        self.maxsize = maxsize
+        # Чат -> (время истечения, состояние). Срок у всех одинаковый, поэтому порядок записи - это и порядок
+        # истечения: истёкшие состояния снимаются с начала словаря
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        while self._states:
+            expires_at, _ = next(iter(self._states.values()))
+            if expires_at > now:
+                break
+            self._states.popitem(last=False)
+
+    def _get(self, chat_id):
+        with self._lock:
+            self._purge(time.monotonic())
+            item = self._states.get(chat_id)
+            if item is not None:
+                return item[1]
+
+    def _set(self, chat_id, state):
+        with self._lock:
+            now = time.monotonic()
+            self._states.pop(chat_id, None)
+            self._states[chat_id] = (now + self.ttl, state)
+            self._purge(now)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._states.pop(chat_id, None)
+
+
+class DatabaseStateStore(StateStore):
+    """Состояния в таблице chat_states БД хранилища: переживают перезапуск и доступны всем процессам бота.
+    Диалог проверяется для каждого текстового сообщения, а у большинства чатов его нет, поэтому отсутствие
+    диалога запоминается в памяти процесса на absent_ttl секунд (set и delete этого процесса сбрасывают запись).
+    Диалог, начатый в другом процессе бота, становится виден не позже чем через absent_ttl секунд.
+    """
+
+    def __init__(self, storage, ttl=3600, purge_every=100, absent_ttl=60, absent_maxsize=10000):
+        """purge_every - раз в сколько записей удалять из таблицы истёкшие состояния,
+        absent_ttl - сколько секунд помнить, что у чата нет диалога (0 - не помнить)"""
+        super().__init__(ttl)
+        self.storage = storage
+        self.purge_every = purge_every
+        self._writes = itertools.count(1)
+        self._absent = TTLCache(absent_maxsize, absent_ttl) if absent_ttl else None
+
+    def _get(self, chat_id):
+        generation = None
+        if self._absent is not None:
+            if self._absent.get(chat_id, False):
+                return None
+            generation = self._absent.generation(chat_id)
+        # Пока хранилище не готово, диалогов нет: состояние проверяется для каждого сообщения,
+        # и команды, которым БД не нужна (/start, /metrics), должны отвечать и без неё
+        try:
+            state = self.storage.get_state(chat_id)
+        except StorageUnavailable:
+            return None
+        if state is None and self._absent is not None:
+            # Не сохраняется, если за время чтения диалог начали (см. TTLCache.generation)
+            self._absent.set(chat_id, True, generation)
+        return state
+
+    def _set(self, chat_id, state):
+        self.storage.set_state(chat_id, state, self.ttl)
+        self._forget(chat_id)
+        if next(self._writes) % self.purge_every == 0:
+            self.storage.purge_states()
+
+    def delete(self, chat_id):
+        self.storage.delete_state(chat_id)
+        self._forget(chat_id)
+
+    def _forget(self, chat_id):
+        if self._absent is not None:
+            self._absent.invalidate(chat_id)
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+
+from storage_manager import DEFAULT_OWNER_ID
+from storage_manager.cache import TTLCache
+
+CACHE_COUNTERS = ('hits', 'misses', 'evictions')
+
+
+class TenantStorageManager:
+    """Хранилища репертуаров нескольких владельцев (музыкантов) в одном процессе.
+    Все владельцы работают через один пул соединений. Хранилище владельца (StorageManager.for_owner,
+    обёрнутое в wrap - например, в кэш) создаётся при первом обращении; в памяти держатся не более max_owners
+    хранилищ, давно не использовавшиеся вытесняются (LRU), и их ещё не сохранённые показы записываются в БД.
+    Выбор владельца чатом слушателя (get_chat_owner/set_chat_owner) кэшируется на chat_owner_ttl секунд.
+    Прочие атрибуты - от хранилища владельца по умолчанию.
+    """
+
+    def __init__(self, storage, wrap=None, max_owners=100, chat_owner_cache_size=10000, chat_owner_ttl=300):
+        self.storage = storage
+        self.logger = storage.logger
+        self.pool = storage.pool
+        self.max_owners = max_owners
+        self.chat_owners = TTLCache(chat_owner_cache_size, chat_owner_ttl)
+        self.evictions = 0
+        self._wrap = wrap or (lambda owner_storage: owner_storage)
+        self._owners = OrderedDict()  # владелец -> хранилище, от давно не использовавшихся к недавним
+        self._evicted_cache = dict.fromkeys(CACHE_COUNTERS, 0)  # счётчики кэшей вытесненных хранилищ
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._owners)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.for_owner(DEFAULT_OWNER_ID), name)
+
+    def for_owner(self, owner_id):
+        """Хранилище репертуара владельца owner_id (без обращения к БД)"""
+        evicted = []
+        with self._lock:
+            storage = self._owners.get(owner_id)
+            if storage is not None:
+                self._owners.move_to_end(owner_id)
+                return storage
+            storage = self._wrap(self.storage if owner_id == self.storage.owner_id
+                                 else self.storage.for_owner(owner_id))
+            self._owners[owner_id] = storage
+            while len(self._owners) > self.max_owners:
+                evicted.append(self._owners.popitem(last=False)[1])
+            self.evictions += len(evicted)
+        for old in evicted:
+            self._evict(old)
+        return storage
+
+    def _evict(self, storage):
+        cache = getattr(storage, 'cache', None)
+        if cache is not None:
+            stats = cache.stats()
+            with self._lock:
+                for name in CACHE_COUNTERS:
+                    self._evicted_cache[name] += stats[name]
+        try:
+            storage.deck.save()
+        except Exception as e:
+            self.logger.error(f"Не удалось сохранить показы композиций владельца {storage.owner_id}: {e}")
+
+    def cache_stats(self):
+        """Счётчики кэшей хранилищ всех владельцев (включая вытесненные) в формате TTLCache.stats()"""
+        with self._lock:
+            storages = list(self._owners.values())
+            totals = dict(self._evicted_cache)
+        size = 0
+        for storage in storages:
+            cache = getattr(storage, 'cache', None)
+            if cache is None:
+                continue
+            stats = cache.stats()
+            for name in CACHE_COUNTERS:
+                totals[name] += stats[name]
+            size += stats['size']
+        requests = totals['hits'] + totals['misses']
+        return dict(totals, hit_rate=round(totals['hits'] / requests, 3) if requests else 0.0, size=size)
+
+    def get_chat_owner(self, chat_id):
+        return self.chat_owners.get_or_load(chat_id,
+                                            lambda: self.for_owner(DEFAULT_OWNER_ID).get_chat_owner(chat_id))
+
+    def set_chat_owner(self, chat_id, owner_id):
+        # Другие процессы бота увидят новый выбор не позже чем через chat_owner_ttl секунд
+        self.for_owner(DEFAULT_OWNER_ID).set_chat_owner(chat_id, owner_id)
+        self.chat_owners.set(chat_id, owner_id)
@@ -0,0 +1,262 @@
+"""Отправка сообщений с учётом лимитов Telegram: около 30 сообщений в секунду всего,
+около одного в секунду в один чат и 20 в минуту в одну группу.
+
+RateLimitedBot (для TeleBot) и AsyncRateLimitedBot (для AsyncTeleBot) - обёртки над ботом:
+методы отправки в чат ждут своей очереди по токен-бакетам (общему и чата), а при ответе 429
+выжидают retry_after и повторяют запрос. Остальные атрибуты (декораторы обработчиков, polling и т.п.)
+берутся у бота без изменений. Несрочные сообщения ставятся в очередь с приоритетом (enqueue)
+и отправляются фоновым обработчиком, не задерживая ответы на команды.
+"""
+import asyncio
+import inspect
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+# Позиция аргумента chat_id у методов, отправляющих сообщения в чат
+CHAT_ARGUMENT = {
+    'send_message': 0,
+    'send_document': 0,
+    'send_photo': 0,
+    'send_audio': 0,
+    'forward_message': 0,
+    'copy_message': 0,
+    'edit_message_text': 1,
+    'edit_message_reply_markup': 0,
+    'delete_message': 0,
+}
+
+
+class TokenBucket:
+    """Токен-бакет в виде GCRA: rate сообщений в секунду, до burst сообщений подряд без ожидания.
+    Вместо количества токенов хранится время, когда бакет снова станет полным.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self._full_at = 0
+
+    def reserve(self, at):
+        """Занять место для сообщения не раньше момента at; возвращает момент, когда его можно отправить"""
+        start = max(at, self._full_at - self.tolerance)
+        self._full_at = max(self._full_at, start) + self.interval
+        return start
+
+    def pause(self, until):
+        """Не отправлять до момента until (ответ 429 с retry_after)"""
+        self._full_at = max(self._full_at, until + self.tolerance)
+
+
+class RateLimiter:
+    """Общий бакет бота и бакеты чатов (для групп - с минутным лимитом).
+    Бакеты давно не писавших чатов вытесняются, когда их больше max_chats.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, group_burst=5,
+                 max_chats=10000):
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.pop(chat_id, None)
+        if bucket is None:
+            # Идентификаторы групп и каналов отрицательные
+            bucket = TokenBucket(self.group_rate, self.group_burst) if chat_id < 0 else \
+                TokenBucket(self.chat_rate, self.chat_burst)
+        self._chats[chat_id] = bucket
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return bucket
+
+    def reserve(self, chat_id=None):
+        """Занять место для сообщения в чат; возвращает, сколько секунд подождать перед отправкой"""
+        with self._lock:
+            now = time.monotonic()
+            # Бакеты занимаются независимо: очередь в один чат не должна задерживать остальные чаты
+            start = self._global.reserve(now)
+            if isinstance(chat_id, int):
+                start = max(start, self._bucket(chat_id).reserve(now))
+            return start - now
+
+    def pause(self, chat_id, seconds):
+        with self._lock:
+            until = time.monotonic() + seconds
+            if isinstance(chat_id, int):
+                self._bucket(chat_id).pause(until)
+            else:
+                self._global.pause(until)
+
+
+def chat_argument(method, args, kwargs):
+    if 'chat_id' in kwargs:
+        return kwargs['chat_id']
+    position = CHAT_ARGUMENT[method]
+    if len(args) > position:
+        return args[position]
+
+
+def error_code(exception):
+    """Код ошибки Telegram API (для остальных исключений - имя класса)"""
+    return str(getattr(exception, 'error_code', None) or type(exception).__name__)
+
+
+def retry_after(exception):
+    """Сколько секунд ждать по ответу 429 Too Many Requests (None для остальных ошибок)"""
+    if getattr(exception, 'error_code', None) != 429:
+        return None
+    return (getattr(exception, 'result_json', None) or {}).get('parameters', {}).get('retry_after', 1)
+
+
+class RateLimitedBot:
+    """Обёртка над TeleBot с ограничением частоты отправки и очередью несрочных сообщений"""
+
+    def __init__(self, bot, limiter=None, max_retries=3, logger=None):
+        self.bot = bot
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.logger = logger or logging.getLogger('repertuar_bot')
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._worker = None
+        self._errors = {}  # (метод, код ошибки) -> количество
+        self._errors_lock = threading.Lock()  # счётчики обновляются из потоков обработчиков и читаются метриками
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.bot, name)
+        if name not in CHAT_ARGUMENT:
+            return attr
+
+        def call(*args, **kwargs):
+            return self._call(name, args, kwargs)
+        return call
+
+    def _call(self, method, args, kwargs):
+        chat_id = chat_argument(method, args, kwargs)
+        for attempt in range(self.max_retries + 1):
+            delay = self.limiter.reserve(chat_id)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                return getattr(self.bot, method)(*args, **kwargs)
+            except Exception as e:
+                key = (method, error_code(e))
+                with self._errors_lock:
+                    self._errors[key] = self._errors.get(key, 0) + 1
+                seconds = retry_after(e)
+                if seconds is None or attempt == self.max_retries:
+                    raise
+                self.logger.warning(f"Telegram просит подождать {seconds} с перед {method} в чат {chat_id}")
+                self.limiter.pause(chat_id, seconds)
+
+    def error_counts(self):
+        """Количество ошибок Telegram API: {(метод, код ошибки): количество}"""
+        with self._errors_lock:
+            return dict(self._errors)
+
+    def enqueue(self, method, *args, priority=PRIORITY_NORMAL, on_error=None, **kwargs):
+        """Поставить вызов метода отправки в очередь; при одинаковом приоритете - в порядке постановки.
+        on_error(exception) вызывается, если отправить так и не удалось.
+        """
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, name='telegram-sender', daemon=True)
+                self._worker.start()
+        self._queue.put((priority, next(self._sequence), method, args, kwargs, on_error))
+
+    def _work(self):
+        while True:
+            _, _, method, args, kwargs, on_error = self._queue.get()
+            try:
+                self._call(method, args, kwargs)
+            except Exception as e:
+                self.logger.error(f"Не удалось выполнить {method} из очереди: {e}")
+                if on_error is not None:
+                    try:
+                        on_error(e)
+                    except Exception as error:
+                        self.logger.error(error)
+
+
+class AsyncRateLimitedBot:
+    """Обёртка над AsyncTeleBot с ограничением частоты отправки и очередью несрочных сообщений"""
+
+    def __init__(self, bot, limiter=None, max_retries=3, logger=None):
+        self.bot = bot
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.logger = logger or logging.getLogger('repertuar_bot')
+        self._queue = None
+        self._sequence = itertools.count()
+        self._worker = None
+        self._errors = {}  # (метод, код ошибки) -> количество
+        self._errors_lock = threading.Lock()  # счётчики обновляются из потоков обработчиков и читаются метриками
+
+    def __getattr__(self, name):
+        attr = getattr(self.bot, name)
+        if name not in CHAT_ARGUMENT:
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self._call(name, args, kwargs)
+        return call
+
+    async def _call(self, method, args, kwargs):
+        chat_id = chat_argument(method, args, kwargs)
+        for attempt in range(self.max_retries + 1):
+            delay = self.limiter.reserve(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await getattr(self.bot, method)(*args, **kwargs)
+            except Exception as e:
+                key = (method, error_code(e))
+                with self._errors_lock:
+                    self._errors[key] = self._errors.get(key, 0) + 1
+                seconds = retry_after(e)
+                if seconds is None or attempt == self.max_retries:
+                    raise
+                self.logger.warning(f"Telegram просит подождать {seconds} с перед {method} в чат {chat_id}")
+                self.limiter.pause(chat_id, seconds)
+
+    def error_counts(self):
+        """Количество ошибок Telegram API: {(метод, код ошибки): количество}"""
+        with self._errors_lock:
+            return dict(self._errors)
+
+    def enqueue(self, method, *args, priority=PRIORITY_NORMAL, on_error=None, **kwargs):
+        """Поставить вызов метода отправки в очередь; при одинаковом приоритете - в порядке постановки.
+        on_error(exception) (функция или корутина) вызывается, если отправить так и не удалось.
+        Вызывается из цикла событий, в котором работает бот.
+        """
+        if self._worker is None:
+            self._queue = asyncio.PriorityQueue()
+            self._worker = asyncio.create_task(self._work())
+        self._queue.put_nowait((priority, next(self._sequence), method, args, kwargs, on_error))
+
+    async def _work(self):
+        while True:
+            _, _, method, args, kwargs, on_error = await self._queue.get()
+            try:
+                await self._call(method, args, kwargs)
+            except Exception as e:
+                self.logger.error(f"Не удалось выполнить {method} из очереди: {e}")
+                if on_error is not None:
+                    try:
+                        result = on_error(e)
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception as error:
+                        self.logger.error(error)
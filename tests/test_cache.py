@@ -0,0 +1,137 @@
+"""Кэш с TTL (storage_manager/cache.py) и кэширующая обёртка хранилища (storage_manager/cached_storage_manager.py):
+устаревание записей, вытеснение, поколения ключей и сброс кэша при записи.
+
+    python -m unittest discover tests
+"""
+import logging
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage_manager.cache import TTLCache  # noqa: E402
+from storage_manager.cached_storage_manager import CachedStorageManager  # noqa: E402
+from storage_manager.sqlite_storage_manager import SqliteStorageManager  # noqa: E402
+
+logger = logging.getLogger('test_cache')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+class Clock:
+    """Подменяемое time.monotonic() модуля cache"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('storage_manager.cache.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entry_expires_after_ttl(self):
+        cache = TTLCache(ttl=10)
+        cache.set('key', 'value')
+        self.clock.now += 9.9
+        self.assertEqual(cache.get('key'), 'value')
+        self.clock.now += 0.1
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_read_entry_is_evicted(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_get_or_load_loads_once(self):
+        cache = TTLCache(ttl=10)
+        load = mock.Mock(return_value=42)
+        self.assertEqual(cache.get_or_load('key', load), 42)
+        self.assertEqual(cache.get_or_load('key', load), 42)
+        self.assertEqual(load.call_count, 1)
+        self.clock.now += 10
+        cache.get_or_load('key', load)
+        self.assertEqual(load.call_count, 2)
+
+    def test_value_loaded_before_invalidate_is_not_stored(self):
+        cache = TTLCache()
+        # Запись в БД (и invalidate) произошла, пока значение загружалось: загруженное значение могло устареть
+        generation = cache.generation('key')
+        cache.invalidate('key')
+        cache.set('key', 'stale', generation)
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', 'fresh', cache.generation('key'))
+        self.assertEqual(cache.get('key'), 'fresh')
+
+    def test_clear_drops_values_of_all_keys(self):
+        cache = TTLCache()
+        cache.set('a', 1)
+        generation = cache.generation('b')
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+        cache.set('b', 'stale', generation)
+        self.assertIsNone(cache.get('b'))
+
+
+class CachedStorageManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = SqliteStorageManager(logger, dict(database=os.path.join(directory.name, 'cache.sqlite3')))
+        self.addCleanup(storage.pool.close)
+        self.storage = storage.for_owner(0)
+        self.cached = CachedStorageManager(self.storage)
+        self.cached.add_song("Песня", "Автор", "рок", 2)
+        self.song_id = self.storage.search_songs("Песня")[0].id
+
+    def test_song_is_read_once(self):
+        with mock.patch.object(self.storage, 'get_song', wraps=self.storage.get_song) as get_song:
+            self.assertEqual(self.cached.get_song(self.song_id).mark, 2)
+            self.assertEqual(self.cached.get_songs([self.song_id])[0].mark, 2)
+            self.assertEqual(get_song.call_count, 1)
+
+    def test_rating_update_invalidates_song(self):
+        self.assertEqual(self.cached.get_song(self.song_id).mark, 2)
+        self.cached.update_rating(self.song_id, 5)
+        self.assertEqual(self.cached.get_song(self.song_id).mark, 5)
+        self.cached.update_ratings({self.song_id: 3})
+        self.assertEqual(self.cached.get_songs([self.song_id])[0].mark, 3)
+
+    def test_song_loaded_during_update_is_not_cached(self):
+        read = self.storage.get_song
+
+        def get_song(song_id):
+            # Другой поток успел прочитать композицию до записи оценки, а сохранить в кэш - после
+            song = read(song_id)
+            self.cached.update_rating(song_id, 5)
+            return song
+
+        with mock.patch.object(self.storage, 'get_song', get_song):
+            self.assertEqual(self.cached.get_song(self.song_id).mark, 2)
+        self.assertEqual(self.cached.get_song(self.song_id).mark, 5)
+
+    def test_adding_song_invalidates_count_and_tags(self):
+        self.assertEqual((self.cached.get_songs_count(), self.cached.get_tags()), (1, "рок"))
+        self.cached.add_song("Другая", "Автор", "джаз", 0)
+        self.assertEqual(self.cached.get_songs_count(), 2)
+        self.assertEqual(self.cached.get_tags(), "джаз, рок")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Пул соединений (storage_manager/connection_pool.py): однократный повтор запроса после потери соединения
+и проверка долго простаивавших соединений.
+
+    python -m unittest discover tests
+"""
+import logging
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage_manager.connection_pool import ConnectionPool  # noqa: E402
+
+logger = logging.getLogger('test_connection_pool')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+class FakeConnection:
+    """Соединение, которое можно «потерять»: alive=False"""
+
+    def __init__(self, number):
+        self.number = number
+        self.alive = True
+        self.closed = False
+        self.in_transaction = False
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Clock:
+    """Подменяемое time.monotonic() модуля connection_pool"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('storage_manager.connection_pool.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connections = []
+
+    def connect(self):
+        self.connections.append(FakeConnection(len(self.connections) + 1))
+        return self.connections[-1]
+
+    def pool(self, **pool_params):
+        return ConnectionPool(logger, self.connect, lambda db: db.alive, (ConnectionLost,), **pool_params)
+
+    @staticmethod
+    def query(db):
+        if not db.alive:
+            raise ConnectionLost(f"соединение {db.number} потеряно")
+        return db.number
+
+    def test_lost_connection_is_retried_once(self):
+        pool = self.pool()
+        self.connections[0].alive = False
+        self.assertEqual(pool.run(self.query), 2)
+        self.assertTrue(self.connections[0].closed)
+        stats = pool.stats()
+        self.assertEqual((stats['retries'], stats['disconnects'], stats['connects']), (1, 1, 2))
+        self.assertEqual((stats['size'], stats['idle']), (1, 1))
+        # Новое соединение вернулось в пул и выдаётся следующему запросу
+        self.assertEqual(pool.run(self.query), 2)
+
+    def test_second_failure_is_not_retried(self):
+        pool = self.pool()
+        operation = mock.Mock(side_effect=ConnectionLost("сервер БД недоступен"))
+        with self.assertRaises(ConnectionLost):
+            pool.run(operation)
+        self.assertEqual(operation.call_count, 2)
+        self.assertEqual(pool.stats()['retries'], 1)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_non_idempotent_operation_is_not_retried(self):
+        pool = self.pool()
+        self.connections[0].alive = False
+        with self.assertRaises(ConnectionLost):
+            pool.run(self.query, retry=False)
+        self.assertEqual(pool.stats()['retries'], 0)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_other_errors_keep_connection(self):
+        pool = self.pool()
+        with self.assertRaises(ValueError):
+            pool.run(mock.Mock(side_effect=ValueError("ошибка в запросе")))
+        self.assertFalse(self.connections[0].closed)
+        self.assertEqual(pool.run(self.query), 1)
+        self.assertEqual(pool.stats()['retries'], 0)
+
+    def test_idle_connection_is_probed(self):
+        pool = self.pool(probe_idle_seconds=60)
+        # Недавно использованное соединение не проверяется
+        self.clock.now += 30
+        self.assertEqual(pool.run(self.query), 1)
+        self.assertEqual(pool.stats()['probes'], 0)
+        # Долго простаивавшее потерянное соединение заменяется до запроса, без повтора самого запроса
+        self.connections[0].alive = False
+        self.clock.now += 61
+        self.assertEqual(pool.run(self.query), 2)
+        stats = pool.stats()
+        self.assertEqual((stats['probes'], stats['disconnects'], stats['retries']), (1, 1, 0))
+        self.assertTrue(self.connections[0].closed)
+
+    def test_lost_connection_expires_other_idle_connections(self):
+        pool = self.pool(min_size=2, probe_idle_seconds=60)
+        first, second = self.connections
+        first.alive = second.alive = False
+        # Сервер БД перезапускался: после потери одного соединения остальные проверяются при выдаче
+        self.assertEqual(pool.run(self.query), 3)
+        self.assertEqual(pool.stats()['retries'], 1)
+        self.assertTrue(first.closed and second.closed)
+        self.assertEqual(pool.stats()['probes'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
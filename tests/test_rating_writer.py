@@ -0,0 +1,145 @@
+"""Отложенная пакетная запись оценок (storage_manager/rating_writer.py) в хранилище SQLite:
+последняя оценка побеждает, пачки не больше max_batch, запись при close() и повтор после ошибки записи.
+
+    python -m unittest discover tests
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage_manager.rating_writer import RatingWriter  # noqa: E402
+from storage_manager.sqlite_storage_manager import SqliteStorageManager  # noqa: E402
+
+DELAY = 0.05
+TIMEOUT = 5
+
+logger = logging.getLogger('test_rating_writer')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+class RecordingStorage:
+    """Хранилище, запоминающее пачки оценок (владелец, оценки); первые failures записей завершаются ошибкой"""
+
+    def __init__(self, storage, failures=0):
+        self.storage = storage
+        self.logger = storage.logger
+        self.batches = []
+        self.failures = failures
+
+    def for_owner(self, owner_id):
+        return OwnerStorage(self, owner_id)
+
+
+class OwnerStorage:
+
+    def __init__(self, recorder, owner_id):
+        self.recorder = recorder
+        self.owner_id = owner_id
+
+    def update_ratings(self, marks):
+        # Пачка запоминается после записи, чтобы тест, дождавшийся пачки, видел её в БД
+        try:
+            if self.recorder.failures:
+                self.recorder.failures -= 1
+                raise RuntimeError("БД недоступна")
+            return self.recorder.storage.for_owner(self.owner_id).update_ratings(marks)
+        finally:
+            self.recorder.batches.append((self.owner_id, dict(marks)))
+
+
+class RatingWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = SqliteStorageManager(logger, dict(database=os.path.join(directory.name, 'ratings.sqlite3')))
+        self.addCleanup(self.storage.pool.close)
+        self.song_ids = [self.add_song(f"Песня {number}") for number in range(7)]
+
+    def add_song(self, title, owner_id=0):
+        owner_storage = self.storage.for_owner(owner_id)
+        owner_storage.add_song(title, "Автор", "", 0)
+        return next(song.id for song in owner_storage.search_songs(title, 10) if song.title == title)
+
+    def mark(self, song_id, owner_id=0):
+        return self.storage.for_owner(owner_id).get_song(song_id).mark
+
+    def writer(self, recorder, **params):
+        writer = RatingWriter(recorder, **dict(dict(delay=DELAY), **params))
+        self.addCleanup(writer.close)
+        return writer
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + TIMEOUT
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "оценки не записаны")
+            time.sleep(0.01)
+
+    def test_last_rating_wins(self):
+        recorder = RecordingStorage(self.storage)
+        writer = self.writer(recorder)
+        song_id = self.song_ids[0]
+        for mark in (1, 3, 5):
+            writer.set(song_id, mark)
+        self.wait_for(lambda: recorder.batches)
+        time.sleep(DELAY * 3)
+        self.assertEqual(recorder.batches, [(0, {song_id: 5})])
+        self.assertEqual(self.mark(song_id), 5)
+
+    def test_batches_respect_max_batch(self):
+        recorder = RecordingStorage(self.storage)
+        writer = self.writer(recorder, max_batch=3)
+        for song_id in self.song_ids:
+            writer.set(song_id, 4)
+        self.wait_for(lambda: sum(len(marks) for _, marks in recorder.batches) == len(self.song_ids))
+        self.assertTrue(all(len(marks) <= 3 for _, marks in recorder.batches))
+        self.assertEqual([self.mark(song_id) for song_id in self.song_ids], [4] * len(self.song_ids))
+
+    def test_owners_are_written_separately(self):
+        recorder = RecordingStorage(self.storage)
+        writer = self.writer(recorder)
+        other_song_id = self.add_song("Чужая", owner_id=1)
+        writer.set(self.song_ids[0], 2)
+        writer.set(other_song_id, 3, owner_id=1)
+        self.wait_for(lambda: len(recorder.batches) == 2)
+        self.assertEqual(sorted(recorder.batches), [(0, {self.song_ids[0]: 2}), (1, {other_song_id: 3})])
+        self.assertEqual(self.mark(other_song_id, owner_id=1), 3)
+
+    def test_close_flushes_pending_ratings(self):
+        recorder = RecordingStorage(self.storage)
+        writer = RatingWriter(recorder, delay=60)
+        writer.set(self.song_ids[0], 5)
+        writer.set(self.song_ids[1], 1)
+        writer.close()
+        self.assertFalse(writer._thread.is_alive())
+        self.assertEqual((self.mark(self.song_ids[0]), self.mark(self.song_ids[1])), (5, 1))
+
+    def test_failed_write_is_retried(self):
+        recorder = RecordingStorage(self.storage, failures=1)
+        writer = self.writer(recorder)
+        writer.set(self.song_ids[0], 3)
+        self.wait_for(lambda: len(recorder.batches) == 2)
+        self.assertEqual(recorder.batches, [(0, {self.song_ids[0]: 3})] * 2)
+        self.assertEqual(self.mark(self.song_ids[0]), 3)
+
+    def test_newer_rating_replaces_failed_one(self):
+        recorder = RecordingStorage(self.storage, failures=1)
+        writer = self.writer(recorder, delay=0.2)
+        writer.set(self.song_ids[0], 3)
+        self.wait_for(lambda: recorder.batches)
+        # Оценку поменяли, пока ждали повтора: записывается новая, старая не возвращается
+        writer.set(self.song_ids[0], 4)
+        self.wait_for(lambda: len(recorder.batches) == 2)
+        time.sleep(0.5)
+        self.assertEqual(recorder.batches[1:], [(0, {self.song_ids[0]: 4})])
+        self.assertEqual(self.mark(self.song_ids[0]), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
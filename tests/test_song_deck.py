@@ -0,0 +1,145 @@
+"""Взвешенный случайный выбор композиций (storage_manager/song_deck.py): дерево Фенвика, веса по оценке
+и давности показа, удаление композиций.
+
+    python -m unittest discover tests
+"""
+import os
+import random
+import sys
+import unittest
+from collections import Counter
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage_manager.song_deck import RECENCY_FACTORS, FenwickTree, SongDeck, mark_weight  # noqa: E402
+
+DRAWS = 6000
+
+
+class Clock:
+    """Подменяемое time.monotonic() модуля song_deck"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FenwickTreeTest(unittest.TestCase):
+
+    def test_prefix_sums_and_find(self):
+        weights = [3.0, 0.0, 1.5, 2.0, 0.5, 4.0, 1.0]
+        tree = FenwickTree(weights)
+        self.assertEqual(len(tree), len(weights))
+        for count in range(len(weights) + 1):
+            self.assertAlmostEqual(tree.prefix_sum(count), sum(weights[:count]))
+        # Позиция с нулевым весом никогда не находится
+        for value in [0.0, 2.9, 3.0, 4.4, 4.5, 6.4, 6.5, 6.9, 7.0, 10.9, 11.0, 11.9]:
+            position = tree.find(value)
+            self.assertLessEqual(sum(weights[:position]), value)
+            self.assertGreater(sum(weights[:position + 1]), value)
+
+    def test_append_and_add_match_building(self):
+        weights = [1.0, 2.0, 3.0, 4.0, 5.0]
+        tree = FenwickTree()
+        for weight in weights:
+            tree.append(weight)
+        tree.add(2, -3.0)
+        weights[2] = 0.0
+        built = FenwickTree(weights)
+        for count in range(len(weights) + 1):
+            self.assertAlmostEqual(tree.prefix_sum(count), built.prefix_sum(count))
+        self.assertAlmostEqual(tree.total(), sum(weights))
+
+
+class SongDeckTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(12345)
+        self.clock = Clock()
+        patcher = mock.patch('storage_manager.song_deck.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_distribution_follows_mark_weights(self):
+        # Без ступеней давности вес композиции - только множитель оценки: 1, 2 и 6
+        deck = SongDeck(lambda: [(1, 0, None), (2, 1, None), (3, 5, None)], recency=())
+        counts = Counter(deck.draw()[0] for _ in range(DRAWS))
+        total = sum(mark_weight(mark) for mark in (0, 1, 5))
+        for song_id, mark in [(1, 0), (2, 1), (3, 5)]:
+            self.assertAlmostEqual(counts[song_id] / DRAWS, mark_weight(mark) / total, delta=0.03)
+        self.assertGreater(counts[3], counts[2])
+        self.assertGreater(counts[2], counts[1])
+
+    def test_recently_shown_song_is_rarely_drawn_again(self):
+        # Вес только что показанной композиции - доля RECENCY_FACTORS[0][1] от полного
+        counts = Counter()
+        for _ in range(500):
+            deck = SongDeck(lambda: [(1, 3, None), (2, 3, None)])
+            deck.draw(count=0)  # загрузка колоды
+            deck.mark_shown([1])
+            counts.update(deck.draw())
+        self.assertGreaterEqual(counts[2], 495)
+
+    def test_weight_recovers_by_recency_stages(self):
+        deck = SongDeck(lambda: [(1, 0, None), (2, 0, None)], refresh_seconds=10 ** 9)
+        deck.draw(count=0)  # загрузка колоды
+        deck.mark_shown([1])
+        self.assertAlmostEqual(deck._tree.total(), 1 + RECENCY_FACTORS[0][1])
+        # После истечения каждой ступени вес растёт до множителя следующей, после последней - до полного
+        expected = [factor for _, factor in RECENCY_FACTORS[1:]] + [1.0]
+        for (seconds, _), factor in zip(RECENCY_FACTORS, expected):
+            self.clock.now = 1000.0 + seconds
+            deck.draw(count=0)
+            self.assertAlmostEqual(deck._tree.total(), 1 + factor)
+
+    def test_deleted_song_is_never_drawn(self):
+        deck = SongDeck(lambda: [(1, 5, None), (2, 0, None), (3, 0, None)], recency=())
+        deck.draw(count=0)
+        deck.discard(1)
+        drawn = {song_id for _ in range(DRAWS // 10) for song_id in deck.draw(count=2)}
+        self.assertEqual(drawn, {2, 3})
+        deck.discard(2)
+        deck.discard(3)
+        self.assertEqual(deck.draw(count=3), [])
+
+    def test_empty_deck(self):
+        deck = SongDeck(lambda: [])
+        self.assertEqual(deck.draw(), [])
+        self.assertEqual(deck.draw(count=5, min_mark=3), [])
+        deck.add([(7, 2)])
+        self.assertEqual(deck.draw(), [7])
+
+    def test_draw_distinct_songs_with_min_mark(self):
+        deck = SongDeck(lambda: [(song_id, song_id % 6, None) for song_id in range(1, 31)], recency=())
+        song_ids = deck.draw(count=10, min_mark=3)
+        self.assertEqual(len(song_ids), len(set(song_ids)))
+        self.assertTrue(all(song_id % 6 >= 3 for song_id in song_ids))
+        # Подходящих меньше, чем просят: возвращаются все подходящие
+        self.assertEqual(sorted(deck.draw(count=10, min_mark=5)), [5, 11, 17, 23, 29])
+
+    def test_set_mark_changes_weight(self):
+        deck = SongDeck(lambda: [(1, 0, None), (2, 0, None)], recency=())
+        deck.draw(count=0)
+        deck.set_mark(2, 5)
+        counts = Counter(deck.draw()[0] for _ in range(DRAWS))
+        self.assertAlmostEqual(counts[2] / DRAWS, 6 / 7, delta=0.03)
+
+    def test_refresh_saves_shows_and_keeps_them(self):
+        saved = []
+        deck = SongDeck(lambda: [(1, 0, None), (2, 0, None)], saved.append)
+        deck.draw(count=0)
+        deck.mark_shown([1])
+        self.clock.now += 60
+        deck.refresh()
+        self.assertEqual(saved, [{1: 60.0}])
+        # Показ пережил перечитывание: вес композиции 1 всё ещё понижен
+        self.assertAlmostEqual(deck._tree.total(), 1 + RECENCY_FACTORS[0][1])
+        deck.refresh()
+        self.assertEqual(len(saved), 1)  # сохранять больше нечего
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Бот отвечает на /start, пока БД недоступна: хранилище не готово, а проверка состояния диалога
+(фильтр pending_step) для каждого сообщения не должна падать.
+
+    python -m unittest discover tests
+"""
+import asyncio
+import importlib
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Параметры из шаблона; файл БД SQLite - в несуществующем каталоге, поэтому хранилище не создаётся
+env = importlib.import_module('repertuar_env_template')
+env.TELEGRAM_BOT_TOKEN = "123:test"
+env.STORAGE_BACKEND = "sqlite"
+env.SQLITE_CONNECTOR_PARAMS = dict(database=os.path.join(tempfile.mkdtemp(), 'missing', 'repertuar.sqlite3'))
+sys.modules['repertuar_env'] = env
+
+CHAT_ID = 1000
+
+
+def start_update(update_id):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len('/start')}],
+                        'chat': {'id': CHAT_ID, 'type': 'private'},
+                        'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'Гость', 'username': 'guest'}}}
+
+
+def sent_message(params):
+    """Ответ Telegram API на sendMessage"""
+    return {'message_id': 1, 'date': int(time.time()), 'text': params['text'],
+            'chat': {'id': int(params['chat_id']), 'type': 'private'}}
+
+
+class StorageUnavailableTest(unittest.TestCase):
+
+    def test_sync_start(self):
+        bot_module = importlib.import_module('repertuar_tgbot')
+        self.assertFalse(bot_module.storage.ready)
+        sent = []
+
+        def make_request(token, method_name, method='get', params=None, files=None):
+            sent.append((method_name, params))
+            return sent_message(params)
+
+        bot_module.bot.bot.threaded = False
+        with mock.patch('telebot.apihelper._make_request', make_request):
+            bot_module.bot.process_new_updates([bot_module.telebot.types.Update.de_json(start_update(1))])
+        self.assertEqual([params['text'] for _, params in sent], ["Добро пожаловать!", "Выберите пункт меню"])
+
+    def test_async_start(self):
+        bot_module = importlib.import_module('repertuar_async_tgbot')
+        self.assertFalse(bot_module.storage.ready)
+        sent = []
+
+        async def process_request(token, url, method='get', params=None, files=None, **kwargs):
+            sent.append((url, params))
+            return sent_message(params)
+
+        with mock.patch('telebot.asyncio_helper._process_request', process_request):
+            asyncio.run(bot_module.process_update(start_update(2)))
+        self.assertEqual([params['text'] for _, params in sent], ["Добро пожаловать!", "Выберите пункт меню"])
+
+
+if __name__ == '__main__':
+    unittest.main()
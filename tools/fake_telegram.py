@@ -0,0 +1,144 @@
+"""Локальный имитатор Telegram Bot API для проверки режима webhook без сети.
+
+Поднимает сервер Bot API, который отвечает на вызовы бота и считает отправленные сообщения,
+и присылает на webhook бота заданное количество команд от разных чатов.
+Бот запускается отдельно, в repertuar_env.py для него указываются:
+
+    TELEGRAM_API_URL = "http://127.0.0.1:8081/bot{0}/{1}"
+    WEBHOOK_PARAMS = dict(url="http://127.0.0.1:8443/repertuar", port=8443, path="/repertuar",
+                          secret_token="test")
+
+    python -m tools.fake_telegram --webhook http://127.0.0.1:8443/repertuar --secret test --updates 1000
+
+Результат выводится одной строкой в формате JSON.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Команды, на каждую из которых бот отвечает ровно одним сообщением
+COMMANDS = ['/random', '/tags', '/search кино', '/stats']
+
+
+def make_update(update_id, chat_id, text, username='client'):
+    """Обновление Telegram с текстовым сообщением"""
+    user = dict(id=chat_id, is_bot=False, first_name=username, username=username)
+    return dict(update_id=update_id,
+                message={'message_id': update_id, 'date': int(time.time()), 'text': text,
+                         'chat': dict(id=chat_id, type='private'), 'from': user})
+
+
+class FakeTelegram:
+    """Сервер, отвечающий на вызовы Bot API как Telegram"""
+
+    def __init__(self):
+        self.calls = {}  # метод -> количество вызовов
+        self.replies = 0
+        self.replied = asyncio.Event()
+        self.expected_replies = None
+        self._message_ids = itertools.count(1)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/bot{token}/{method}', self.handle)
+        return app
+
+    def _message(self, params):
+        return dict(message_id=next(self._message_ids), date=int(time.time()), text=params.get('text', ''),
+                    chat=dict(id=int(params.get('chat_id', 0)), type='private'))
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(request.query)
+        params.update((key, value) for key, value in (await request.post()).items() if isinstance(value, str))
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method in ('sendMessage', 'sendDocument', 'editMessageText', 'editMessageReplyMarkup'):
+            result = self._message(params)
+        elif method == 'getMe':
+            result = dict(id=1, is_bot=True, first_name='repertuar', username='repertuar_bot')
+        elif method == 'getFile':
+            file_id = params.get('file_id', '')
+            result = dict(file_id=file_id, file_unique_id=file_id, file_path=f'documents/{file_id}')
+        else:
+            result = True
+
+        if method == 'sendMessage':
+            self.replies += 1
+            if self.expected_replies is not None and self.replies >= self.expected_replies:
+                self.replied.set()
+        return web.json_response(dict(ok=True, result=result))
+
+
+async def post_update(session, url, update, secret):
+    async with session.post(url, json=update, headers={SECRET_HEADER: secret}) as response:
+        return response.status
+
+
+async def run(args):
+    telegram = FakeTelegram()
+    runner = web.AppRunner(telegram.app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.api_port).start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            # Запрос с неверным секретом должен быть отклонён
+            forbidden = await post_update(session, args.webhook, make_update(0, 1, '/stats'), args.secret + 'x')
+
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def send(update_id):
+                async with semaphore:
+                    text = COMMANDS[update_id % len(COMMANDS)]
+                    return await post_update(session, args.webhook,
+                                             make_update(update_id, 1000 + update_id % args.chats, text),
+                                             args.secret)
+
+            started = time.perf_counter()
+            statuses = await asyncio.gather(*(send(update_id) for update_id in range(1, args.updates + 1)))
+            accepted = statuses.count(200)
+            telegram.expected_replies = accepted
+            if telegram.replies >= accepted:
+                telegram.replied.set()
+            try:
+                await asyncio.wait_for(telegram.replied.wait(), timeout=args.timeout)
+            except asyncio.TimeoutError:
+                pass
+            seconds = time.perf_counter() - started
+    finally:
+        await runner.cleanup()
+
+    print(json.dumps(dict(
+        updates=args.updates,
+        accepted=accepted,
+        rejected=statuses.count(503),
+        other_errors=len(statuses) - accepted - statuses.count(503),
+        secret_checked=forbidden == 403,
+        replies=telegram.replies,
+        seconds=round(seconds, 3),
+        updates_per_second=round(telegram.replies / seconds, 1) if seconds else None,
+        calls=telegram.calls,
+    ), ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--webhook", default="http://127.0.0.1:8443/repertuar")
+    parser.add_argument("--secret", default="test")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=60)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""Восстановление репертуара из бэкапов команды /backup: полного и следующих за ним частичных
+(инкрементных или дифференциального), в порядке перечисления.
+
+Композиции добавляются, а у уже сохранённых обновляются теги и оценки, поэтому повторное восстановление
+того же файла ничего не меняет. Каждый файл восстанавливается в одной транзакции и разбирается по мере чтения,
+сжатые (.gz) распознаются по содержимому. Имена файлов бэкапов начинаются со времени, так что порядок
+восстановления даёт сортировка:
+
+    python -m tools.restore backup_repertuar_20240101_030000_full.csv backup_repertuar_2024*_incremental.csv
+
+Репертуар другого музыканта (см. TENANTS в repertuar_env.py) восстанавливается с --owner <id владельца>.
+"""
+import argparse
+
+from repertuar_common import create_logger, create_storage, format_csv_result, format_restore_progress, throttled
+from storage_manager import DEFAULT_OWNER_ID
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="полный бэкап, затем частичные")
+    parser.add_argument("--owner", type=int, default=DEFAULT_OWNER_ID, help="id владельца репертуара")
+    args = parser.parse_args()
+
+    logger = create_logger()
+    # Не в фоне: если БД недоступна, восстановление сразу завершается с ошибкой
+    storage = create_storage(logger, lazy=False).for_owner(args.owner)
+    for path in args.files:
+        with open(path, 'rb') as stream:
+            result = storage.restore(stream, throttled(lambda result: print(format_restore_progress(result))))
+        logger.info(f"Восстановление из {path}: {result}")
+        print(f"{path}:\n{format_csv_result(result)}")
+
+
+if __name__ == "__main__":
+    main()
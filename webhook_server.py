@@ -0,0 +1,112 @@
+"""Режим webhook: Telegram присылает обновления на встроенный HTTP-сервер (aiohttp) вместо long polling.
+
+Обновления проверяются по секретному токену (заголовок X-Telegram-Bot-Api-Secret-Token),
+складываются в ограниченную очередь и обрабатываются несколькими задачами-обработчиками параллельно.
+Если очередь заполнена, сервер отвечает 503 и Telegram повторяет доставку позже.
+С processes > 1 запускается несколько процессов на одном порту (SO_REUSEPORT),
+каждый со своим ботом, пулом соединений с БД и очередью.
+"""
+import asyncio
+import hmac
+import importlib
+import logging
+import multiprocessing
+
+from aiohttp import web
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_app(process_update, secret_token=None, path='/', queue_size=1000, workers=16, setup=None,
+               logger=None):
+    """Приложение aiohttp, принимающее обновления Telegram.
+    process_update - корутина обработки одного обновления (словарь из JSON)
+    setup - корутина, выполняемая при старте (например, регистрация webhook в Telegram)
+    """
+    logger = logger or logging.getLogger('repertuar_bot')
+    state = {}
+
+    async def handle(request):
+        # Байты, а не строки: compare_digest не принимает строки с не-ASCII символами
+        if secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, '').encode(),
+                                                    secret_token.encode()):
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            state['queue'].put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning("Очередь обновлений заполнена, Telegram повторит доставку")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def worker():
+        queue = state['queue']
+        while True:
+            update = await queue.get()
+            try:
+                await process_update(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+            finally:
+                queue.task_done()
+
+    async def on_startup(app):
+        state['queue'] = asyncio.Queue(queue_size)
+        state['workers'] = [asyncio.create_task(worker()) for _ in range(workers)]
+        if setup is not None:
+            await setup()
+
+    async def on_shutdown(app):
+        # Даём дообработать принятые обновления: Telegram их уже не пришлёт повторно
+        try:
+            await asyncio.wait_for(state['queue'].join(), timeout=10)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не обработано обновлений при остановке: {state['queue'].qsize()}")
+        for task in state['workers']:
+            task.cancel()
+        await asyncio.gather(*state['workers'], return_exceptions=True)
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def _app_params(params):
+    return dict(secret_token=params.get('secret_token'), path=params.get('path', '/'),
+                queue_size=params.get('queue_size', 1000), workers=params.get('workers', 16))
+
+
+def serve(bot_module, params, setup=False):
+    """Точка входа процесса-обработчика: импортирует модуль бота и обслуживает webhook.
+    Модуль бота должен определять корутины process_update(update) и setup_webhook().
+    """
+    module = importlib.import_module(bot_module)
+    app = create_app(module.process_update, setup=module.setup_webhook if setup else None,
+                     logger=module.logger, **_app_params(params))
+    web.run_app(app, host=params.get('host', '0.0.0.0'), port=params.get('port', 8443),
+                reuse_port=params.get('processes', 1) > 1, print=None)
+
+
+def run_webhook(params, process_update, setup_webhook, bot_module, logger=None):
+    """Запуск webhook-сервера с параметрами params (WEBHOOK_PARAMS из repertuar_env.py).
+    В одном процессе используются уже созданные process_update и setup_webhook;
+    при processes > 1 каждый процесс заново импортирует bot_module (имя модуля бота).
+    """
+    processes = params.get('processes', 1)
+    if processes <= 1:
+        app = create_app(process_update, setup=setup_webhook, logger=logger, **_app_params(params))
+        web.run_app(app, host=params.get('host', '0.0.0.0'), port=params.get('port', 8443), print=None)
+        return
+    # spawn - чтобы процессы не унаследовали соединения с БД родителя
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=serve, args=(bot_module, params, index == 0), name=f"webhook-{index}")
+               for index in range(processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()